@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Cross-chat luck analytics over the counter tables, computed column-wise in one pass.
+
+A 🎰 spin is a jackpot (one of 4 triples out of 64 values) with probability 4/64, so a
+user's luck is a binomial rate, and ranking by the raw triples/spins puts someone with
+1 spin and 1 jackpot on top. Here users are ranked by the lower Wilson bound of their
+rate instead, next to the z-score of their jackpots against the expected 4/64; per dice
+value the observed count is set against spins/64.
+
+Counters are loaded into numpy arrays and summed per user across all chats.
+
+  users = load_user_totals(c)                       # (user_ids, spins, triples)
+  board = rank_users(*users, min_spins=100, top=100)
+  odds = combo_odds(load_value_counts(c))
+"""
+import numpy as np
+
+P_TRIPLE = 4 / 64
+Z95 = 1.959963984540054
+CHUNK = 1 << 16  # rows per fetchmany()
+
+
+def wilson(k, n, z:float=Z95):
+    """Wilson score interval of k successes in n trials -> (lower, upper), elementwise
+    on arrays."""
+    p = k / n
+    z2 = z * z
+    denom = 1 + z2 / n
+    center = (p + z2 / (2 * n)) / denom
+    half = z * np.sqrt(p * (1 - p) / n + z2 / (4 * n * n)) / denom
+    return center - half, center + half
+
+
+def deviation(k, n, p:float=P_TRIPLE):
+    """Standard deviations k lies above (or below) the n*p expected."""
+    return (k - n * p) / np.sqrt(n * p * (1 - p))
+
+
+def _chunks(cur):
+    while True:
+        rows = cur.fetchmany(CHUNK)
+        if not rows:
+            return
+        yield rows
+
+
+def load_user_totals(c):
+    """spin_totals summed per user over all chats -> (user_ids, spins, triples)."""
+    cur = c.execute("SELECT user_id, spins, triples FROM spin_totals")
+    parts = [np.array(rows, dtype=np.int64) for rows in _chunks(cur)]
+    if not parts:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty
+    a = np.concatenate(parts)
+    uids, inv = np.unique(a[:, 0], return_inverse=True)
+    spins = np.bincount(inv, weights=a[:, 1], minlength=len(uids)).astype(np.int64)
+    triples = np.bincount(inv, weights=a[:, 2], minlength=len(uids)).astype(np.int64)
+    return uids, spins, triples
+
+
+def load_value_counts(c, values:int=64):
+    """dice_counts summed per value over all chats -> counts indexed 0..values (0 unused)."""
+    cur = c.execute("SELECT value, count FROM dice_counts")
+    counts = np.zeros(values + 1, dtype=np.int64)
+    for rows in _chunks(cur):
+        a = np.array(rows, dtype=np.int64)
+        counts += np.bincount(a[:, 0], weights=a[:, 1], minlength=values + 1).astype(np.int64)
+    return counts
+
+
+def rank_users(uids, spins, triples, min_spins:int, top:int, z:float=Z95, p:float=P_TRIPLE):
+    """Users with at least `min_spins`, best `top` by the lower Wilson bound (more
+    jackpots first on ties) -> [(user_id, spins, triples, lower, upper, z-score)]."""
+    min_spins = max(1, min_spins)
+    keep = np.asarray(spins) >= min_spins
+    u = np.asarray(uids)[keep]
+    s = np.asarray(spins)[keep].astype(np.float64)
+    t = np.asarray(triples)[keep].astype(np.float64)
+    if not len(u) or top <= 0:
+        return []
+    lo, hi = wilson(t, s, z)
+    dev = deviation(t, s, p)
+    k = min(top, len(u))
+    idx = np.argpartition(-lo, k - 1)[:k] if k < len(u) else np.arange(len(u))
+    idx = idx[np.lexsort((-t[idx], -lo[idx]))]
+    return [(int(u[i]), int(s[i]), int(t[i]), float(lo[i]), float(hi[i]), float(dev[i])) for i in idx]
+
+
+def combo_odds(counts):
+    """Observed vs expected count of every dice value (each 1/64) ->
+    [(value, observed, expected, z-score)] for values 1..len(counts)-1."""
+    observed = np.asarray(counts, dtype=np.int64)[1:]
+    values, total = len(observed), int(observed.sum())
+    if not total:
+        return [(v, 0, 0.0, 0.0) for v in range(1, values + 1)]
+    expected = total / values
+    dev = deviation(observed, total, 1 / values)
+    return [(v, int(n), expected, float(d)) for v, n, d in zip(range(1, values + 1), observed, dev)]
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Load/replay benchmark for the bot's hot paths (on_dice, /mystats, /stats).
+
+Runs the real handlers against a throwaway SQLite file with a fake bot (replies are
+recorded, nothing goes to Telegram) and prints one JSON document with throughput,
+per-handler latency percentiles, DB commits and DB file growth.
+
+  python bench.py synth --chats 50 --users 20 --updates 20000 [--record updates.jsonl]
+  python bench.py replay updates.jsonl
+  python bench.py micro [--loops 200000]   # on_dice per-update CPU, outcome table vs the old inline code
+
+Update stream format (JSONL, one per line):
+  {"kind": "dice", "chat_id": -100, "user_id": 7, "name": "Alice", "value": 64, "ts": 1760000000}
+  {"kind": "mystats" | "stats", "chat_id": -100, "user_id": 7, "name": "Alice", "ts": 1760000000}
+"""
+import argparse, asyncio, json, os, random, sys, tempfile, time, tracemalloc
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import bot
+
+
+class FakeMessage:
+    """Stands in for telegram.Message: only what the handlers touch."""
+    __slots__ = ("dice", "date", "replies")
+
+    def __init__(self, dice, date):
+        self.dice = dice
+        self.date = date
+        self.replies = 0
+
+    async def reply_text(self, text, **kwargs):
+        self.replies += 1
+
+
+def make_update(u: dict):
+    date = datetime.fromtimestamp(u.get("ts") or time.time(), tz=timezone.utc)
+    dice = SimpleNamespace(emoji="🎰", value=u["value"]) if u["kind"] == "dice" else None
+    m = FakeMessage(dice, date)
+    return SimpleNamespace(
+        effective_message=m,
+        message=m,
+        effective_user=SimpleNamespace(id=u["user_id"], full_name=u.get("name"), username=None),
+        effective_chat=SimpleNamespace(id=u["chat_id"]),
+    )
+
+
+def synth_updates(chats:int, users:int, n:int, mystats:float, stats:float, seed:int):
+    """Synthetic stream: users spin 🎰 (the dice value is uniform over 1..64, like Telegram's)
+    and now and then ask for /mystats or /stats in their chat."""
+    rng = random.Random(seed)
+    ts = int(time.time()) - n
+    for i in range(n):
+        chat = rng.randrange(chats)
+        uid = chat * users + rng.randrange(users) + 1
+        u = {"chat_id": -1000 - chat, "user_id": uid, "name": f"user{uid}", "ts": ts + i}
+        r = rng.random()
+        if r < stats:
+            u["kind"] = "stats"
+        elif r < stats + mystats:
+            u["kind"] = "mystats"
+        else:
+            u["kind"] = "dice"
+            u["value"] = rng.randint(1, 64)
+        yield u
+
+
+def read_jsonl(path:str):
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def percentile(sorted_vals, p:float) -> float:
+    if not sorted_vals:
+        return 0.0
+    k = min(len(sorted_vals) - 1, max(0, int(round(p / 100 * (len(sorted_vals) - 1)))))
+    return sorted_vals[k]
+
+
+def db_size(path:str) -> int:
+    return sum(os.path.getsize(p) for p in (path, path + "-wal") if os.path.exists(p))
+
+
+async def drive(updates, db_path:str) -> dict:
+    bot.DB_PATH = db_path
+    bot._storage = None
+    bot.spin_buffer = bot.SpinBuffer(bot.SPIN_FLUSH_INTERVAL, bot.SPIN_FLUSH_MAX)
+    bot.stats_cache = bot.StatsCache(bot.STATS_CACHE_CHATS, bot.STATS_SPIN_STALENESS)
+    bot.reply_scheduler = bot.ReplyScheduler()
+    # replies go to a fake bot, so Telegram's flood limits are not simulated
+    bot.send_queue = bot.SendQueue(rate=1e9, chat_rate=1e9, chat_burst=1e9)
+    storage = bot.get_storage()
+    size_before = db_size(storage.path)
+    handlers = {"dice": bot.on_dice, "mystats": bot.cmd_mystats, "stats": bot.cmd_stats}
+    latencies = {k: [] for k in handlers}
+    ctx = SimpleNamespace(args=[])
+    clock = time.perf_counter
+
+    start = clock()
+    for u in updates:
+        update = make_update(u)
+        t0 = clock()
+        await handlers[u["kind"]](update, ctx)
+        latencies[u["kind"]].append(clock() - t0)
+    handled = clock() - start
+    await bot.spin_buffer.close()
+    elapsed = clock() - start
+    await bot.reply_scheduler.drain(0)
+    await bot.send_queue.drain(0)
+    writes = storage.writes
+    bot.close_storage()
+
+    total = sum(len(v) for v in latencies.values())
+    result = {
+        "updates": total,
+        "seconds": round(elapsed, 4),
+        "updates_per_sec": round(total / handled, 1) if handled else None,
+        "db": {
+            "commits": writes,
+            "spin_flushes": bot.spin_buffer.commits,
+            "commits_per_sec": round(writes / elapsed, 2) if elapsed else None,
+            "bytes_before": size_before,
+            "bytes_after": db_size(db_path),
+            "bytes_per_spin": round((db_size(db_path) - size_before) / max(1, len(latencies["dice"])), 2),
+        },
+        "handlers": {},
+    }
+    for kind, vals in latencies.items():
+        vals.sort()
+        result["handlers"][kind] = {
+            "count": len(vals),
+            "p50_us": round(percentile(vals, 50) * 1e6, 1),
+            "p99_us": round(percentile(vals, 99) * 1e6, 1),
+            "max_us": round(vals[-1] * 1e6, 1) if vals else 0.0,
+        }
+    return result
+
+
+# ---- micro: per-update CPU of on_dice's classification, before/after the outcome table ----
+def classify_before(m, user):
+    """on_dice's per-spin work as it was before OUTCOMES / DisplayNames (the baseline)."""
+    d = getattr(m, "dice", None)
+    if not d or d.emoji != "🎰":
+        return None
+    if any(getattr(m, a, None) for a in ("forward_origin","forward_from","forward_from_chat","forward_sender_name")) \
+       or getattr(m, "is_automatic_forward", False):
+        return None
+    value = int(d.value)
+    combo_tuple = bot.slot_value.get(value)
+    if not combo_tuple:
+        return None
+    username = user.full_name or (user.username and f"@{user.username}") or str(user.id)
+    triple = combo_tuple[0] == combo_tuple[1] == combo_tuple[2]
+    return value, username, triple, len(set(combo_tuple)) == 2
+
+
+def classify_after(m, user):
+    o = bot.dice_outcome(m)
+    if o is None:
+        return None
+    return o.value, bot.display_names.get(user), o.triple, o.near
+
+
+def render_before(value:int) -> str:
+    return "".join(bot.EMOJI[x] for x in bot.slot_value[value])
+
+
+def micro_messages():
+    """Real telegram objects (User.full_name is a property, as in production)."""
+    from telegram import Chat, Dice, Message, MessageOriginUser, User
+    date = datetime.now(timezone.utc)
+    chat = Chat(-1001, Chat.SUPERGROUP)
+    user = User(7, "Alice", False, last_name="Liddell", username="alice")
+    spins = [Message(i, date, chat, from_user=user, dice=Dice(i, "🎰")) for i in range(1, 65)]
+    other = [Message(1, date, chat, from_user=user, dice=Dice(6, "🎲"))]
+    forward = [Message(1, date, chat, from_user=user, dice=Dice(64, "🎰"),
+                       forward_origin=MessageOriginUser(date, user))]
+    return user, {"spin": spins, "reject_other_dice": other, "reject_forward": forward}
+
+
+def ns_per_call(fn, args, loops:int, repeat:int=5) -> float:
+    n = len(args)
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter_ns()
+        for i in range(loops):
+            fn(*args[i % n])
+        best = min(best, time.perf_counter_ns() - t0)
+    return best / loops
+
+
+def peak_bytes(fn, args) -> int:
+    """Most memory held at once during one call (0: nothing allocated)."""
+    fn(*args)  # warm caches (display names) first
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        fn(*args)
+        return tracemalloc.get_traced_memory()[1] - base
+    finally:
+        tracemalloc.stop()
+
+
+def micro(loops:int) -> dict:
+    user, cases = micro_messages()
+    result = {"loops": loops, "cases": {}}
+    variants = {name: ([(m, user) for m in msgs], classify_before, classify_after) for name, msgs in cases.items()}
+    variants["render"] = ([(v,) for v in range(1, 65)], render_before, bot._compact_combo)
+    for name, (args, before, after) in variants.items():
+        b, a = ns_per_call(before, args, loops), ns_per_call(after, args, loops)
+        result["cases"][name] = {
+            "before_ns": round(b, 1),
+            "after_ns": round(a, 1),
+            "speedup": round(b / a, 2) if a else None,
+            "before_peak_bytes": peak_bytes(before, args[-1]),
+            "after_peak_bytes": peak_bytes(after, args[-1]),
+        }
+    return result
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = p.add_subparsers(dest="mode", required=True)
+    s = sub.add_parser("synth", help="generate a synthetic update stream and run it")
+    s.add_argument("--chats", type=int, default=50)
+    s.add_argument("--users", type=int, default=20, help="users per chat")
+    s.add_argument("--updates", type=int, default=20000)
+    s.add_argument("--mystats", type=float, default=0.02, help="share of /mystats updates")
+    s.add_argument("--stats", type=float, default=0.01, help="share of /stats updates")
+    s.add_argument("--seed", type=int, default=1)
+    s.add_argument("--record", help="also write the generated stream to this JSONL file")
+    r = sub.add_parser("replay", help="replay a recorded JSONL stream at full speed")
+    r.add_argument("path")
+    m = sub.add_parser("micro", help="time on_dice's per-update classification, old inline code vs outcome table")
+    m.add_argument("--loops", type=int, default=200_000)
+    for sp in (s, r):
+        sp.add_argument("--db", help="SQLite file to use (default: fresh temp file)")
+    for sp in (s, r, m):
+        sp.add_argument("--out", help="write the JSON result here as well as to stdout")
+    args = p.parse_args(argv)
+
+    if args.mode == "micro":
+        result = micro(args.loops)
+        updates = None
+    elif args.mode == "synth":
+        updates = list(synth_updates(args.chats, args.users, args.updates, args.mystats, args.stats, args.seed))
+        if args.record:
+            with open(args.record, "w", encoding="utf-8") as f:
+                for u in updates:
+                    f.write(json.dumps(u) + "\n")
+    else:
+        updates = list(read_jsonl(args.path))
+
+    if updates is not None:
+        tmp = None
+        db_path = args.db
+        if not db_path:
+            tmp = tempfile.TemporaryDirectory()
+            db_path = os.path.join(tmp.name, "bench.sqlite3")
+        try:
+            result = asyncio.run(drive(updates, db_path))
+        finally:
+            if tmp:
+                tmp.cleanup()
+    result["mode"] = args.mode
+    out = json.dumps(result, indent=2)
+    print(out)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(out + "\n")
+    return result
+
+
+if __name__ == "__main__":
+    sys.exit(main() and 0)
@@ -6,7 +6,10 @@ Ludooman Bot — Telegram slot 🎰 tracker
 - On triple (jackpot) sends a random phrase from a preset list
 - Occasionally reacts to near-jackpot (two-of-a-kind) with a random phrase after a random delay
 - SQLite stats (persistent with Railway Volume)
-- Commands: /mystats, /stats, /help
+- Commands: /mystats, /stats, /global, /help
+- Optional gzip'd online snapshots of the DB (SNAPSHOT_DIR), restored at startup if the DB is gone
+- Backfill from a Telegram Desktop chat export: python bot.py import result.json [--chat-id ID] [--until TS] [--force]
+- Optional memory-mapped counter file for /mystats (COUNTER_STORE); rebuild it: python bot.py counters rebuild
 
 ENV:
   TG_TOKEN                - required
@@ -16,16 +19,90 @@ ENV:
   JACKPOT_DELAY           - delay before jackpot reply in seconds (default 4.1)
   NEAR_JACKPOT_DELAY_MIN  - min delay before near-jackpot reply (default 4.5)
   NEAR_JACKPOT_DELAY_MAX  - max delay before near-jackpot reply (default 10)
+  REPLY_DRAIN_TIMEOUT     - seconds to wait for pending delayed replies on shutdown (default 10)
+  SPIN_FLUSH_INTERVAL     - max seconds spins stay buffered before being written (default 2)
+  SPIN_FLUSH_MAX          - flush early once this many (chat, user, value) keys are pending (default 500)
+  DB_READERS              - read-only SQLite connections for stats queries (default 4)
+  MIGRATE_BATCH           - rows per transaction when migrating an old (v1) DB at startup (default 2000)
+  STATS_CACHE_CHATS       - chats whose /stats aggregate is kept in memory (LRU, default 1000)
+  STATS_SPIN_STALENESS    - seconds cached /stats may lag plain (non-jackpot) spins (default 30)
+  STATS_TOP_LUCK          - rows in the /stats luck list (default 10)
+  SPIN_LOG_RETENTION_DAYS - days of raw spin events kept (one table per day, default 14)
+  ROLLUP_HOURLY_RETENTION_DAYS - days of hourly rollups kept, at least 2 (default 7)
+  ROLLUP_DAILY_RETENTION_DAYS  - days of daily rollups kept, at least 30, 0 = forever (default 0)
+  UPDATE_CONCURRENCY      - updates handled in parallel, one at a time per chat (default 32, 1 = sequential)
+  SEND_RATE               - max messages/sec the bot sends overall (default 25)
+  SEND_CHAT_RATE          - max messages/sec per chat (default 0.33, ~20/min as in groups)
+  SEND_CHAT_BURST         - messages a quiet chat may get back to back (default 3)
+  SEND_QUEUE_MAX          - queued messages before near-jackpot taunts are dropped (default 1000)
+  SEND_DROP_AFTER         - seconds a queued near-jackpot taunt is still worth sending (default 30)
+  SEND_CONCURRENCY        - Bot API send requests in flight (default 16)
+  SHARDS                  - >1: webhook front + this many worker processes, one SQLite shard each
+                            (DB_PATH stem + .shardN, see cluster.py; default 1)
+  SHARD_PORT_BASE         - first localhost port for shard workers (default 8100)
+  WEBHOOK_SECRET          - optional secret_token for the webhook (checked by the shard front)
+  METRICS_PORT            - side port for Prometheus /metrics in polling mode (default 9091, 0 = off);
+                            in webhook mode /metrics is served on PORT next to the webhook
+  METRICS_PATH            - metrics route (default /metrics)
+  READY_PATH              - readiness probe next to METRICS_PATH: 503 until the DB is open and updates
+                            flow, then 200 (default /ready)
+  BOT_POOL_SIZE           - Bot API connections for sending (default 256)
+  BOT_KEEPALIVE           - seconds an idle Bot API connection is kept for reuse (default 60)
+  BOT_CONNECT_TIMEOUT     - Bot API connect timeout (default 5)
+  BOT_READ_TIMEOUT        - Bot API read timeout; getUpdates adds its long-poll time on top (default 10)
+  BOT_WRITE_TIMEOUT       - Bot API write timeout (default 10)
+  BOT_POOL_TIMEOUT        - seconds a request may wait for a free pooled connection (default 5)
+  POLL_TIMEOUT            - getUpdates long-poll seconds in polling mode (default 30)
+  DROP_PENDING_UPDATES    - 1: discard updates queued at Telegram while the bot was down (default);
+                            0: process them (spins counted before the restart are skipped)
+  DEDUPE_RECENT           - recent (chat, message) ids remembered to drop redelivered spins (default 100000)
+  SHED_LAG                - update lag in seconds that moves load shedding to level 1,2,3,4 (default 5,15,30,60;
+                            empty = never shed): 1 no near-jackpot taunts, 2 /stats from cache however stale,
+                            3 spins flushed SHED_FLUSH_STRETCH times less often, 4 count spins only
+  SHED_BACKLOG            - updates waiting for a handler that do the same (default 200,500,1000,2000)
+  SHED_RECOVER_AFTER      - calm seconds before stepping one level back down (default 10)
+  SHED_FLUSH_STRETCH      - flush interval / batch size multiplier from level 3 (default 5)
+  SNAPSHOT_DIR            - directory for gzip'd online snapshots of the DB (default empty = off);
+                            put it on another volume than DB_PATH
+  SNAPSHOT_INTERVAL       - seconds between snapshots (default 3600)
+  SNAPSHOT_KEEP           - snapshots kept per DB file (default 24)
+  SNAPSHOT_STEP_PAGES     - DB pages copied per backup step (default 256)
+  SNAPSHOT_RESTORE        - 1: if DB_PATH is missing at startup, restore the newest good snapshot (default 1)
+  COMPACT_INTERVAL        - min seconds between VACUUMs, run only in quiet periods with enough free pages (default 86400)
+  QUIET_SPINS             - spins per minute at or below which WAL checkpoints and VACUUM may run (default 30)
+  GLOBAL_INTERVAL         - seconds between rebuilds of the /global cross-chat luck board (default 600)
+  GLOBAL_MIN_SPINS        - spins a user needs (over all chats) to be ranked on /global (default 100)
+  GLOBAL_TOP              - rows of the /global board kept in the DB (default 100)
+  COUNTER_STORE           - 1: keep every user's 64 value counters and spin total in a memory-mapped file
+                            next to the DB (DB_PATH stem + .counters), updated in place on each spin, so
+                            /mystats needs no SQL; rebuilt from SQLite at startup unless it was closed
+                            cleanly at the DB's last flush (default 0)
+  COUNTER_STORE_SLOTS     - initial (chat, user) slots of that file, doubled as it fills (default 65536)
 """
-import os, sqlite3, logging, hashlib, random, asyncio
-from typing import Tuple
+import os, sys, io, re, gzip, html, json, mmap, shutil, struct, argparse, sqlite3, contextlib, logging, hashlib, random, asyncio, heapq, itertools, pathlib, queue, threading, time, functools
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import NamedTuple, Tuple
 from telegram import Update
 from telegram.constants import ParseMode
-from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters
+from telegram.error import NetworkError, RetryAfter, TimedOut
+from telegram.ext import Application, BaseUpdateProcessor, CommandHandler, MessageHandler, ContextTypes, filters
+from telegram.request import HTTPXRequest
+import httpx
+import analytics, metrics
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("ludooman")
 
+def _retention_days(name:str, default:str, minimum:int) -> int:
+    """Days from the env; 0 = forever, otherwise at least `minimum` (what /stats windows read)."""
+    days = int(os.getenv(name, default))
+    if 0 < days < minimum:
+        log.warning("%s=%d is too short for /stats, keeping %d days", name, days, minimum)
+        return minimum
+    return days
+
 TOKEN = os.getenv("TG_TOKEN")
 DB_PATH = os.getenv("DB_PATH", "casino_stats.sqlite3")
 WEBHOOK_BASE = os.getenv("WEBHOOK_BASE")
@@ -34,6 +111,62 @@ PORT = int(os.getenv("PORT", "8080"))
 JACKPOT_DELAY = float(os.getenv("JACKPOT_DELAY", "4.1"))
 NEAR_JACKPOT_DELAY_MIN = float(os.getenv("NEAR_JACKPOT_DELAY_MIN", "4.5"))
 NEAR_JACKPOT_DELAY_MAX = float(os.getenv("NEAR_JACKPOT_DELAY_MAX", "10"))
+REPLY_DRAIN_TIMEOUT = float(os.getenv("REPLY_DRAIN_TIMEOUT", "10"))
+SPIN_FLUSH_INTERVAL = float(os.getenv("SPIN_FLUSH_INTERVAL", "2"))
+SPIN_FLUSH_MAX = int(os.getenv("SPIN_FLUSH_MAX", "500"))
+DB_READERS = int(os.getenv("DB_READERS", "4"))
+MIGRATE_BATCH = int(os.getenv("MIGRATE_BATCH", "2000"))
+KNOWN_NAMES_MAX = 100_000
+DISPLAY_NAMES_MAX = 50_000
+STATS_CACHE_CHATS = int(os.getenv("STATS_CACHE_CHATS", "1000"))
+STATS_SPIN_STALENESS = float(os.getenv("STATS_SPIN_STALENESS", "30"))
+STATS_TOP_LUCK = int(os.getenv("STATS_TOP_LUCK", "10"))
+SPIN_LOG_RETENTION_DAYS = int(os.getenv("SPIN_LOG_RETENTION_DAYS", "14"))
+ROLLUP_HOURLY_RETENTION_DAYS = _retention_days("ROLLUP_HOURLY_RETENTION_DAYS", "7", 2)  # /stats day: 24h spans 2 UTC days
+ROLLUP_DAILY_RETENTION_DAYS = _retention_days("ROLLUP_DAILY_RETENTION_DAYS", "0", 30)   # /stats month
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "32"))
+SEND_RATE = float(os.getenv("SEND_RATE", "25"))
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "0.33"))
+SEND_CHAT_BURST = float(os.getenv("SEND_CHAT_BURST", "3"))
+SEND_QUEUE_MAX = int(os.getenv("SEND_QUEUE_MAX", "1000"))
+SEND_DROP_AFTER = float(os.getenv("SEND_DROP_AFTER", "30"))
+SEND_CONCURRENCY = int(os.getenv("SEND_CONCURRENCY", "16"))
+SHARDS = int(os.getenv("SHARDS", "1"))
+SHARD_PORT_BASE = int(os.getenv("SHARD_PORT_BASE", "8100"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None
+WORKER_PORT = int(os.getenv("WORKER_PORT", "0"))  # set by cluster.py for shard workers
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9091"))
+METRICS_PATH = os.getenv("METRICS_PATH", "/metrics")
+READY_PATH = os.getenv("READY_PATH", "/ready")
+BOT_POOL_SIZE = int(os.getenv("BOT_POOL_SIZE", "256"))
+BOT_KEEPALIVE = float(os.getenv("BOT_KEEPALIVE", "60"))
+BOT_CONNECT_TIMEOUT = float(os.getenv("BOT_CONNECT_TIMEOUT", "5"))
+BOT_READ_TIMEOUT = float(os.getenv("BOT_READ_TIMEOUT", "10"))
+BOT_WRITE_TIMEOUT = float(os.getenv("BOT_WRITE_TIMEOUT", "10"))
+BOT_POOL_TIMEOUT = float(os.getenv("BOT_POOL_TIMEOUT", "5"))
+POLL_TIMEOUT = int(os.getenv("POLL_TIMEOUT", "30"))
+DROP_PENDING_UPDATES = os.getenv("DROP_PENDING_UPDATES", "1") != "0"
+DEDUPE_RECENT = int(os.getenv("DEDUPE_RECENT", "100000"))
+SHED_LAG = [float(x) for x in os.getenv("SHED_LAG", "5,15,30,60").split(",") if x.strip()]
+SHED_BACKLOG = [int(x) for x in os.getenv("SHED_BACKLOG", "200,500,1000,2000").split(",") if x.strip()]
+SHED_RECOVER_AFTER = float(os.getenv("SHED_RECOVER_AFTER", "10"))
+SHED_FLUSH_STRETCH = float(os.getenv("SHED_FLUSH_STRETCH", "5"))
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "")
+SNAPSHOT_INTERVAL = float(os.getenv("SNAPSHOT_INTERVAL", "3600"))
+SNAPSHOT_KEEP = int(os.getenv("SNAPSHOT_KEEP", "24"))
+SNAPSHOT_STEP_PAGES = int(os.getenv("SNAPSHOT_STEP_PAGES", "256"))
+SNAPSHOT_RESTORE = os.getenv("SNAPSHOT_RESTORE", "1") != "0"
+COMPACT_INTERVAL = float(os.getenv("COMPACT_INTERVAL", "86400"))
+QUIET_SPINS = int(os.getenv("QUIET_SPINS", "30"))
+GLOBAL_INTERVAL = float(os.getenv("GLOBAL_INTERVAL", "600"))
+GLOBAL_MIN_SPINS = int(os.getenv("GLOBAL_MIN_SPINS", "100"))
+GLOBAL_TOP = int(os.getenv("GLOBAL_TOP", "100"))
+COUNTER_STORE = os.getenv("COUNTER_STORE", "0") != "0"
+COUNTER_STORE_SLOTS = int(os.getenv("COUNTER_STORE_SLOTS", "65536"))
+CHECKPOINT_INTERVAL = 600
+COMPACT_FREE_RATIO = 0.2
+STATS_TOP_USERS = 10
+STATS_TOP_COMBO = 5
 
 # ---- jackpot phrases (sent on triples) ----
 JACKPOT_PHRASES = [
@@ -136,264 +269,2703 @@ slot_value = {
 }
 EMOJI = {"bar":"🍺", "grape":"🍇", "lemon":"🍋", "seven":"7️⃣"}
 
-# ---- DB with auto-dir creation and fallback ----
-_conn = None
-def get_conn() -> sqlite3.Connection:
-    global _conn
-    if _conn is None:
-        db_dir = os.path.dirname(DB_PATH)
+class Outcome(NamedTuple):
+    value: int
+    symbols: Tuple[str, str, str]
+    key: str       # "seven|seven|seven" (v1 schema key)
+    triple: bool   # jackpot
+    near: bool     # exactly two identical symbols
+    compact: str   # "7️⃣7️⃣7️⃣" (без пробелов)
+
+# Everything on_dice and the renderers need per value, computed once; OUTCOMES[value], 1..64.
+OUTCOMES = (None,) + tuple(
+    Outcome(v, t, "|".join(t), len(set(t)) == 1, len(set(t)) == 2, "".join(EMOJI[x] for x in t))
+    for v, t in sorted(slot_value.items()))
+COMBO_KEY = {o.value: o.key for o in OUTCOMES[1:]}  # 64 -> "seven|seven|seven"
+COMBO_VALUE = {k: v for v, k in COMBO_KEY.items()}
+TRIPLES = (64, 22, 43, 1)  # 7️⃣7️⃣7️⃣, 🍇🍇🍇, 🍋🍋🍋, 🍺🍺🍺
+TRIPLE_SET = frozenset(TRIPLES)
+
+def dice_outcome(m):
+    """-> Outcome of a countable 🎰 message, else None. Other dice and forwards are turned
+    away on attribute reads alone, before anything is allocated."""
+    d = getattr(m, "dice", None)
+    if d is None or d.emoji != "🎰":
+        return None
+    if getattr(m, "forward_origin", None) is not None or getattr(m, "is_automatic_forward", False):
+        return None
+    value = d.value
+    return OUTCOMES[value] if 0 < value < len(OUTCOMES) else None
+
+class DisplayNames:
+    """user_id -> name shown in stats: full name, else @username, else the id.
+
+    telegram.User.full_name builds a new string on every access; here it is built once
+    per (first_name, last_name, username) and afterwards only compared. Cleared when it
+    grows past `max_size`, like SpinBuffer's known names.
+    """
+    def __init__(self, max_size:int):
+        self.max_size = max_size
+        self._names = {}  # user_id -> (first_name, last_name, username, name)
+
+    def __len__(self):
+        return len(self._names)
+
+    def get(self, user) -> str:
+        first = getattr(user, "first_name", None)
+        if first is None:  # no name parts to compare (full_name given as is)
+            return user.full_name or (user.username and f"@{user.username}") or str(user.id)
+        last, username = user.last_name, user.username
+        e = self._names.get(user.id)
+        if e is not None and e[0] == first and e[1] == last and e[2] == username:
+            return e[3]
+        name = user.full_name or (username and f"@{username}") or str(user.id)
+        if len(self._names) >= self.max_size:
+            self._names.clear()
+        self._names[user.id] = (first, last, username, name)
+        return name
+
+display_names = DisplayNames(DISPLAY_NAMES_MAX)
+
+# ---- Metrics (Prometheus text at METRICS_PATH; values read lazily where a counter already exists) ----
+LAG_BUCKETS = (.1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300, 3600)
+HANDLER_SECONDS = metrics.Histogram("ludooman_handler_seconds", "Handler run time.", ("handler",))
+UPDATE_LAG = metrics.Histogram("ludooman_update_lag_seconds", "Message date to handling time.", buckets=LAG_BUCKETS)
+SQLITE_SECONDS = metrics.Histogram("ludooman_sqlite_seconds", "SQLite job run time (writer thread / reader pool).", ("mode", "op"))
+TG_SECONDS = metrics.Histogram("ludooman_telegram_request_seconds", "Bot API call latency.", ("method",))
+TG_ERRORS = metrics.Counter("ludooman_telegram_errors_total", "Failed Bot API calls by HTTP status (or 'network').", ("method", "code"))
+metrics.Sampled("ludooman_sqlite_commits_total", "Write transactions run by the writer thread.",
+                lambda: _storage.writes if _storage else 0, kind="counter")
+metrics.Sampled("ludooman_sqlite_write_backlog", "Write jobs queued for the writer thread.",
+                lambda: _storage.write_backlog if _storage else 0)
+metrics.Sampled("ludooman_spins_total", "Spins counted since start.", lambda: spin_buffer.spins, kind="counter")
+metrics.Sampled("ludooman_duplicate_spins_total", "Redelivered spins dropped (already counted).",
+                lambda: spin_dedupe.duplicates, kind="counter")
+metrics.Sampled("ludooman_delayed_replies_pending", "Delayed replies waiting to be sent.", lambda: reply_scheduler.depth)
+metrics.Sampled("ludooman_delayed_replies_total", "Delayed replies by outcome.",
+                lambda: {(k,): getattr(reply_scheduler, k) for k in ("sent", "failed", "dropped")},
+                ("outcome",), kind="counter")
+metrics.Sampled("ludooman_send_queue_pending", "Messages queued or in flight in the send queue.", lambda: send_queue.pending)
+metrics.Sampled("ludooman_send_queue_total", "Send queue messages by outcome (retried = RetryAfter/network requeues).",
+                lambda: {(k,): getattr(send_queue, k) for k in ("sent", "failed", "dropped", "retried")},
+                ("outcome",), kind="counter")
+metrics.Sampled("ludooman_updates_running", "Updates being handled.", lambda: update_processor.running)
+metrics.Sampled("ludooman_updates_waiting", "Updates waiting for their chat's turn or a free slot.",
+                lambda: update_processor.waiting)
+metrics.Sampled("ludooman_shed_level", "Load shedding level (0 normal .. 4 count-only).", lambda: load_shedder.level)
+metrics.Sampled("ludooman_shed_skipped_total", "Optional work skipped while shedding load.",
+                lambda: {(k,): n for k, n in load_shedder.skipped.items()}, ("what",), kind="counter")
+metrics.Sampled("ludooman_snapshots_total", "Online DB snapshots by outcome.",
+                lambda: {("taken",): snapshots.taken, ("failed",): snapshots.failed}, ("outcome",), kind="counter")
+metrics.Sampled("ludooman_snapshot_last_timestamp_seconds", "Unix time of the last good snapshot.",
+                lambda: snapshots.last_at)
+metrics.Sampled("ludooman_snapshot_last_seconds", "Run time of the last snapshot (backup + gzip).",
+                lambda: snapshots.last_seconds)
+metrics.Sampled("ludooman_ready", "1 once the DB is open and updates flow.", lambda: int(startup.ready))
+metrics.Sampled("ludooman_startup_phase_seconds", "Time spent in each startup phase (phases overlap).",
+                lambda: {(k,): v for k, v in startup.phases.items()}, ("phase",))
+metrics.Sampled("ludooman_stats_cache_total", "/stats text cache lookups.",
+                lambda: {("hit",): stats_cache.hits, ("miss",): stats_cache.misses}, ("result",), kind="counter")
+
+def instrumented(name:str):
+    """Handler decorator: run time into HANDLER_SECONDS, message age into UPDATE_LAG."""
+    latency = HANDLER_SECONDS.labels(name)
+    def deco(fn):
+        @functools.wraps(fn)
+        async def wrapper(update, context):
+            t0 = time.perf_counter()
+            date = getattr(update.effective_message, "date", None)
+            if date is not None:
+                lag = time.time() - date.timestamp()
+                UPDATE_LAG.observe(lag)
+                load_shedder.observe_lag(lag)
+            try:
+                return await fn(update, context)
+            finally:
+                latency.observe(time.perf_counter() - t0)
+        return wrapper
+    return deco
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest that times each Bot API call and counts non-2xx answers (429 included).
+
+    All `connection_pool_size` connections may stay open for `keepalive` idle seconds
+    (httpx drops them after 5 by default), so bursts of replies after a quiet spell reuse
+    warm TLS connections instead of queueing behind new handshakes.
+    """
+    def __init__(self, connection_pool_size:int, keepalive:float=5.0, **kwargs):
+        limits = httpx.Limits(max_connections=connection_pool_size,
+                              max_keepalive_connections=connection_pool_size, keepalive_expiry=keepalive)
+        super().__init__(connection_pool_size=connection_pool_size,
+                         httpx_kwargs={**kwargs.pop("httpx_kwargs", {}), "limits": limits}, **kwargs)
+
+    async def do_request(self, url:str, method:str, *args, **kwargs):
+        api = url.rsplit("/", 1)[-1]
+        t0 = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            TG_ERRORS.labels(api, "network").inc()
+            raise
+        finally:
+            dt = time.perf_counter() - t0
+            TG_SECONDS.labels(api).observe(dt)
+            if not startup.ready:
+                startup.record(api, dt)  # getMe, setWebhook/deleteWebhook
+        if code >= 300:
+            TG_ERRORS.labels(api, str(code)).inc()
+        return code, payload
+
+def api_request(pool_size:int) -> InstrumentedRequest:
+    return InstrumentedRequest(pool_size, keepalive=BOT_KEEPALIVE, connect_timeout=BOT_CONNECT_TIMEOUT,
+                               read_timeout=BOT_READ_TIMEOUT, write_timeout=BOT_WRITE_TIMEOUT,
+                               pool_timeout=BOT_POOL_TIMEOUT)
+
+# ---- Startup: DB open runs on a thread alongside getMe/setWebhook; updates wait for it ----
+class StartupLog:
+    """Seconds per startup phase, from process start to ready (phases run in parallel)."""
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        self.phases = {}
+        self.ready = False
+        self._lock = threading.Lock()
+
+    def record(self, phase:str, seconds:float):
+        with self._lock:
+            self.phases.setdefault(phase, seconds)  # first time only (getMe is called again later)
+
+    @contextlib.contextmanager
+    def phase(self, name:str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - t0)
+
+    def done(self):
+        self.record("total", time.perf_counter() - self.t0)
+        self.ready = True
+        log.info("Ready in %.2fs (%s)", self.phases["total"],
+                 ", ".join(f"{k} {v:.2f}s" for k, v in self.phases.items() if k != "total"))
+
+startup = StartupLog()
+
+# ---- Storage: one writer thread + read-only WAL connection pool, awaitable from handlers ----
+# v2: dice value (1..64) instead of "seven|seven|seven" text, names in `users` only.
+# v1 `results`/`totals` are drained into these in batches by migrate_v2_batch().
+# v3: spin_totals.triples (jackpots of any kind) so /stats top lists come straight off an index.
+# v4: spin_marks, global_luck, combo_odds. A DB already at SCHEMA_VERSION skips all DDL on open.
+# v5: bucket indexes on the rollups, so pruning them is a range delete instead of a full scan.
+SCHEMA_VERSION = 5
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dice_counts(
+    chat_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    value INTEGER NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY(chat_id, user_id, value)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS spin_totals(
+    chat_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    spins INTEGER NOT NULL DEFAULT 0,
+    triples INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY(chat_id, user_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS users(
+    user_id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta(
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rollup_hourly(
+    chat_id INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,  -- unix time // 3600
+    user_id INTEGER NOT NULL,
+    value INTEGER NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY(chat_id, bucket, user_id, value)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rollup_daily(
+    chat_id INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,  -- unix time // 86400 (UTC days)
+    user_id INTEGER NOT NULL,
+    value INTEGER NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY(chat_id, bucket, user_id, value)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS global_luck(  -- /global, rebuilt by global_luck_job
+    rank INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    spins INTEGER NOT NULL,
+    triples INTEGER NOT NULL,
+    lower REAL NOT NULL,  -- 95% Wilson interval of the jackpot rate
+    upper REAL NOT NULL,
+    z REAL NOT NULL       -- jackpots vs the expected 4/64, in standard deviations
+);
+CREATE TABLE IF NOT EXISTS combo_odds(
+    value INTEGER PRIMARY KEY,
+    observed INTEGER NOT NULL,
+    expected REAL NOT NULL,
+    z REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS spin_marks(
+    chat_id INTEGER PRIMARY KEY,
+    message_id INTEGER NOT NULL  -- highest 🎰 message_id counted (see SpinDedupe)
+);
+"""
+LUCK_EXPR = "(triples * 1.0 / spins)"
+# Access paths for /stats (see sql_stats). Secondary indexes on WITHOUT ROWID tables carry
+# the primary key, so these cover user_id too.
+INDEXES = f"""
+CREATE INDEX IF NOT EXISTS dice_counts_top ON dice_counts(chat_id, value, count DESC);
+CREATE INDEX IF NOT EXISTS spin_totals_top ON spin_totals(chat_id, triples DESC) WHERE triples > 0;
+CREATE INDEX IF NOT EXISTS spin_totals_luck ON spin_totals(chat_id, {LUCK_EXPR} DESC) WHERE triples > 0;
+CREATE INDEX IF NOT EXISTS rollup_hourly_bucket ON rollup_hourly(bucket);
+CREATE INDEX IF NOT EXISTS rollup_daily_bucket ON rollup_daily(bucket);
+"""
+
+def upgrade_v3(c: sqlite3.Connection):
+    with c:
+        c.execute("ALTER TABLE spin_totals ADD COLUMN triples INTEGER NOT NULL DEFAULT 0")
+        c.execute(f"""
+        UPDATE spin_totals SET triples = (
+          SELECT COALESCE(SUM(d.count), 0) FROM dice_counts d
+          WHERE d.chat_id=spin_totals.chat_id AND d.user_id=spin_totals.user_id
+            AND d.value IN ({",".join(map(str, TRIPLES))}))
+        """)
+        c.execute("PRAGMA user_version=3")
+
+def _connect_rw(path:str):
+    """Open the DB (auto-creating its dir), falling back to /tmp -> (conn, path)."""
+    db_dir = os.path.dirname(path)
+    try:
         if db_dir:
             os.makedirs(db_dir, exist_ok=True)
+        return sqlite3.connect(path, check_same_thread=False), path
+    except (sqlite3.OperationalError, OSError) as e:
+        fallback = "/tmp/casino_stats.sqlite3"
+        log.warning("DB open failed for %s (%s). Falling back to %s", path, e, fallback)
+        os.makedirs("/tmp", exist_ok=True)
+        return sqlite3.connect(fallback, check_same_thread=False), fallback
+
+class Storage:
+    """Serializes all mutations on one writer thread; reads run on a pool of read-only
+    WAL connections so /stats never waits behind spin ingestion (or the event loop behind either).
+
+    Write/read callables take the connection as first argument. Reads run inside one
+    snapshot and also return the last committed flush_seq (see SpinBuffer).
+    """
+    def __init__(self, path:str, readers:int=4):
+        self.path = path
+        self.readers = max(1, readers)
+        self._queue = queue.Queue()
+        self._writer = None
+        self._pool = None
+        self._local = threading.local()
+        self._read_conns = []
+        self._read_conns_lock = threading.Lock()
+        self.flush_seq = 0
+        self.legacy = False  # v1 tables still hold rows not yet moved to v2
+        self.writes = 0      # write jobs run (each is one transaction)
+        self.marks = {}      # chat_id -> spin_marks.message_id as of open()
+        self.data_gen = 0    # meta.data_gen as of open() (see bump_data_gen)
+        self.reads_started = 0
+        self._active_reads = set()
+
+    def open(self) -> "Storage":
+        c, self.path = _connect_rw(self.path)
+        c.execute("PRAGMA journal_mode=WAL")
+        c.execute("PRAGMA synchronous=NORMAL")
+        version = c.execute("PRAGMA user_version").fetchone()[0]
+        if version != SCHEMA_VERSION:
+            c.executescript(SCHEMA)
+            if version == 2:
+                upgrade_v3(c)
+            c.executescript(INDEXES)
+            self.legacy = c.execute("""
+              SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name IN ('results','totals')
+            """).fetchone()[0] == 2
+            if not self.legacy:
+                c.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+        row = c.execute("SELECT value FROM meta WHERE key='flush_seq'").fetchone()
+        self.flush_seq = row[0] if row else 0
+        self.marks = dict(c.execute("SELECT chat_id, message_id FROM spin_marks"))
+        self.data_gen = _meta_get(c, "data_gen")
+        if self.data_gen is None:
+            with c:
+                self.data_gen = bump_data_gen(c)
+        self._writer = threading.Thread(target=self._write_loop, args=(c,), name="sqlite-writer", daemon=True)
+        self._writer.start()
+        self._pool = ThreadPoolExecutor(max_workers=self.readers, thread_name_prefix="sqlite-reader")
+        return self
+
+    def _write_loop(self, c: sqlite3.Connection):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            fn, args, fut = item
+            if not fut.set_running_or_notify_cancel():
+                continue
+            t0 = time.perf_counter()
+            try:
+                res = fn(c, *args)
+            except BaseException as e:
+                self.writes += 1
+                fut.set_exception(e)
+            else:
+                self.writes += 1
+                fut.set_result(res)
+            finally:
+                SQLITE_SECONDS.labels("write", getattr(fn, "__name__", "other")).observe(time.perf_counter() - t0)
+        c.close()
+
+    @property
+    def write_backlog(self) -> int:
+        return self._queue.qsize()
+
+    def submit_write(self, fn, *args) -> Future:
+        fut = Future()
+        self._queue.put((fn, args, fut))
+        return fut
+
+    async def write(self, fn, *args):
+        return await asyncio.wrap_future(self.submit_write(fn, *args))
+
+    def _read_conn(self) -> sqlite3.Connection:
+        c = getattr(self._local, "conn", None)
+        if c is None:
+            uri = pathlib.Path(self.path).absolute().as_uri() + "?mode=ro"
+            c = sqlite3.connect(uri, uri=True, isolation_level=None, check_same_thread=False)
+            self._local.conn = c
+            with self._read_conns_lock:
+                self._read_conns.append(c)
+        return c
+
+    def _read(self, fn, args):
+        c = self._read_conn()
+        t0 = time.perf_counter()
+        c.execute("BEGIN")
+        try:
+            row = c.execute("SELECT value FROM meta WHERE key='flush_seq'").fetchone()
+            return (row[0] if row else 0), fn(c, *args)
+        finally:
+            c.execute("COMMIT")
+            SQLITE_SECONDS.labels("read", getattr(fn, "__name__", "other")).observe(time.perf_counter() - t0)
+
+    async def read(self, fn, *args):
+        """-> (flush_seq visible to this snapshot, fn result)"""
+        token = self.reads_started
+        self.reads_started += 1
+        self._active_reads.add(token)
         try:
-            _conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-        except sqlite3.OperationalError as e:
-            fallback = "/tmp/casino_stats.sqlite3"
-            log.warning("DB open failed for %s (%s). Falling back to %s", DB_PATH, e, fallback)
-            os.makedirs("/tmp", exist_ok=True)
-            _conn = sqlite3.connect(fallback, check_same_thread=False)
-
-        _conn.execute("""
-        CREATE TABLE IF NOT EXISTS results(
-            chat_id INTEGER NOT NULL,
-            user_id INTEGER NOT NULL,
-            username TEXT,
-            combo TEXT NOT NULL,
-            count INTEGER NOT NULL DEFAULT 0,
-            PRIMARY KEY(chat_id, user_id, combo)
-        )""")
-        _conn.execute("""
-        CREATE TABLE IF NOT EXISTS totals(
-            chat_id INTEGER NOT NULL,
-            user_id INTEGER NOT NULL,
-            spins INTEGER NOT NULL DEFAULT 0,
-            PRIMARY KEY(chat_id, user_id)
-        )""")
-        _conn.commit()
-    return _conn
-
-def upsert_result(chat_id:int, user_id:int, username:str, combo:str):
-    c = get_conn()
+            return await asyncio.get_running_loop().run_in_executor(self._pool, self._read, fn, args)
+        finally:
+            self._active_reads.discard(token)
+
+    def oldest_read(self) -> int:
+        """reads_started as of the oldest read still running (== reads_started if none)."""
+        return min(self._active_reads, default=self.reads_started)
+
+    def close(self):
+        if self._writer is not None:
+            self._queue.put(None)
+            self._writer.join()
+            self._writer = None
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+        with self._read_conns_lock:
+            for c in self._read_conns:
+                c.close()
+            self._read_conns.clear()
+
+_storage = None
+_storage_lock = threading.Lock()
+_storage_opening = None  # Future of open_storage_soon()
+def get_storage() -> Storage:
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                _storage = Storage(DB_PATH, DB_READERS).open()
+    return _storage
+
+def open_storage_soon() -> Future:
+    """Restore (if configured) and open the DB on a thread -> Future of the Storage."""
+    global _storage_opening
+    if _storage_opening is None:
+        fut = _storage_opening = Future()
+
+        def run():
+            global counter_store
+            try:
+                if snapshots.directory and SNAPSHOT_RESTORE and _storage is None:
+                    with startup.phase("db_restore"):
+                        snapshots.restore(DB_PATH)
+                with startup.phase("db_open"):
+                    storage = get_storage()
+                if COUNTER_STORE and not storage.legacy:
+                    with startup.phase("counters_open"):
+                        counter_store = open_counter_store(storage)
+                fut.set_result(storage)
+            except BaseException as e:
+                fut.set_exception(e)
+
+        threading.Thread(target=run, name="db-open", daemon=True).start()
+    return _storage_opening
+
+def close_storage():
+    global _storage, _storage_opening, counter_store
+    _storage_opening = None
+    if counter_store is not None:
+        seq = None
+        if spin_buffer.settled and _storage is not None:
+            seq = _storage.submit_write(_meta_get, "flush_seq").result() or 0
+        counter_store.close(seq)
+        counter_store = None
+    if _storage is not None:
+        _storage.close()
+        _storage = None
+
+def upsert_spin_counts(c: sqlite3.Connection, counts, spins):
+    c.executemany("""
+    INSERT INTO dice_counts(chat_id,user_id,value,count) VALUES(?,?,?,?)
+    ON CONFLICT(chat_id,user_id,value) DO UPDATE SET count = count + excluded.count
+    """, counts)
+    c.executemany("""
+    INSERT INTO spin_totals(chat_id,user_id,spins,triples) VALUES(?, ?, ?, ?)
+    ON CONFLICT(chat_id,user_id) DO UPDATE SET
+       spins = spins + excluded.spins,
+       triples = triples + excluded.triples
+    """, spins)
+
+def write_spin_batch(c: sqlite3.Connection, counts, spins, names, events, seq:int, marks=()):
+    """Apply merged increments (and the batch's flush_seq) in one transaction.
+
+    counts: [(chat_id, user_id, value, n)], spins: [(chat_id, user_id, spins, triples)],
+    names: [(user_id, name)], events: [(ts, chat_id, user_id, value)],
+    marks: [(chat_id, highest message_id in the batch)]
+    """
     with c:
+        append_spin_events(c, events)
+        upsert_spin_counts(c, counts, spins)
+        c.executemany("""
+        INSERT INTO users(user_id,name) VALUES(?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET name = excluded.name WHERE name IS NOT excluded.name
+        """, names)
+        c.executemany("""
+        INSERT INTO spin_marks(chat_id,message_id) VALUES(?, ?)
+        ON CONFLICT(chat_id) DO UPDATE SET message_id = MAX(message_id, excluded.message_id)
+        """, marks)
         c.execute("""
-        INSERT INTO results(chat_id,user_id,username,combo,count)
-        VALUES(?,?,?,?,1)
-        ON CONFLICT(chat_id,user_id,combo) DO UPDATE SET
-           count = count + 1,
-           username = excluded.username
-        """,(chat_id,user_id,username,combo))
-        c.execute("""
-        INSERT INTO totals(chat_id,user_id,spins) VALUES(?, ?, 1)
-        ON CONFLICT(chat_id,user_id) DO UPDATE SET spins = spins + 1
-        """,(chat_id,user_id))
+        INSERT INTO meta(key,value) VALUES('flush_seq', ?)
+        ON CONFLICT(key) DO UPDATE SET value = excluded.value
+        """, (seq,))
 
-def fetch_user_stats(chat_id:int, user_id:int):
-    c = get_conn()
-    rows = c.execute("""
-      SELECT combo, count FROM results
-      WHERE chat_id=? AND user_id=?
-      ORDER BY count DESC
-    """,(chat_id,user_id)).fetchall()
-    t = c.execute("SELECT spins FROM totals WHERE chat_id=? AND user_id=?",(chat_id,user_id)).fetchone()
-    return rows, (t[0] if t else 0)
-
-def fetch_leaderboard(chat_id:int, combos:Tuple[str,...]):
-    c = get_conn()
-    q = ",".join("?"*len(combos))
-    return c.execute(f"""
-      SELECT username, combo, SUM(count) c
-      FROM results
-      WHERE chat_id=? AND combo IN ({q})
-      GROUP BY username, combo
-      ORDER BY combo, c DESC
-    """, (chat_id, *combos)).fetchall()
-
-def fetch_spins_by_username(chat_id:int):
-    """Map username -> total spins in chat (uses any stored username for user_id)."""
-    c = get_conn()
-    rows = c.execute("""
-      SELECT r.username, t.spins
-      FROM totals t
-      JOIN (
-        SELECT chat_id, user_id, MAX(username) AS username
-        FROM results
-        WHERE chat_id=?
-        GROUP BY chat_id, user_id
-      ) r ON r.chat_id=t.chat_id AND r.user_id=t.user_id
-      WHERE t.chat_id=?
-    """, (chat_id, chat_id)).fetchall()
-    return {u: s for (u, s) in rows if u is not None}
+# ---- Spin event log: one append-only table per UTC day + hourly/daily rollups ----
+ROLLUPS = {"rollup_hourly": 3600, "rollup_daily": 86400}
 
-# ---- Helpers ----
-def _compact_combo(key: str) -> str:
-    # "seven|seven|seven" -> "7️⃣7️⃣7️⃣"  (без пробелов)
-    return "".join(EMOJI[x] for x in key.split("|"))
+SPIN_LOG_DDL = """
+CREATE TABLE IF NOT EXISTS {table}(
+    ts INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    value INTEGER NOT NULL
+)"""
 
-# ---- Handlers ----
-async def on_dice(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    m = update.effective_message
-    d = getattr(m, "dice", None)
-    if not d or d.emoji != "🎰":
-        return
-    # ignore forwards
-    if any(getattr(m, a, None) for a in ("forward_origin","forward_from","forward_from_chat","forward_sender_name")) \
-       or getattr(m, "is_automatic_forward", False):
-        return
-    value = int(d.value)
-    combo_tuple = slot_value.get(value)
-    if not combo_tuple:
+def _log_partition(day:int) -> str:
+    return "spin_log_" + time.strftime("%Y%m%d", time.gmtime(day * 86400))
+
+def append_spin_events(c: sqlite3.Connection, events, log_from:int=0, hourly_from:int=0):
+    """Append events to their day partitions and fold them into the rollups (caller's transaction).
+    Events before `log_from` / `hourly_from` skip the raw log / hourly rollup (backfills)."""
+    if not events:
         return
-    combo_key = "|".join(combo_tuple)
-    user = update.effective_user
-    username = user.full_name or (user.username and f"@{user.username}") or str(user.id)
-    upsert_result(update.effective_chat.id, user.id, username, combo_key)
+    by_day = {}
+    for e in events:
+        if e[0] >= log_from:
+            by_day.setdefault(e[0] // 86400, []).append(e)
+    for day, rows in by_day.items():
+        table = _log_partition(day)
+        c.execute(SPIN_LOG_DDL.format(table=table))
+        c.executemany(f"INSERT INTO {table}(ts,chat_id,user_id,value) VALUES(?,?,?,?)", rows)
+    for table, width in ROLLUPS.items():
+        since = hourly_from if table == "rollup_hourly" else 0
+        buckets = {}
+        for ts, chat_id, uid, value in events:
+            if ts < since:
+                continue
+            key = (chat_id, ts // width, uid, value)
+            buckets[key] = buckets.get(key, 0) + 1
+        c.executemany(f"""
+        INSERT INTO {table}(chat_id,bucket,user_id,value,count) VALUES(?,?,?,?,?)
+        ON CONFLICT(chat_id,bucket,user_id,value) DO UPDATE SET count = count + excluded.count
+        """, [(*k, n) for k, n in buckets.items()])
+
+def prune_spin_log(c: sqlite3.Connection, now:float, log_days:int, hourly_days:int, daily_days:int):
+    """Drop raw partitions older than `log_days` and rollup rows past their retention (0 = keep)."""
+    today = int(now) // 86400
+    dropped = 0
+    with c:
+        if log_days > 0:
+            oldest = _log_partition(today - log_days + 1)
+            for (table,) in c.execute("""
+              SELECT name FROM sqlite_master WHERE type='table' AND name GLOB 'spin_log_[0-9]*'
+            """).fetchall():
+                if table < oldest:
+                    c.execute(f"DROP TABLE {table}")
+                    dropped += 1
+        if hourly_days > 0:
+            c.execute("DELETE FROM rollup_hourly WHERE bucket < ?", ((today - hourly_days + 1) * 24,))
+        if daily_days > 0:
+            c.execute("DELETE FROM rollup_daily WHERE bucket < ?", (today - daily_days + 1,))
+    return dropped
 
-    # if triple (jackpot) -> configurable delay + non-repeating random phrase
-    if combo_tuple[0] == combo_tuple[1] == combo_tuple[2]:
+async def spin_log_maintenance(interval:float=3600):
+    while True:
         try:
-            await asyncio.sleep(JACKPOT_DELAY)  # неблокирующая задержка
-            phrase = await get_next_jackpot_phrase()
-            await m.reply_text(phrase)  # reply to the jackpot message
+            dropped = await get_storage().write(prune_spin_log, time.time(), SPIN_LOG_RETENTION_DAYS,
+                                                ROLLUP_HOURLY_RETENTION_DAYS, ROLLUP_DAILY_RETENTION_DAYS)
+            if dropped:
+                log.info("Spin log: dropped %d old partitions", dropped)
         except Exception:
-            log.exception("Failed to send jackpot phrase")
-    else:
-        # near-jackpot: exactly two identical symbols (one short of a triple)
-        if len(set(combo_tuple)) == 2:
+            log.exception("Spin log pruning failed")
+        await asyncio.sleep(interval)
+
+# ---- Online snapshots (backup API in page steps, gzip'd, rotated) + quiet-time compaction ----
+class Snapshots:
+    """gzip'd copies of the stats DB in `directory`, newest `keep` per DB file.
+
+    take() runs on a worker thread: SQLite's backup API copies `step_pages` pages at a
+    time from a read-only connection that holds one read transaction throughout, so the
+    copy is a consistent snapshot that never restarts, and in WAL mode the writer thread
+    commits spins alongside it. The copy is then gzip'd and renamed into place.
+    """
+    SUFFIX = ".sqlite3.gz"
+
+    def __init__(self, directory:str, keep:int, step_pages:int, step_pause:float=0.001):
+        self.directory = directory
+        self.keep = max(1, keep)
+        self.step_pages = max(1, step_pages)
+        self.step_pause = step_pause
+        self.taken = 0
+        self.failed = 0
+        self.last_at = 0.0
+        self.last_seconds = 0.0
+
+    def files(self, db_path:str):
+        """-> this DB's snapshots, newest first."""
+        stem = pathlib.Path(db_path).stem
+        return sorted(pathlib.Path(self.directory).glob(f"{stem}-*{self.SUFFIX}"), reverse=True)
+
+    def take(self, db_path:str) -> str:
+        t0 = time.perf_counter()
+        os.makedirs(self.directory, exist_ok=True)
+        now = time.time()
+        stamp = time.strftime("%Y%m%dT%H%M%S", time.gmtime(now)) + f".{int(now * 1000) % 1000:03d}Z"
+        out = pathlib.Path(self.directory) / f"{pathlib.Path(db_path).stem}-{stamp}{self.SUFFIX}"
+        raw = out.with_name(out.name + ".raw")
+        try:
+            src = sqlite3.connect(pathlib.Path(db_path).absolute().as_uri() + "?mode=ro", uri=True,
+                                  isolation_level=None)
+            dst = sqlite3.connect(raw)
             try:
-                if random.randint(1, 9) == 1:
-                    # random delay between configured bounds
-                    await asyncio.sleep(random.uniform(NEAR_JACKPOT_DELAY_MIN, NEAR_JACKPOT_DELAY_MAX))
-                    await m.reply_text(random.choice(NEAR_JACKPOT_PHRASES))
-            except Exception:
-                log.exception("Failed to send near-jackpot phrase")
+                src.execute("BEGIN")
+                src.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchall()  # pin the snapshot
+                pause = self.step_pause
+                src.backup(dst, pages=self.step_pages, progress=lambda *_: time.sleep(pause) if pause else None)
+                src.execute("COMMIT")
+                dst.execute("PRAGMA journal_mode=DELETE")  # self-contained file, no -wal to carry
+            finally:
+                dst.close()
+                src.close()
+            with open(raw, "rb") as f, gzip.open(str(out) + ".tmp", "wb", compresslevel=6) as z:
+                shutil.copyfileobj(f, z, 1 << 20)
+            os.replace(str(out) + ".tmp", out)
+        except BaseException:
+            self.failed += 1
+            if os.path.exists(str(out) + ".tmp"):
+                os.remove(str(out) + ".tmp")
+            raise
+        finally:
+            if raw.exists():
+                raw.unlink()
+        for old in self.files(db_path)[self.keep:]:
+            old.unlink()
+        self.taken += 1
+        self.last_at = time.time()
+        self.last_seconds = time.perf_counter() - t0
+        return str(out)
 
-    # no reply for other combinations
+    def restore(self, db_path:str):
+        """If db_path does not exist, unpack the newest snapshot that passes quick_check
+        into it -> that snapshot's path (None if nothing was restored)."""
+        if os.path.exists(db_path):
+            return None
+        tmp = db_path + ".restore"
+        for snap in self.files(db_path):
+            try:
+                with gzip.open(snap, "rb") as z, open(tmp, "wb") as f:
+                    shutil.copyfileobj(z, f, 1 << 20)
+                c = sqlite3.connect(tmp)
+                try:
+                    ok = c.execute("PRAGMA quick_check").fetchone()[0] == "ok"
+                finally:
+                    c.close()
+            except (OSError, EOFError, sqlite3.DatabaseError):
+                ok = False
+            if ok:
+                for p in (db_path + "-wal", db_path + "-shm"):
+                    if os.path.exists(p):
+                        os.remove(p)
+                os.replace(tmp, db_path)
+                log.warning("Restored %s from snapshot %s", db_path, snap)
+                return str(snap)
+            log.error("Snapshot %s is damaged, trying an older one", snap)
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return None
 
-async def cmd_mystats(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat_id = update.effective_chat.id
-    user = update.effective_user
-    rows, total = fetch_user_stats(chat_id, user.id)
-    if not rows:
-        await update.message.reply_text("No data yet. Send 🎰 and come back.")
-        return
+snapshots = Snapshots(SNAPSHOT_DIR, SNAPSHOT_KEEP, SNAPSHOT_STEP_PAGES)
 
-    name = user.full_name or (user.username and f"@{user.username}") or str(user.id)
-    lines = []
-    lines.append(f"<b>Top combos</b> — {name}:")
-    for combo, cnt in rows[:15]:
-        compact = _compact_combo(combo)
-        lines.append(f"{compact} — {cnt}")
-    lines.append("")
-    lines.append(f"<b>Total spins</b>: {total}")
-    await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+def checkpoint_db(c: sqlite3.Connection):
+    """-> (busy, wal frames, frames checkpointed); TRUNCATE also shrinks the -wal file back to 0."""
+    return c.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
 
-async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat_id = update.effective_chat.id
-    triples = ("seven|seven|seven","grape|grape|grape","lemon|lemon|lemon","bar|bar|bar")
-    board = fetch_leaderboard(chat_id, triples)
-    if not board:
-        await update.message.reply_text("No data in this chat yet. Spin 🎰!")
+def vacuum_db(c: sqlite3.Connection, min_free_ratio:float) -> bool:
+    """VACUUM if at least `min_free_ratio` of the pages are free (dropped spin_log partitions)."""
+    pages = c.execute("PRAGMA page_count").fetchone()[0]
+    free = c.execute("PRAGMA freelist_count").fetchone()[0]
+    if not pages or free / pages < min_free_ratio:
+        return False
+    c.execute("VACUUM")
+    checkpoint_db(c)
+    return True
+
+async def db_maintenance(snapshots: "Snapshots", snapshot_interval:float, compact_interval:float,
+                         quiet_spins:int, tick:float=60):
+    """Snapshots on schedule (due from the newest file, so restarts do not reset it); WAL
+    checkpoints and VACUUM only in a quiet minute: few spins, no shedding, writer idle."""
+    loop = asyncio.get_running_loop()
+    last_checkpoint = last_vacuum = loop.time()
+    spins = spin_buffer.spins
+    while True:
+        await asyncio.sleep(tick)
+        storage = get_storage()
+        try:
+            if snapshots.directory:
+                newest = snapshots.files(storage.path)[:1]
+                if not newest or time.time() - newest[0].stat().st_mtime >= snapshot_interval:
+                    path = await asyncio.to_thread(snapshots.take, storage.path)
+                    log.info("Snapshot %s (%.1fs)", path, snapshots.last_seconds)
+            quiet = spin_buffer.spins - spins <= quiet_spins * tick / 60 \
+                and load_shedder.level == SHED_NORMAL and not storage.write_backlog
+            spins = spin_buffer.spins
+            now = loop.time()
+            if quiet and now - last_vacuum >= compact_interval:
+                last_vacuum = last_checkpoint = now
+                if await storage.write(vacuum_db, COMPACT_FREE_RATIO):
+                    log.info("VACUUM done")
+            elif quiet and now - last_checkpoint >= CHECKPOINT_INTERVAL:
+                last_checkpoint = now
+                await storage.write(checkpoint_db)
+        except Exception:
+            log.exception("DB maintenance failed")
+
+# ---- v1 -> v2 migration: moves rows in small transactions so spin flushes interleave ----
+def migrate_v2_batch(c: sqlite3.Connection, limit:int) -> int:
+    """Move up to `limit` v1 rows into the v2 tables -> rows moved (0 once drained).
+
+    Moved rows are deleted in the same transaction, so an interrupted migration just
+    resumes from whatever is left on the next start.
+    """
+    with c:
+        rows = c.execute("""
+          SELECT rowid, chat_id, user_id, username, combo, count FROM results ORDER BY rowid LIMIT ?
+        """, (limit,)).fetchall()
+        if rows:
+            counts = [(chat_id, uid, COMBO_VALUE[combo], n)
+                      for _, chat_id, uid, _, combo, n in rows if combo in COMBO_VALUE]
+            if len(counts) != len(rows):
+                log.warning("Migration: skipped %d rows with unknown combos", len(rows) - len(counts))
+            c.executemany("""
+            INSERT INTO dice_counts(chat_id,user_id,value,count) VALUES(?,?,?,?)
+            ON CONFLICT(chat_id,user_id,value) DO UPDATE SET count = count + excluded.count
+            """, counts)
+            triples = {}
+            for chat_id, uid, value, n in counts:
+                if value in TRIPLE_SET:
+                    triples[(chat_id, uid)] = triples.get((chat_id, uid), 0) + n
+            c.executemany("""
+            INSERT INTO spin_totals(chat_id,user_id,triples) VALUES(?, ?, ?)
+            ON CONFLICT(chat_id,user_id) DO UPDATE SET triples = triples + excluded.triples
+            """, [(chat_id, uid, n) for (chat_id, uid), n in triples.items()])
+            names = {uid: name for _, _, uid, name, _, _ in rows if name}
+            c.executemany("INSERT INTO users(user_id,name) VALUES(?, ?) ON CONFLICT(user_id) DO NOTHING",
+                          names.items())
+            c.execute("DELETE FROM results WHERE rowid <= ?", (rows[-1][0],))
+            return len(rows)
+        rows = c.execute("SELECT rowid, chat_id, user_id, spins FROM totals ORDER BY rowid LIMIT ?",
+                         (limit,)).fetchall()
+        if rows:
+            c.executemany("""
+            INSERT INTO spin_totals(chat_id,user_id,spins) VALUES(?, ?, ?)
+            ON CONFLICT(chat_id,user_id) DO UPDATE SET spins = spins + excluded.spins
+            """, [r[1:] for r in rows])
+            c.execute("DELETE FROM totals WHERE rowid <= ?", (rows[-1][0],))
+        return len(rows)
+
+def finish_v2(c: sqlite3.Connection):
+    with c:
+        bump_data_gen(c)
+        c.execute("DROP TABLE IF EXISTS results")
+        c.execute("DROP TABLE IF EXISTS totals")
+        c.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+
+async def migrate_v2(storage: Storage, batch:int):
+    if not storage.legacy:
         return
+    log.info("Migrating stats DB to schema v%d in batches of %d", SCHEMA_VERSION, batch)
+    moved = 0
+    while True:
+        n = await storage.write(migrate_v2_batch, batch)
+        if not n:
+            break
+        moved += n
+        await asyncio.sleep(0)
+    storage.legacy = False  # readers stop looking at v1 before it is dropped
+    await storage.write(finish_v2)
+    log.info("Migration done: %d rows moved", moved)
+
+# ---- Write-behind spin buffer (merged in memory, flushed as one transaction) ----
+def _new_chat_delta():
+    return {"counts": {}, "spins": {}, "names": {}, "events": [], "mark": 0}
+
+class SpinBuffer:
+    """Merges spin increments per (chat_id, user_id, value) until the next flush.
+
+    Flushes every SPIN_FLUSH_INTERVAL seconds, when SPIN_FLUSH_MAX distinct keys are
+    pending, and on shutdown. Each flush is a numbered batch handed to the writer thread;
+    until it commits it stays "in flight", and readers merge every batch newer than the
+    flush_seq their snapshot saw, so /mystats and /stats always read their writes.
+    """
+    def __init__(self, interval:float, max_pending:int):
+        self.interval = interval
+        self.max_pending = max_pending
+        self.stretch = 1  # > 1 while shedding load: fewer, bigger commits
+        # chat_id -> {"counts": {(user_id, value): n}, "spins": {user_id: n}, "names": {user_id: name},
+        #             "events": [(ts, user_id, value)], "mark": highest message_id}
+        self._chats = {}
+        self._known_names = {}  # user_id -> name as last written to `users`
+        self._size = 0
+        self._seq = 0
+        self._inflight = {}  # seq -> (chats, future)
+        # seq -> (chats, storage.reads_started at commit): a read begun before the commit may
+        # hold a snapshot without it, so the batch stays visible until those reads are done
+        self._retired = {}
+        self._loop = None
+        self._task = None
+        self.spins = 0
+        self.commits = 0
+        self.flushed_rows = 0
+
+    @property
+    def pending(self) -> int:
+        return self._size
+
+    @property
+    def settled(self) -> bool:
+        """Every spin added so far is committed."""
+        return not self._size and not self._inflight
+
+    def add(self, chat_id:int, user_id:int, username:str, value:int, ts:int=None, message_id:int=None):
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = _new_chat_delta()
+        if message_id is not None and message_id > chat["mark"]:
+            chat["mark"] = message_id
+        counts = chat["counts"]
+        key = (user_id, value)
+        if key not in counts:
+            self._size += 1
+            counts[key] = 1
+        else:
+            counts[key] += 1
+        chat["spins"][user_id] = chat["spins"].get(user_id, 0) + 1
+        chat["names"][user_id] = username
+        chat["events"].append((int(time.time()) if ts is None else ts, user_id, value))
+        self.spins += 1
+        if self._size >= self.max_pending * self.stretch:
+            self.flush()
+        else:
+            self._ensure_timer()
+
+    def _deltas(self, chat_id:int, seen_seq:int):
+        for batches in (self._retired, self._inflight):
+            for seq, (chats, _) in batches.items():
+                if seq > seen_seq and chat_id in chats:
+                    yield chats[chat_id]
+        if chat_id in self._chats:
+            yield self._chats[chat_id]
+
+    def pending_user(self, chat_id:int, user_id:int, seen_seq:int=0):
+        """-> ({value: n}, spins) not visible in a snapshot that saw `seen_seq`."""
+        values, spins = {}, 0
+        for chat in self._deltas(chat_id, seen_seq):
+            for (uid, value), n in chat["counts"].items():
+                if uid == user_id:
+                    values[value] = values.get(value, 0) + n
+            spins += chat["spins"].get(user_id, 0)
+        return values, spins
+
+    def pending_chat(self, chat_id:int, seen_seq:int=0):
+        """-> ([(user_id, username, value, n)], {user_id: spins}) not visible in that snapshot."""
+        rows, spins = [], {}
+        for chat in self._deltas(chat_id, seen_seq):
+            names = chat["names"]
+            rows.extend((uid, names[uid], value, n) for (uid, value), n in chat["counts"].items())
+            for uid, n in chat["spins"].items():
+                spins[uid] = spins.get(uid, 0) + n
+        return rows, spins
+
+    def pending_events(self, chat_id:int, since:int, seen_seq:int=0):
+        """-> ([(user_id, username, value, n)], {user_id: spins}) of unwritten spins at ts >= since."""
+        counts, spins = {}, {}
+        names = {}
+        for chat in self._deltas(chat_id, seen_seq):
+            for ts, uid, value in chat["events"]:
+                if ts >= since:
+                    counts[(uid, value)] = counts.get((uid, value), 0) + 1
+                    spins[uid] = spins.get(uid, 0) + 1
+                    names[uid] = chat["names"][uid]
+        return [(uid, names[uid], value, n) for (uid, value), n in counts.items()], spins
+
+    def rows(self, chats):
+        """-> (counts, spins, names, events) rows for write_spin_batch; names only where they changed."""
+        counts, spins, names, events = [], [], {}, []
+        known = self._known_names
+        if len(known) > KNOWN_NAMES_MAX:
+            known.clear()
+        for chat_id, chat in chats.items():
+            triples = {}
+            for (uid, value), n in chat["counts"].items():
+                counts.append((chat_id, uid, value, n))
+                if value in TRIPLE_SET:
+                    triples[uid] = triples.get(uid, 0) + n
+            spins.extend((chat_id, uid, n, triples.get(uid, 0)) for uid, n in chat["spins"].items())
+            for uid, name in chat["names"].items():
+                if known.get(uid) != name:
+                    names[uid] = known[uid] = name
+            events.extend((ts, chat_id, uid, value) for ts, uid, value in chat["events"])
+        return counts, spins, list(names.items()), events
+
+    def flush(self):
+        """Hand everything pending to the writer thread -> Future (None if nothing pending)."""
+        if not self._chats:
+            return None
+        storage = get_storage()
+        self._seq = max(self._seq, storage.flush_seq) + 1
+        seq, chats = self._seq, self._chats
+        self._chats, self._size = {}, 0
+        counts, spins, names, events = self.rows(chats)
+        marks = [(chat_id, chat["mark"]) for chat_id, chat in chats.items() if chat["mark"]]
+        fut = storage.submit_write(write_spin_batch, counts, spins, names, events, seq, marks)
+        self._inflight[seq] = (chats, fut)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            fut.exception()  # no loop (scripts/tests): wait for the commit right here
+            self._done(storage, seq, fut)
+        else:
+            fut.add_done_callback(lambda f: loop.call_soon_threadsafe(self._done, storage, seq, f))
+        return fut
+
+    def _done(self, storage: Storage, seq:int, fut: Future):
+        chats, _ = self._inflight.pop(seq)
+        oldest = storage.oldest_read()
+        for s in [s for s, (_, started) in self._retired.items() if oldest >= started]:
+            del self._retired[s]
+        if fut.exception() is not None:
+            log.error("Spin flush failed, keeping batch for retry", exc_info=fut.exception())
+            self._merge_back(chats)
+            return
+        if oldest < storage.reads_started:
+            self._retired[seq] = (chats, storage.reads_started)
+        self.commits += 1
+        self.flushed_rows += sum(len(c["counts"]) for c in chats.values())
+
+    def _merge_back(self, chats):
+        for chat_id, delta in chats.items():
+            chat = self._chats.setdefault(chat_id, _new_chat_delta())
+            for key, n in delta["counts"].items():
+                if key not in chat["counts"]:
+                    self._size += 1
+                chat["counts"][key] = chat["counts"].get(key, 0) + n
+            for uid, n in delta["spins"].items():
+                chat["spins"][uid] = chat["spins"].get(uid, 0) + n
+            for uid, name in delta["names"].items():
+                chat["names"].setdefault(uid, name)
+                self._known_names.pop(uid, None)
+            chat["events"][:0] = delta["events"]
+            chat["mark"] = max(chat["mark"], delta["mark"])
+
+    def _ensure_timer(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if self._loop is not loop or self._task is None or self._task.done():
+            self._loop = loop
+            self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval * self.stretch)
+            self.flush()
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.flush()
+        futs = [asyncio.wrap_future(f) for _, f in self._inflight.values()]
+        if futs:
+            await asyncio.gather(*futs, return_exceptions=True)
+            await asyncio.sleep(0)  # let the _done callbacks run
+
+spin_buffer = SpinBuffer(SPIN_FLUSH_INTERVAL, SPIN_FLUSH_MAX)
+
+# ---- Optional memory-mapped counters for /mystats (COUNTER_STORE=1) ----
+class CounterStore:
+    """The 64 dice-value counters and the spin total of every (chat_id, user_id), in
+    fixed-width slots of a memory-mapped file updated in place: add() and get() touch one
+    slot and run no SQL.
+
+    SQLite stays the source of truth. open() only trusts a file closed cleanly at the DB's
+    current flush_seq and data_gen (bump_data_gen: imports, the v1 migration); anything else,
+    a crash included, means rebuild() from dice_counts/spin_totals. Layout after a 64-byte
+    header: keys (chat_id, user_id as int64; user_id 0 = free slot, linear probing from
+    _mix(), so MAGIC changes with the layout), spins (uint64) and counts (64 x uint32, value
+    v at v-1) per slot. When LOAD of the slots are taken the file is copied into one twice
+    the size on a thread; until it is swapped in, add() keeps deltas in `_journal` (merged
+    by get()) and the old slots are only read.
+    """
+    MAGIC = b"LUDCNT02"
+    HEADER = struct.Struct("<8sQQqqQ")  # magic, capacity, used, data_gen, flush_seq, clean
+    HEADER_SIZE = 64
+    VALUES = 64
+    LOAD = 0.7
+
+    def __init__(self, path:str, capacity:int=1 << 16):
+        self.path = path
+        self.min_capacity = max(8, 1 << (max(capacity, 1) - 1).bit_length())
+        self.capacity = 0
+        self.used = 0
+        self.data_gen = 0
+        self.grown = 0
+        self._mm = self._views = None
+        self._journal = None  # {(chat_id, user_id): {value: n}} while growing
+        self._growing = None  # Future of the copy thread
+
+    @classmethod
+    def _size(cls, capacity:int) -> int:
+        return cls.HEADER_SIZE + capacity * (16 + 8 + 4 * cls.VALUES)
+
+    def _map(self):
+        with open(self.path, "r+b") as f:
+            mm = mmap.mmap(f.fileno(), 0)
+        try:
+            magic, cap, used, gen = self.HEADER.unpack_from(mm, 0)[:4]
+        except struct.error:
+            magic = cap = None
+        if magic != self.MAGIC or not cap or cap & (cap - 1) or len(mm) != self._size(cap):
+            mm.close()
+            raise ValueError(f"{self.path} is not a counter file")
+        view = memoryview(mm)
+        spins_at = self.HEADER_SIZE + 16 * cap
+        counts_at = spins_at + 8 * cap
+        self._views = (view[self.HEADER_SIZE:spins_at].cast("q"), view[spins_at:counts_at].cast("Q"),
+                       view[counts_at:].cast("I"), view)
+        self._keys, self._spins, self._counts = self._views[:3]
+        self._mm, self.capacity, self.used, self.data_gen = mm, cap, used, gen
+
+    def _header(self, flush_seq:int, clean:bool):
+        self.HEADER.pack_into(self._mm, 0, self.MAGIC, self.capacity, self.used, self.data_gen, flush_seq, int(clean))
+        self._mm.flush(0, self.HEADER_SIZE)
+
+    def _create(self, capacity:int, data_gen:int):
+        with open(self.path, "wb") as f:
+            f.write(self.HEADER.pack(self.MAGIC, capacity, 0, data_gen, 0, 0))
+            f.truncate(self._size(capacity))
+        self._map()
+
+    def open(self, data_gen:int, flush_seq:int) -> bool:
+        """Map the file -> False (and left closed: call rebuild()) unless it was closed
+        cleanly at exactly this data_gen and flush_seq."""
+        try:
+            self._map()
+        except (OSError, ValueError):
+            return False
+        _, _, _, gen, seq, clean = self.HEADER.unpack_from(self._mm, 0)
+        if not (clean and gen == data_gen and seq == flush_seq):
+            self.close()
+            return False
+        self._header(0, clean=False)  # on disk before the first in-place update
+        return True
+
+    def rebuild(self, c: sqlite3.Connection, data_gen:int):
+        """Rewrite the file from the counter tables. Run it on the writer thread (or with
+        the bot stopped) so no spin commits while the tables are read."""
+        self.close()
+        keys = c.execute("SELECT COUNT(*) FROM spin_totals").fetchone()[0]
+        capacity = self.min_capacity
+        while capacity * self.LOAD < keys + 1:
+            capacity *= 2
+        new = CounterStore(self.path + ".tmp")
+        new._create(capacity, data_gen)
+        try:
+            cur = c.execute("SELECT chat_id, user_id, spins FROM spin_totals")
+            for rows in iter(lambda: cur.fetchmany(10_000), []):
+                for chat_id, user_id, spins in rows:
+                    new._spins[new._slot(chat_id, user_id)] = spins
+            cur = c.execute("SELECT chat_id, user_id, value, count FROM dice_counts")
+            for rows in iter(lambda: cur.fetchmany(10_000), []):
+                for chat_id, user_id, value, n in rows:
+                    if 1 <= value <= self.VALUES:
+                        new._counts[new._slot(chat_id, user_id) * self.VALUES + value - 1] = n
+        finally:
+            new.close()
+        os.replace(new.path, self.path)
+        self._map()
+        self._header(0, clean=False)
+
+    def close(self, flush_seq:int=None):
+        """Unmap; with flush_seq (every spin added is committed at it) mark the file clean."""
+        while self._growing is not None:
+            self._growing.exception()  # wait for the copy, then swap it in here
+            self._grown(self._growing)
+        if self._journal:  # the copy failed: these deltas never reached the file
+            flush_seq = None
+        self._journal = None
+        if self._mm is None:
+            return
+        self._mm.flush()
+        self._header(flush_seq or 0, clean=flush_seq is not None)
+        for view in self._views:
+            view.release()
+        self._mm.close()
+        self._mm = self._views = self._keys = self._spins = self._counts = None
+
+    @staticmethod
+    def _mix(chat_id:int, user_id:int) -> int:
+        """splitmix64 of the key: slots must not depend on the Python build (hash() does)."""
+        x = (chat_id * 0x9E3779B97F4A7C15 + user_id) & 0xFFFFFFFFFFFFFFFF
+        x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+        x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+        return x ^ (x >> 31)
+
+    def _slot(self, chat_id:int, user_id:int, insert:bool=True) -> int:
+        """Slot index of the key (claimed if new and insert) -> -1 if absent, or if new while
+        the file is growing on a thread."""
+        mask = self.capacity - 1
+        keys = self._keys
+        i = self._mix(chat_id, user_id) & mask
+        while True:
+            uid = keys[2 * i + 1]
+            if uid == user_id and keys[2 * i] == chat_id:
+                return i
+            if not uid:
+                if not insert:
+                    return -1
+                if self.used + 1 > self.capacity * self.LOAD:
+                    return self._slot(chat_id, user_id) if self._grow() else -1
+                keys[2 * i], keys[2 * i + 1] = chat_id, user_id
+                self.used += 1
+                return i
+            i = (i + 1) & mask
+
+    def _grow(self) -> bool:
+        """Double the file -> True if done already; False if copying on a thread (called
+        from the event loop: add() must not stall it for a rewrite of the whole file)."""
+        capacity = self.capacity * 2
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:  # scripts/tests, the writer thread
+            self._copy(capacity)
+            self._swap()
+            return True
+        if self._journal is None:
+            self._journal = {}
+        fut = self._growing = Future()
+
+        def run():
+            try:
+                fut.set_result(self._copy(capacity))
+            except BaseException as e:
+                fut.set_exception(e)
+
+        def done(f):
+            try:
+                loop.call_soon_threadsafe(self._grown, f)
+            except RuntimeError:  # loop closed: close() swapped it in
+                pass
+
+        fut.add_done_callback(done)
+        threading.Thread(target=run, name="counters-grow", daemon=True).start()
+        return False
+
+    def _copy(self, capacity:int):
+        """Slots into path.tmp at `capacity`. Only reads this file: adds go to the journal."""
+        new = CounterStore(self.path + ".tmp")
+        new._create(capacity, self.data_gen)
+        v = self.VALUES
+        try:
+            keys = self._keys
+            for i in range(self.capacity):
+                if keys[2 * i + 1]:
+                    j = new._slot(keys[2 * i], keys[2 * i + 1])
+                    new._spins[j] = self._spins[i]
+                    new._counts[j * v:(j + 1) * v] = self._counts[i * v:(i + 1) * v]
+        finally:
+            new.close()
+
+    def _swap(self):
+        journal = self._journal
+        self._journal = None  # so close() doesn't wait on or drop it
+        self.close()
+        os.replace(self.path + ".tmp", self.path)
+        self._map()
+        self._header(0, clean=False)
+        self.grown += 1
+        log.info("Counter file %s grown to %d slots (%d used)", self.path, self.capacity, self.used)
+        for (chat_id, user_id), counts in (journal or {}).items():
+            for value, n in counts.items():
+                self.add(chat_id, user_id, value, n)
+
+    def _grown(self, fut: Future):
+        if fut is not self._growing:  # close() got here first
+            return
+        self._growing = None
+        if fut.exception() is not None:
+            log.error("Growing counter file %s failed; retried on the next spin", self.path, exc_info=fut.exception())
+            return
+        self._swap()
+
+    def add(self, chat_id:int, user_id:int, value:int, n:int=1):
+        if self._journal is None:
+            i = self._slot(chat_id, user_id)
+            if i >= 0:
+                self._spins[i] += n
+                self._counts[i * self.VALUES + value - 1] += n
+                return
+        counts = self._journal.setdefault((chat_id, user_id), {})
+        counts[value] = counts.get(value, 0) + n
+        if self._growing is None:  # the last copy failed
+            self._grow()
+
+    def get(self, chat_id:int, user_id:int):
+        """-> ([(value, count)] most frequent first, spins), as sql_user_stats."""
+        i = self._slot(chat_id, user_id, insert=False)
+        extra = self._journal.get((chat_id, user_id)) if self._journal else None
+        if i < 0 and not extra:
+            return [], 0
+        counts = self._counts[i * self.VALUES:(i + 1) * self.VALUES].tolist() if i >= 0 else [0] * self.VALUES
+        spins = self._spins[i] if i >= 0 else 0
+        for value, n in (extra or {}).items():
+            counts[value - 1] += n
+            spins += n
+        rows = sorted(((v, n) for v, n in enumerate(counts, 1) if n), key=lambda r: r[1], reverse=True)
+        return rows, spins
+
+counter_store = None  # CounterStore while COUNTER_STORE is on and the DB is open (and not mid-migration)
+
+def counters_path(db_path:str) -> str:
+    return str(pathlib.Path(db_path).with_suffix(".counters"))
+
+def open_counter_store(storage: Storage) -> CounterStore:
+    store = CounterStore(counters_path(storage.path), COUNTER_STORE_SLOTS)
+    if not store.open(storage.data_gen, storage.flush_seq):
+        log.info("Rebuilding %s from the DB", store.path)
+        storage.submit_write(store.rebuild, storage.data_gen).result()
+    return store
+
+# ---- Redelivery dedupe (webhook retries, pending updates replayed after a restart) ----
+class SpinDedupe:
+    """Tells whether a 🎰 message was counted already.
+
+    Within a run an LRU of the last `max_recent` (chat_id, message_id) keys catches retries,
+    whatever order they arrive in. Across restarts the LRU starts empty; instead every flush
+    stores the highest counted message_id per chat in `spin_marks`, in the same transaction
+    as the counts, so ids at or below the mark loaded at startup were counted exactly when
+    their batch committed. Memory: max_recent keys plus one int per chat.
+    """
+    def __init__(self, max_recent:int):
+        self.max_recent = max_recent
+        self._recent = OrderedDict()
+        self.duplicates = 0
+
+    def seen(self, chat_id:int, message_id:int) -> bool:
+        """Record the message -> True if it is a duplicate."""
+        key = (chat_id, message_id)
+        if key in self._recent or message_id <= get_storage().marks.get(chat_id, 0):
+            self.duplicates += 1
+            return True
+        self._recent[key] = None
+        if len(self._recent) > self.max_recent:
+            self._recent.popitem(last=False)
+        return False
+
+spin_dedupe = SpinDedupe(DEDUPE_RECENT)
+
+def upsert_result(chat_id:int, user_id:int, username:str, value:int, ts:int=None, message_id:int=None) -> bool:
+    """Buffer one spin -> False (nothing counted) if message_id was counted already."""
+    if message_id is not None and spin_dedupe.seen(chat_id, message_id):
+        return False
+    spin_buffer.add(chat_id, user_id, username, value, ts, message_id)
+    if counter_store is not None:
+        counter_store.add(chat_id, user_id, value)
+    return True
+
+# ---- Queries (run on the reader pool; pending deltas merged on the loop) ----
+# While a v1 -> v2 migration is running (legacy=True) rows still in `results`/`totals` are added in.
+def _legacy(c: sqlite3.Connection, sql:str, params):
+    try:
+        return c.execute(sql, params).fetchall()
+    except sqlite3.OperationalError:  # dropped by the migration after we looked
+        return []
+
+def sql_user_stats(c: sqlite3.Connection, chat_id:int, user_id:int, legacy:bool=False):
+    rows = c.execute("""
+      SELECT value, count FROM dice_counts
+      WHERE chat_id=? AND user_id=?
+      ORDER BY count DESC
+    """,(chat_id,user_id)).fetchall()
+    t = c.execute("SELECT spins FROM spin_totals WHERE chat_id=? AND user_id=?",(chat_id,user_id)).fetchone()
+    spins = t[0] if t else 0
+    if legacy:
+        old = _legacy(c, "SELECT combo, count FROM results WHERE chat_id=? AND user_id=?", (chat_id, user_id))
+        if old:
+            merged = dict(rows)
+            for combo, n in old:
+                v = COMBO_VALUE.get(combo)
+                if v:
+                    merged[v] = merged.get(v, 0) + n
+            rows = sorted(merged.items(), key=lambda kv: kv[1], reverse=True)
+        spins += sum(n for (n,) in _legacy(c, "SELECT spins FROM totals WHERE chat_id=? AND user_id=?",
+                                           (chat_id, user_id)))
+    return rows, spins
+
+def sql_chat_board(c: sqlite3.Connection, chat_id:int, legacy:bool=False):
+    """Every jackpot row and spin total of the chat (used while v1 rows are still being migrated)."""
+    q = ",".join("?"*len(TRIPLES))
+    triples = c.execute(f"""
+      SELECT d.user_id, u.name, d.value, d.count
+      FROM dice_counts d LEFT JOIN users u ON u.user_id=d.user_id
+      WHERE d.chat_id=? AND d.value IN ({q})
+    """, (chat_id, *TRIPLES)).fetchall()
+    spins = c.execute("SELECT user_id, spins FROM spin_totals WHERE chat_id=?", (chat_id,)).fetchall()
+    if legacy:
+        triples += [(uid, name, COMBO_VALUE[combo], n) for uid, name, combo, n in _legacy(c, f"""
+          SELECT user_id, username, combo, count FROM results WHERE chat_id=? AND combo IN ({q})
+        """, (chat_id, *(COMBO_KEY[v] for v in TRIPLES)))]
+        spins += _legacy(c, "SELECT user_id, spins FROM totals WHERE chat_id=?", (chat_id,))
+    return triples, spins
+
+def sql_stats(c: sqlite3.Connection, chat_id:int, k_combo:int, k_users:int, k_luck:int, uids=()):
+    """Top rows for each /stats section, straight off the indexes, plus the exact rows of
+    `uids` (users with spins still in the buffer, whose rank may change once merged).
+
+    -> (total, [(value, user_id, count)], [(user_id, triples, spins)], {user_id: name})
+    where the totals list holds the top by triples, the top by luck and all of `uids`.
+    """
+    q = ",".join("?"*len(TRIPLES))
+    combos = c.execute(f"""
+      SELECT value, user_id, count FROM (
+        SELECT value, user_id, count,
+               ROW_NUMBER() OVER (PARTITION BY value ORDER BY count DESC) AS rn
+        FROM dice_counts
+        WHERE chat_id=? AND value IN ({q})
+      ) WHERE rn <= ?
+    """, (chat_id, *TRIPLES, k_combo)).fetchall()
+    totals = c.execute("""
+      SELECT user_id, triples, spins FROM spin_totals
+      WHERE chat_id=? AND triples > 0
+      ORDER BY triples DESC LIMIT ?
+    """, (chat_id, k_users)).fetchall()
+    totals += c.execute(f"""
+      SELECT user_id, triples, spins FROM spin_totals
+      WHERE chat_id=? AND triples > 0
+      ORDER BY {LUCK_EXPR} DESC LIMIT ?
+    """, (chat_id, k_luck)).fetchall()
+    total = c.execute("""
+      SELECT COALESCE(SUM(triples), 0) FROM spin_totals WHERE chat_id=? AND triples > 0
+    """, (chat_id,)).fetchone()[0]
+    if uids:
+        u = ",".join("?"*len(uids))
+        combos += c.execute(f"""
+          SELECT value, user_id, count FROM dice_counts
+          WHERE chat_id=? AND user_id IN ({u}) AND value IN ({q})
+        """, (chat_id, *uids, *TRIPLES)).fetchall()
+        totals += c.execute(f"""
+          SELECT user_id, triples, spins FROM spin_totals WHERE chat_id=? AND user_id IN ({u})
+        """, (chat_id, *uids)).fetchall()
+    ids = {r[1] for r in combos} | {r[0] for r in totals}
+    names = {}
+    if ids:
+        names = dict(c.execute(f"SELECT user_id, name FROM users WHERE user_id IN ({','.join('?'*len(ids))})",
+                               tuple(ids)).fetchall())
+    return total, combos, totals, names
+
+async def fetch_user_stats(chat_id:int, user_id:int):
+    if counter_store is not None:
+        return counter_store.get(chat_id, user_id)  # buffered spins included
+    storage = get_storage()
+    seq, (rows, total) = await storage.read(sql_user_stats, chat_id, user_id, storage.legacy)
+    pending, pending_spins = spin_buffer.pending_user(chat_id, user_id, seq)
+    if pending:
+        merged = dict(rows)
+        for value, n in pending.items():
+            merged[value] = merged.get(value, 0) + n
+        rows = sorted(merged.items(), key=lambda kv: kv[1], reverse=True)
+    return rows, total + pending_spins
+
+async def fetch_stats_view(chat_id:int) -> "StatsView":
+    storage = get_storage()
+    if storage.legacy:
+        seq, (triples, spins) = await storage.read(sql_chat_board, chat_id, True)
+        v = StatsView.from_rows(triples, spins)
+        v.add_pending(*spin_buffer.pending_chat(chat_id, seq))
+        return v
+    uids = set()
+    while True:
+        extra = len(uids)
+        seq, (total, combos, totals, names) = await storage.read(
+            sql_stats, chat_id, STATS_TOP_COMBO + extra, STATS_TOP_USERS + extra, STATS_TOP_LUCK + extra,
+            tuple(uids))
+        pending, pending_spins = spin_buffer.pending_chat(chat_id, seq)
+        if pending_spins.keys() <= uids:
+            break
+        uids |= pending_spins.keys()  # someone new spun while we were reading: fetch them exactly too
+    v = StatsView()
+    v.total = total
+    v.names = names
+    for value, uid, n in combos:
+        v.combos[value][uid] = n
+    for uid, t, s in totals:
+        v.totals[uid] = (t, s)
+    v.add_pending(pending, pending_spins)
+    return v
+
+# ---- Windowed /stats (day|week|month) from the rollups: cost depends on the window, not history ----
+STATS_WINDOWS = {  # arg -> (rollup table, buckets, title)
+    "day": ("rollup_hourly", 24, "Last 24 hours"),
+    "week": ("rollup_daily", 7, "Last 7 days"),
+    "month": ("rollup_daily", 30, "Last 30 days"),
+}
 
-    # triples per user
-    totals_by_user = {}
-    for username, combo, c in board:
-        totals_by_user[username] = totals_by_user.get(username, 0) + c
-    total_triples = sum(totals_by_user.values())
+def sql_window_stats(c: sqlite3.Connection, chat_id:int, table:str, since_bucket:int):
+    rows = c.execute(f"""
+      SELECT r.user_id, u.name, r.value, SUM(r.count)
+      FROM {table} r LEFT JOIN users u ON u.user_id=r.user_id
+      WHERE r.chat_id=? AND r.bucket >= ?
+      GROUP BY r.user_id, r.value
+    """, (chat_id, since_bucket)).fetchall()
+    spins = {}
+    for uid, _, _, n in rows:
+        spins[uid] = spins.get(uid, 0) + n
+    return [r for r in rows if r[2] in TRIPLE_SET], list(spins.items())
+
+async def fetch_window_view(chat_id:int, window:str, now:float=None) -> "StatsView":
+    table, buckets, _ = STATS_WINDOWS[window]
+    width = ROLLUPS[table]
+    since_bucket = int(time.time() if now is None else now) // width - buckets + 1
+    seq, (triples, spins) = await get_storage().read(sql_window_stats, chat_id, table, since_bucket)
+    v = StatsView.from_rows(triples, spins)
+    v.add_pending(*spin_buffer.pending_events(chat_id, since_bucket * width, seq))
+    return v
+
+# ---- Helpers ----
+def _compact_combo(value: int) -> str:
+    return OUTCOMES[value].compact
+
+# ---- /stats: ranked from indexed top-N rows, rendered text cached per chat (LRU) ----
+class StatsView:
+    """Candidate rows for each /stats section; ranking happens in render_stats()."""
+    __slots__ = ("total", "combos", "totals", "names")
+
+    def __init__(self):
+        self.total = 0
+        self.combos = {k: {} for k in TRIPLES}  # value -> {user_id: n}
+        self.totals = {}                        # user_id -> (triples, spins)
+        self.names = {}                         # user_id -> display name
+
+    @classmethod
+    def from_rows(cls, triples, spins) -> "StatsView":
+        v = cls()
+        per_user = {}
+        for uid, name, value, n in triples:
+            v.combos[value][uid] = v.combos[value].get(uid, 0) + n
+            per_user[uid] = per_user.get(uid, 0) + n
+            if name:
+                v.names[uid] = name
+        for uid, n in spins:
+            t, s = v.totals.get(uid, (per_user.get(uid, 0), 0))
+            v.totals[uid] = (t, s + n)
+        v.total = sum(per_user.values())
+        return v
+
+    def add_pending(self, rows, spins):
+        """Merge SpinBuffer.pending_chat() output."""
+        triples = {}
+        for uid, name, value, n in rows:
+            self.names[uid] = name
+            per_user = self.combos.get(value)
+            if per_user is not None:
+                per_user[uid] = per_user.get(uid, 0) + n
+                triples[uid] = triples.get(uid, 0) + n
+                self.total += n
+        for uid, n in spins.items():
+            t, s = self.totals.get(uid, (0, 0))
+            self.totals[uid] = (t + triples.get(uid, 0), s + n)
+
+def render_stats(v: StatsView) -> str:
+    name = lambda uid: v.names.get(uid) or str(uid)
 
     # luck list (desc by rate). Format: rate (≈1/N)
-    spins_by_user = fetch_spins_by_username(chat_id)
-    luck_rows = []
-    for u, triples_cnt in totals_by_user.items():
-        spins = spins_by_user.get(u, 0)
-        if spins > 0 and triples_cnt > 0:
-            rate = triples_cnt / spins
-            per_n = int(round(spins / triples_cnt))
-            luck_rows.append((rate, u, per_n))
-    luck_rows.sort(key=lambda x: x[0], reverse=True)
-
-    # per-combo leaders (to number later)
-    by = {c:[] for c in triples}  # combo -> list[(username, count)]
-    for username, combo, c in board:
-        by[combo].append((username, c))
-
-    # output
+    luck_rows = heapq.nlargest(STATS_TOP_LUCK, (
+        (t / s, uid, int(round(s / t))) for uid, (t, s) in v.totals.items() if t > 0 and s > 0
+    ), key=lambda x: x[0])
+
     lines = []
-    lines.append(f"<b>Total Jackpot:</b> {total_triples}")
+    lines.append(f"<b>Total Jackpot:</b> {v.total}")
     lines.append("")  # empty line after Total Jackpot
 
     lines.append("<b>TheMostLuckyPerson:</b>")
     lines.append("")
     if luck_rows:
-        for idx, (rate, u, per_n) in enumerate(luck_rows, start=1):
-            lines.append(f"{idx}. {u} — {rate:.3f} (≈1/{per_n})")
+        for idx, (rate, uid, per_n) in enumerate(luck_rows, start=1):
+            lines.append(f"{idx}. {name(uid)} — {rate:.3f} (≈1/{per_n})")
     else:
         lines.append("—")
 
     lines.append("")
     lines.append("<b>Users Total Jackpot:</b>")
     lines.append("")
-    top_users = sorted(totals_by_user.items(), key=lambda kv: kv[1], reverse=True)
+    top_users = heapq.nlargest(STATS_TOP_USERS, ((uid, t) for uid, (t, _) in v.totals.items() if t > 0),
+                               key=lambda kv: kv[1])
     if top_users:
-        for idx, (u, n) in enumerate(top_users[:10], start=1):
-            lines.append(f"{idx}. {u} — {n}")
+        for idx, (uid, n) in enumerate(top_users, start=1):
+            lines.append(f"{idx}. {name(uid)} — {n}")
     else:
         lines.append("—")
 
     lines.append("")
     lines.append("<b>Total Combination Jackpot:</b>")
     lines.append("")
-    for k in triples:
-        header = f"{_compact_combo(k)}:"
-        vals = by.get(k) or []
-        lines.append(header)
+    for k in TRIPLES:
+        lines.append(f"{_compact_combo(k)}:")
+        vals = heapq.nlargest(STATS_TOP_COMBO, v.combos[k].items(), key=lambda kv: kv[1])
         if vals:
-            for idx, (u, n) in enumerate(vals[:5], start=1):
-                lines.append(f"{idx}. {u} — {n}")
+            for idx, (uid, n) in enumerate(vals, start=1):
+                lines.append(f"{idx}. {name(uid)} — {n}")
         else:
             lines.append("—")
         lines.append("")
 
     while lines and lines[-1] == "":
         lines.pop()
+    return "\n".join(lines)
+
+class _CachedStats:
+    __slots__ = ("text", "rendered_at", "spins_dirty", "jackpot_dirty")
+
+    def __init__(self, text, rendered_at:float):
+        self.text = text
+        self.rendered_at = rendered_at
+        self.spins_dirty = False
+        self.jackpot_dirty = False
+
+class StatsCache:
+    """LRU of rendered /stats per chat. A jackpot in the chat outdates its text right away;
+    plain spins (which only move luck ratios) let it live for up to STATS_SPIN_STALENESS
+    seconds. Outdated text is only served with stale_ok (load shedding). Idle chats fall
+    off the LRU end.
+    """
+    def __init__(self, max_chats:int, spin_staleness:float):
+        self.max_chats = max_chats
+        self.spin_staleness = spin_staleness
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def on_spin(self, chat_id:int, triple:bool):
+        e = self._entries.get(chat_id)
+        if e is None:
+            return
+        self._entries.move_to_end(chat_id)
+        if triple:
+            e.jackpot_dirty = True
+        else:
+            e.spins_dirty = True
+
+    def invalidate(self, chat_id:int):
+        self._entries.pop(chat_id, None)
+
+    async def get_text(self, chat_id:int, stale_ok:bool=False):
+        """-> rendered /stats HTML, or None when the chat has no jackpots yet."""
+        now = time.monotonic()
+        e = self._entries.get(chat_id)
+        if e is not None:
+            self._entries.move_to_end(chat_id)
+            if stale_ok or not e.jackpot_dirty and (not e.spins_dirty or now - e.rendered_at < self.spin_staleness):
+                self.hits += 1
+                return e.text
+        self.misses += 1
+        v = await fetch_stats_view(chat_id)
+        text = render_stats(v) if v.total else None
+        if self.max_chats > 0:
+            self._entries[chat_id] = _CachedStats(text, now)
+            self._entries.move_to_end(chat_id)
+            while len(self._entries) > self.max_chats:
+                self._entries.popitem(last=False)
+        return text
+
+stats_cache = StatsCache(STATS_CACHE_CHATS, STATS_SPIN_STALENESS)
+
+# ---- /global: cross-chat luck board, rebuilt periodically into global_luck (see analytics.py) ----
+# With SHARDS > 1 every shard ranks the chats it holds.
+def sql_global_analysis(c: sqlite3.Connection, min_spins:int, top:int):
+    """-> (board rows, combo_odds rows), computed over every chat in one pass."""
+    board = analytics.rank_users(*analytics.load_user_totals(c), min_spins=min_spins, top=top)
+    return board, analytics.combo_odds(analytics.load_value_counts(c))
+
+def write_global_luck(c: sqlite3.Connection, board, odds, at:int):
+    with c:
+        c.execute("DELETE FROM global_luck")
+        c.executemany("INSERT INTO global_luck(rank,user_id,spins,triples,lower,upper,z) VALUES(?,?,?,?,?,?,?)",
+                      [(rank, *row) for rank, row in enumerate(board, start=1)])
+        c.executemany("""
+        INSERT INTO combo_odds(value,observed,expected,z) VALUES(?,?,?,?)
+        ON CONFLICT(value) DO UPDATE SET observed=excluded.observed, expected=excluded.expected, z=excluded.z
+        """, odds)
+        _meta_set(c, [("global_luck_at", at)])
+
+async def global_luck_job(interval:float, min_spins:int, top:int):
+    while True:
+        try:
+            storage = get_storage()
+            t0 = time.perf_counter()
+            _, (board, odds) = await storage.read(sql_global_analysis, min_spins, top)
+            await storage.write(write_global_luck, board, odds, int(time.time()))
+            log.info("Global luck board: %d users ranked in %.2fs", len(board), time.perf_counter() - t0)
+        except Exception:
+            log.exception("Global luck board rebuild failed")
+        await asyncio.sleep(interval)
+
+def sql_global_board(c: sqlite3.Connection, k:int):
+    """-> ([(name, spins, triples, lower, upper, z)], [(value, observed, expected, z)] of the triples, built at)"""
+    rows = c.execute("""
+      SELECT COALESCE(u.name, g.user_id), g.spins, g.triples, g.lower, g.upper, g.z
+      FROM global_luck g LEFT JOIN users u ON u.user_id = g.user_id
+      WHERE g.rank <= ? ORDER BY g.rank
+    """, (k,)).fetchall()
+    q = ",".join("?"*len(TRIPLES))
+    odds = {r[0]: r for r in c.execute(f"SELECT value, observed, expected, z FROM combo_odds WHERE value IN ({q})",
+                                       TRIPLES)}
+    return rows, [odds[v] for v in TRIPLES if v in odds], _meta_get(c, "global_luck_at")
+
+def render_global(rows, odds, at, min_spins:int, now:float=None) -> str:
+    lines = [f"<b>Luckiest across all chats</b> (≥{min_spins} spins, by the 95% lower bound)", ""]
+    for idx, (name, spins, triples, lower, upper, z) in enumerate(rows, start=1):
+        lines.append(f"{idx}. {html.escape(str(name))} — {lower:.3f}…{upper:.3f}, {z:+.1f}σ ({triples}/{spins})")
+    if odds:
+        lines.append("")
+        lines.append("<b>Jackpots vs expected</b> (each 1/64):")
+        lines.append("")
+        for value, observed, expected, z in odds:
+            lines.append(f"{_compact_combo(value)} {observed} / {expected:.1f} ({z:+.1f}σ)")
+    minutes = int(((time.time() if now is None else now) - at) // 60)
+    lines.append("")
+    lines.append(f"Updated {minutes} min ago" if minutes else "Updated just now")
+    return "\n".join(lines)
+
+# ---- Outgoing messages: priority queue with per-chat + global token buckets, RetryAfter-aware ----
+PRIO_COMMAND, PRIO_JACKPOT, PRIO_NEAR = 0, 1, 2  # lower goes first; PRIO_NEAR may be dropped
+KIND_PRIORITY = {"command": PRIO_COMMAND, "jackpot": PRIO_JACKPOT, "near-jackpot": PRIO_NEAR}
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate:float, burst:float, now:float):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.stamp = now
+
+    def _refill(self, now:float):
+        if now > self.stamp:
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+
+    def delay(self, now:float) -> float:
+        """Seconds until one token is available (0 = now)."""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now:float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def full(self, now:float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst
+
+class _Outgoing:
+    __slots__ = ("prio", "seq", "chat_id", "fn", "args", "kwargs", "fut", "kind", "queued_at", "attempts", "state")
+    QUEUED, SENDING, DONE = 0, 1, 2
+
+    def __init__(self, prio, seq, chat_id, fn, args, kwargs, fut, kind, queued_at):
+        self.prio, self.seq, self.chat_id = prio, seq, chat_id
+        self.fn, self.args, self.kwargs = fn, args, kwargs
+        self.fut, self.kind, self.queued_at = fut, kind, queued_at
+        self.attempts = 0
+        self.state = _Outgoing.QUEUED
+
+    def live(self) -> bool:
+        return self.state != _Outgoing.DONE and not self.fut.done()
+
+    def __lt__(self, other):
+        return (self.prio, self.seq) < (other.prio, other.seq)
+
+class _ChatOut:
+    __slots__ = ("heap", "bucket", "paused_until", "busy", "slot")
+
+    def __init__(self, bucket: TokenBucket):
+        self.heap = []           # _Outgoing by (prio, seq)
+        self.bucket = bucket
+        self.paused_until = 0.0  # RetryAfter / network backoff
+        self.busy = False        # one request in flight per chat keeps replies in order
+        self.slot = None         # key of this chat's live entry in _ready/_waiting
+
+class SendQueue:
+    """All bot messages go out through here.
+
+    Each chat has a queue ordered by priority (commands, then jackpots, then near-jackpot
+    taunts) and a token bucket; a global bucket caps the total rate. A chat is in `_ready`
+    (heap by its best message) when it may send now, or in `_waiting` (heap by time) until
+    its bucket refills or a RetryAfter pause ends, so the dispatcher never scans idle chats.
+    Up to `concurrency` requests are in flight, at most one per chat.
+
+    Past `max_pending` queued messages the oldest near-jackpot taunt is dropped (or the new
+    one, if it is a taunt); taunts older than `drop_after` are dropped instead of sent.
+    Commands and jackpot replies are never dropped. A dropped message's future is cancelled.
+    """
+    NETWORK_RETRIES = 3
+
+    def __init__(self, rate:float=25, chat_rate:float=0.33, chat_burst:float=3, max_pending:int=1000,
+                 drop_after:float=30, concurrency:int=16):
+        self.rate = rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_pending = max_pending
+        self.drop_after = drop_after
+        self.concurrency = max(1, concurrency)
+        self._loop = None
+        self._task = None
+        self._wakeup = None
+        self._reset()
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.retried = 0
+
+    def _reset(self):
+        self._chats = {}
+        self._ready = []     # (prio, seq, chat_id)
+        self._waiting = []   # (at, seq, chat_id)
+        self._droppable = deque()
+        self._seq = itertools.count(1)
+        self._global = None
+        self._sweep_at = 1024
+        self.pending = 0
+        self.inflight = 0
+
+    def stats(self) -> dict:
+        return {"pending": self.pending, "inflight": self.inflight, "chats": len(self._chats),
+                "sent": self.sent, "failed": self.failed, "dropped": self.dropped, "retried": self.retried}
+
+    def submit(self, chat_id:int, fn, *args, kind:str="command", **kwargs) -> asyncio.Future:
+        """Queue `await fn(*args, **kwargs)` (e.g. message.reply_text) for `chat_id`.
+        -> future with its result (exception if it failed, cancelled if dropped)."""
+        loop = asyncio.get_running_loop()
+        self._ensure_worker(loop)
+        fut = loop.create_future()
+        prio = KIND_PRIORITY.get(kind, PRIO_JACKPOT)
+        if self.pending >= self.max_pending and not self._drop_oldest_droppable():
+            if prio >= PRIO_NEAR:
+                self.dropped += 1
+                fut.cancel()
+                return fut
+        now = loop.time()
+        item = _Outgoing(prio, next(self._seq), chat_id, fn, args, kwargs, fut, kind, now)
+        cq = self._chats.get(chat_id)
+        if cq is None:
+            cq = self._chats[chat_id] = _ChatOut(TokenBucket(self.chat_rate, self.chat_burst, now))
+        heapq.heappush(cq.heap, item)
+        self.pending += 1
+        if prio >= PRIO_NEAR:
+            self._droppable.append(item)
+        if cq.slot is not None and cq.slot[0] != "wait" and (prio, item.seq) < cq.slot:
+            cq.slot = None  # a better head: re-key the chat in _ready
+        self._schedule_chat(chat_id, cq, now)
+        self._wakeup.set()
+        return fut
+
+    async def send(self, chat_id:int, fn, *args, kind:str="command", **kwargs):
+        return await self.submit(chat_id, fn, *args, kind=kind, **kwargs)
+
+    def _settle(self, item: _Outgoing):
+        if item.state != _Outgoing.DONE:
+            item.state = _Outgoing.DONE
+            self.pending -= 1
+
+    def _drop(self, item: _Outgoing):
+        self._settle(item)
+        item.fut.cancel()
+        self.dropped += 1
+
+    def _drop_oldest_droppable(self) -> bool:
+        while self._droppable:
+            item = self._droppable.popleft()
+            if item.state == _Outgoing.QUEUED and not item.fut.done():
+                self._drop(item)
+                return True
+        return False
+
+    def _pop_dead(self, cq: _ChatOut):
+        # dropped, or cancelled by whoever awaited it
+        while cq.heap and not cq.heap[0].live():
+            self._settle(heapq.heappop(cq.heap))
+
+    def _schedule_chat(self, chat_id:int, cq: _ChatOut, now:float):
+        """Put the chat into _ready or _waiting unless it is already there or has nothing to do."""
+        self._pop_dead(cq)
+        if cq.busy or cq.slot is not None:
+            return
+        if not cq.heap:
+            if cq.paused_until <= now and cq.bucket.full(now):
+                del self._chats[chat_id]
+            return
+        wait = max(cq.paused_until - now, cq.bucket.delay(now))
+        if wait <= 0:
+            head = cq.heap[0]
+            cq.slot = (head.prio, head.seq)
+            heapq.heappush(self._ready, (head.prio, head.seq, chat_id))
+        else:
+            cq.slot = ("wait", next(self._seq))
+            heapq.heappush(self._waiting, (now + wait, cq.slot[1], chat_id))
+
+    def _sweep(self, now:float):
+        for chat_id, cq in list(self._chats.items()):
+            if not cq.heap and not cq.busy and cq.slot is None:
+                self._schedule_chat(chat_id, cq, now)
+        self._sweep_at = max(1024, 2 * len(self._chats))
+
+    def _ensure_worker(self, loop):
+        if self._loop is not loop:
+            self._reset()
+        if self._loop is not loop or self._task is None or self._task.done():
+            self._loop = loop
+            self._wakeup = asyncio.Event()
+            self._global = self._global or TokenBucket(self.rate, self.rate, loop.time())
+            self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            while self._waiting and self._waiting[0][0] <= now:
+                _, seq, chat_id = heapq.heappop(self._waiting)
+                cq = self._chats.get(chat_id)
+                if cq is not None and cq.slot == ("wait", seq):
+                    cq.slot = None
+                    self._schedule_chat(chat_id, cq, now)
+            if len(self._chats) > self._sweep_at:
+                self._sweep(now)
+            wake_at = self._waiting[0][0] if self._waiting else None
+            if self._ready and self.inflight < self.concurrency:
+                gwait = self._global.delay(now)
+                if gwait <= 0:
+                    self._dispatch(loop, now)
+                    continue
+                wake_at = min(wake_at, now + gwait) if wake_at is not None else now + gwait
+            self._wakeup.clear()
+            timer = loop.call_at(wake_at, self._wakeup.set) if wake_at is not None else None
+            try:
+                await self._wakeup.wait()
+            finally:
+                if timer is not None:
+                    timer.cancel()
+
+    def _dispatch(self, loop, now:float):
+        prio, seq, chat_id = heapq.heappop(self._ready)
+        cq = self._chats.get(chat_id)
+        if cq is None or cq.slot != (prio, seq):
+            return  # stale key
+        cq.slot = None
+        while cq.heap:
+            item = heapq.heappop(cq.heap)
+            if not item.live():
+                self._settle(item)
+                continue
+            if item.prio >= PRIO_NEAR and now - item.queued_at > self.drop_after:
+                self._drop(item)
+                continue
+            item.state = _Outgoing.SENDING
+            self._global.take(now)
+            cq.bucket.take(now)
+            cq.busy = True
+            self.inflight += 1
+            loop.create_task(self._deliver(chat_id, cq, item))
+            return
+        self._schedule_chat(chat_id, cq, now)
+
+    async def _deliver(self, chat_id:int, cq: _ChatOut, item: _Outgoing):
+        loop = asyncio.get_running_loop()
+        item.attempts += 1
+        requeue = False
+        try:
+            result = await item.fn(*item.args, **item.kwargs)
+        except RetryAfter as e:
+            ra = e.retry_after
+            pause = ra.total_seconds() if isinstance(ra, timedelta) else float(ra)
+            log.warning("Flood control in chat %s: pausing it for %.0fs", chat_id, pause)
+            cq.paused_until = loop.time() + pause
+            self.retried += 1
+            requeue = True
+        except NetworkError as e:
+            # TimedOut may mean it was delivered: don't risk a duplicate
+            if isinstance(e, TimedOut) or item.attempts >= self.NETWORK_RETRIES:
+                self._fail(item, e)
+            else:
+                cq.paused_until = loop.time() + 0.5 * 2 ** item.attempts
+                self.retried += 1
+                requeue = True
+        except Exception as e:
+            self._fail(item, e)
+        else:
+            self.sent += 1
+            self._settle(item)
+            if not item.fut.done():
+                item.fut.set_result(result)
+        finally:
+            if requeue:
+                item.state = _Outgoing.QUEUED
+                heapq.heappush(cq.heap, item)  # keeps its (prio, seq) place
+            cq.busy = False
+            self.inflight -= 1
+            if self._chats.get(chat_id) is cq:
+                self._schedule_chat(chat_id, cq, loop.time())
+            self._wakeup.set()
+
+    def _fail(self, item: _Outgoing, exc: BaseException):
+        self.failed += 1
+        self._settle(item)
+        if not item.fut.done():
+            item.fut.set_exception(exc)
+
+    async def drain(self, timeout:float):
+        """Wait up to `timeout` seconds for queued/in-flight messages, then drop the rest."""
+        if self._task is not None and not self._task.done():
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + timeout
+            while (self.pending > 0 or self.inflight > 0) and loop.time() < deadline:
+                await asyncio.sleep(min(0.05, max(deadline - loop.time(), 0)))
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self.pending:
+            log.warning("Dropping %d queued messages on shutdown", self.pending)
+        for cq in self._chats.values():
+            for item in cq.heap:
+                if item.live():
+                    self._drop(item)
+        self._reset()
+        self._task = None
+
+send_queue = SendQueue(SEND_RATE, SEND_CHAT_RATE, SEND_CHAT_BURST, SEND_QUEUE_MAX, SEND_DROP_AFTER, SEND_CONCURRENCY)
+
+# ---- Delayed replies: timer heap + one sender task (handlers never sleep) ----
+class ReplyScheduler:
+    """Holds (due, seq, chat_id, message, text, kind) entries and hands each one to
+    send_queue when due (`kind` sets its priority there).
+
+    schedule() returns immediately with a handle usable for cancel(); drain() is called
+    on shutdown to let pending replies go out (up to a timeout) and drop the rest.
+    """
+    def __init__(self):
+        self._heap = []
+        self._seq = itertools.count(1)
+        self._cancelled = set()
+        self._loop = None
+        self._wakeup = None
+        self._task = None
+        self._outgoing = set()  # handed to send_queue, not sent yet
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.last_lateness = 0.0
+        self.max_lateness = 0.0
+        self._lateness_sum = 0.0
+
+    @property
+    def depth(self) -> int:
+        return len(self._heap) - len(self._cancelled)
+
+    def stats(self) -> dict:
+        done = self.sent + self.failed
+        return {
+            "depth": self.depth,
+            "sent": self.sent,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "last_lateness": self.last_lateness,
+            "max_lateness": self.max_lateness,
+            "avg_lateness": self._lateness_sum / done if done else 0.0,
+        }
+
+    def schedule(self, chat_id:int, message, text:str, delay:float, kind:str="delayed") -> int:
+        loop = asyncio.get_running_loop()
+        self._ensure_worker(loop)
+        seq = next(self._seq)
+        heapq.heappush(self._heap, (loop.time() + max(delay, 0.0), seq, chat_id, message, text, kind))
+        self._wakeup.set()
+        return seq
+
+    def cancel(self, handle:int) -> bool:
+        if any(e[1] == handle for e in self._heap) and handle not in self._cancelled:
+            self._cancelled.add(handle)
+            return True
+        return False
+
+    def cancel_chat(self, chat_id:int) -> int:
+        n = 0
+        for e in self._heap:
+            if e[2] == chat_id and e[1] not in self._cancelled:
+                self._cancelled.add(e[1])
+                n += 1
+        return n
+
+    def _ensure_worker(self, loop):
+        if self._loop is not loop or self._task is None or self._task.done():
+            self._loop = loop
+            self._wakeup = asyncio.Event()
+            self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            while self._heap and self._heap[0][1] in self._cancelled:
+                self._cancelled.discard(heapq.heappop(self._heap)[1])
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            now = loop.time()
+            due = self._heap[0][0]
+            if due > now:
+                self._wakeup.clear()
+                timer = loop.call_at(due, self._wakeup.set)
+                try:
+                    await self._wakeup.wait()
+                finally:
+                    timer.cancel()
+                continue
+            _, _, chat_id, message, text, kind = heapq.heappop(self._heap)
+            self._send(chat_id, message, text, kind, now - due)
+
+    def _send(self, chat_id:int, message, text:str, kind:str, lateness:float):
+        self.last_lateness = lateness
+        self.max_lateness = max(self.max_lateness, lateness)
+        self._lateness_sum += lateness
+        fut = send_queue.submit(chat_id, message.reply_text, text, kind=kind)
+        self._outgoing.add(fut)
+        fut.add_done_callback(lambda f: self._sent(f, kind))
+
+    def _sent(self, fut: asyncio.Future, kind:str):
+        self._outgoing.discard(fut)
+        if fut.cancelled():
+            self.dropped += 1
+        elif fut.exception() is not None:
+            self.failed += 1
+            log.error("Failed to send %s phrase", kind, exc_info=fut.exception())
+        else:
+            self.sent += 1
+
+    async def drain(self, timeout:float):
+        """Wait up to `timeout` seconds for pending replies, then drop whatever is left."""
+        if self._task is not None and not self._task.done():
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + timeout
+            while (self.depth > 0 or self._outgoing) and loop.time() < deadline:
+                await asyncio.sleep(min(0.05, max(deadline - loop.time(), 0)))
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self.dropped += self.depth
+        if self.depth:
+            log.warning("Dropping %d delayed replies on shutdown", self.depth)
+        self._heap.clear()
+        self._cancelled.clear()
+        self._task = None
+
+reply_scheduler = ReplyScheduler()
+
+# ---- Handlers ----
+async def reply(update: Update, text:str, **kwargs) -> asyncio.Future:
+    """Command answers: reply_text through send_queue at command priority. Returns once queued
+    (with the send's future): a throttled or flood-paused chat must not hold its handler slot."""
+    fut = send_queue.submit(update.effective_chat.id, update.message.reply_text, text, **kwargs)
+    fut.add_done_callback(_replied)
+    return fut
+
+def _replied(fut: asyncio.Future):
+    if not fut.cancelled() and fut.exception() is not None:
+        log.error("Failed to send command reply", exc_info=fut.exception())
 
-    await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+@instrumented("on_dice")
+async def on_dice(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    m = update.effective_message
+    o = dice_outcome(m)  # None for other dice and forwards
+    if o is None:
+        return
+    user = update.effective_user
+    chat_id = update.effective_chat.id
+    date = getattr(m, "date", None)
+    if not upsert_result(chat_id, user.id, display_names.get(user), o.value,
+                         int(date.timestamp()) if date else None, getattr(m, "message_id", None)):
+        return  # redelivered: already counted (and answered)
+    stats_cache.on_spin(chat_id, o.triple)
+
+    # if triple (jackpot) -> scheduled reply after configurable delay + non-repeating random phrase
+    if o.triple:
+        if load_shedder.skip(SHED_COUNT_ONLY, "jackpot"):
+            return
+        phrase = await get_next_jackpot_phrase()
+        reply_scheduler.schedule(chat_id, m, phrase, JACKPOT_DELAY, "jackpot")  # reply to the jackpot message
+    else:
+        # near-jackpot: exactly two identical symbols (one short of a triple)
+        if o.near and random.randint(1, 9) == 1 \
+           and not load_shedder.skip(SHED_NO_NEAR, "near-jackpot"):
+            # random delay between configured bounds
+            delay = random.uniform(NEAR_JACKPOT_DELAY_MIN, NEAR_JACKPOT_DELAY_MAX)
+            reply_scheduler.schedule(chat_id, m, random.choice(NEAR_JACKPOT_PHRASES), delay, "near-jackpot")
+
+    # no reply for other combinations
+
+@instrumented("cmd_mystats")
+async def cmd_mystats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    user = update.effective_user
+    rows, total = await fetch_user_stats(chat_id, user.id)
+    if not rows:
+        await reply(update, "No data yet. Send 🎰 and come back.")
+        return
+
+    name = display_names.get(user)
+    lines = []
+    lines.append(f"<b>Top combos</b> — {name}:")
+    for value, cnt in rows[:15]:
+        compact = _compact_combo(value)
+        lines.append(f"{compact} — {cnt}")
+    lines.append("")
+    lines.append(f"<b>Total spins</b>: {total}")
+    await reply(update, "\n".join(lines), parse_mode=ParseMode.HTML)
+
+@instrumented("cmd_global")
+async def cmd_global(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    _, (rows, odds, at) = await get_storage().read(sql_global_board, STATS_TOP_LUCK)
+    if not rows:
+        await reply(update, f"No one has {GLOBAL_MIN_SPINS} spins yet (or the board is still being built).")
+        return
+    await reply(update, render_global(rows, odds, at, GLOBAL_MIN_SPINS), parse_mode=ParseMode.HTML)
+
+@instrumented("cmd_stats")
+async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    args = getattr(context, "args", None) or []
+    window = args[0].lower() if args else None
+    if window in STATS_WINDOWS:
+        v = await fetch_window_view(update.effective_chat.id, window)
+        if not v.total:
+            await reply(update, "No jackpots in this period. Spin 🎰!")
+            return
+        text = f"<b>{STATS_WINDOWS[window][2]}</b>\n\n" + render_stats(v)
+        await reply(update, text, parse_mode=ParseMode.HTML)
+        return
+    text = await stats_cache.get_text(update.effective_chat.id,
+                                      stale_ok=load_shedder.level >= SHED_STALE_STATS)
+    if text is None:
+        await reply(update, "No data in this chat yet. Spin 🎰!")
+        return
+    await reply(update, text, parse_mode=ParseMode.HTML)
 
 async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(
+    await reply(update,
         "Commands:\n"
         "/mystats — your stats\n"
         "/stats — leaders by triple matches (with totals & luck list)\n"
+        "/stats day|week|month — the same for the last 24h / 7 days / 30 days\n"
+        "/global — luckiest players across all chats\n"
         "/help — this help\n\n"
         f"Send 🎰 in the chat — I count it silently. Triples trigger a random phrase (after {JACKPOT_DELAY}s) 😉"
     )
 
+# ---- Update processing: chats in parallel, each chat strictly in arrival order ----
+class ChatOrderedProcessor(BaseUpdateProcessor):
+    """Runs updates of different chats concurrently, at most `concurrency` at a time, while
+    the updates of one chat run one after another in arrival order (spin counts, replies).
+
+    PTB's own limit would also count updates that are only waiting for their chat's turn,
+    so a burst in one group could take every slot; it is set out of reach and the real
+    limit is taken once an update's turn has come.
+    """
+    UNBOUNDED = 1 << 20
+
+    def __init__(self, concurrency:int):
+        super().__init__(self.UNBOUNDED)
+        self.concurrency = max(1, concurrency)
+        self._slots = None
+        self._open = None
+        self._chats = {}  # chat_id -> [asyncio.Lock, updates holding or waiting for it]
+        self.waiting = 0
+        self.running = 0
+
+    async def initialize(self):
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._open = asyncio.Event()
+        self._open.set()
+
+    def pause(self):
+        """Updates wait (counted in `waiting`) until resume()."""
+        self._open.clear()
+
+    def resume(self):
+        self._open.set()
+
+    async def shutdown(self):
+        pass
+
+    async def do_process_update(self, update, coroutine):
+        chat = getattr(update, "effective_chat", None)
+        key = chat.id if chat is not None else None
+        entry = None
+        if key is not None:
+            entry = self._chats.get(key)
+            if entry is None:
+                entry = self._chats[key] = [asyncio.Lock(), 0]
+            entry[1] += 1
+        self.waiting += 1
+        locked = started = False
+        try:
+            if not self._open.is_set():
+                await self._open.wait()
+            if entry is not None:
+                await entry[0].acquire()  # asyncio.Lock wakes waiters FIFO
+                locked = True
+            async with self._slots:
+                self.waiting -= 1
+                self.running += 1
+                started = True
+                try:
+                    await coroutine
+                finally:
+                    self.running -= 1
+        finally:
+            if locked:
+                entry[0].release()
+            if not started:
+                self.waiting -= 1
+                coroutine.close()
+            if entry is not None:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._chats[key]
+
+update_processor = ChatOrderedProcessor(UPDATE_CONCURRENCY)
+
+# ---- Load shedding: optional work dropped in stages while the bot is behind ----
+SHED_NORMAL, SHED_NO_NEAR, SHED_STALE_STATS, SHED_SLOW_FLUSH, SHED_COUNT_ONLY = range(5)
+SHED_LEVELS = ("normal", "no near-jackpot", "stale /stats", "slow flush", "count only")
+
+class LoadShedder:
+    """Picks a shedding level once per `interval` from the worst update lag seen since the
+    last tick (message date to handler start) and the updates waiting for a handler; each
+    step in `lag_steps` / `backlog_steps` passed is one level up, and every level keeps
+    shedding what the ones below it do. Going up is immediate; going down is one level at
+    a time after `recover_after` seconds below the current level, so it does not flap.
+    """
+    def __init__(self, lag_steps, backlog_steps, recover_after:float, flush_stretch:float,
+                 backlog=lambda: update_processor.waiting, interval:float=1.0):
+        self.lag_steps = sorted(lag_steps)[:SHED_COUNT_ONLY]
+        self.backlog_steps = sorted(backlog_steps)[:SHED_COUNT_ONLY]
+        self.recover_after = recover_after
+        self.flush_stretch = flush_stretch
+        self.backlog = backlog
+        self.interval = interval
+        self.level = SHED_NORMAL
+        self.skipped = {}
+        self._lag = 0.0
+        self._calm_since = 0.0
+
+    def observe_lag(self, lag:float):
+        if lag > self._lag:
+            self._lag = lag
+
+    def skip(self, level:int, what:str) -> bool:
+        """True (and counted) if work optional from `level` on is to be skipped now."""
+        if self.level < level:
+            return False
+        self.skipped[what] = self.skipped.get(what, 0) + 1
+        return True
+
+    def tick(self, now:float):
+        lag, self._lag = self._lag, 0.0
+        backlog = self.backlog()
+        target = max(sum(lag >= s for s in self.lag_steps), sum(backlog >= s for s in self.backlog_steps))
+        if target >= self.level:
+            self._calm_since = now
+            if target > self.level:
+                self._set(target, lag, backlog)
+        elif now - self._calm_since >= self.recover_after:
+            self._calm_since = now
+            self._set(self.level - 1, lag, backlog)
+
+    def _set(self, level:int, lag:float, backlog:int):
+        log.log(logging.WARNING if level > self.level else logging.INFO,
+                "Load shedding %d -> %d (%s): lag %.1fs, %d updates waiting",
+                self.level, level, SHED_LEVELS[level], lag, backlog)
+        self.level = level
+        spin_buffer.stretch = self.flush_stretch if level >= SHED_SLOW_FLUSH else 1
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.interval)
+            self.tick(loop.time())
+
+load_shedder = LoadShedder(SHED_LAG, SHED_BACKLOG, SHED_RECOVER_AFTER, SHED_FLUSH_STRETCH)
+
 async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE):
     log.exception("Error while handling update", exc_info=context.error)
 
+_background_tasks = set()
+def start_background(coro, name:str) -> asyncio.Task:
+    task = asyncio.get_running_loop().create_task(coro, name=name)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+async def stop_background():
+    tasks = list(_background_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+def probe_routes():
+    return [(READY_PATH, metrics.probe_handler(lambda: startup.ready))] if READY_PATH else []
+
+async def serve_metrics(app: Application):
+    """Polling mode: METRICS_PATH and READY_PATH on a small server of our own on METRICS_PORT.
+    (Webhook mode serves them next to the webhook, see cluster.webhook_app.)"""
+    server = metrics.serve(METRICS_PORT, METRICS_PATH, routes=probe_routes())
+    log.info("Metrics on :%d%s", METRICS_PORT, METRICS_PATH)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        server.stop()
+
+async def start_when_open(app: Application):
+    """Once the DB is open: let updates through, start the DB jobs; ready once PTB is running too."""
+    try:
+        storage = await asyncio.wrap_future(open_storage_soon())
+    except Exception:
+        log.exception("Could not open the stats DB, stopping")
+        app.stop_running()
+        return
+    update_processor.resume()
+    start_background(migrate_v2(storage, MIGRATE_BATCH), "migrate_v2")
+    start_background(spin_log_maintenance(), "spin_log_maintenance")
+    start_background(global_luck_job(GLOBAL_INTERVAL, GLOBAL_MIN_SPINS, GLOBAL_TOP), "global_luck")
+    start_background(db_maintenance(snapshots, SNAPSHOT_INTERVAL, COMPACT_INTERVAL, QUIET_SPINS), "db_maintenance")
+    while not app.running:  # post_init runs before setWebhook / the first getUpdates
+        await asyncio.sleep(0.05)
+    startup.done()
+
+async def on_start(app: Application):
+    # Nothing here may wait on the DB: the webhook is registered (or polling starts) only after post_init returns.
+    with startup.phase("post_init"):
+        open_storage_soon()
+        update_processor.pause()
+        start_background(start_when_open(app), "start_when_open")
+        if load_shedder.lag_steps or load_shedder.backlog_steps:
+            start_background(load_shedder.run(), "load_shedder")
+        if METRICS_PORT and not WEBHOOK_BASE:
+            start_background(serve_metrics(app), "serve_metrics")
+
+async def on_stop(app: Application):
+    await stop_background()
+    if _storage_opening is not None:
+        await asyncio.wait([asyncio.wrap_future(_storage_opening)])  # would outlive close_storage() otherwise
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + REPLY_DRAIN_TIMEOUT
+    await reply_scheduler.drain(REPLY_DRAIN_TIMEOUT)
+    await send_queue.drain(max(deadline - loop.time(), 0))
+    log.info("Delayed replies: %s", reply_scheduler.stats())
+    log.info("Send queue: %s", send_queue.stats())
+    await spin_buffer.close()
+    log.info("Spin buffer: %d spins in %d commits", spin_buffer.spins, spin_buffer.commits)
+    close_storage()
+
+# ---- Backfill from a Telegram Desktop chat export: python bot.py import result.json ----
+_EXPORT_MESSAGES = re.compile(r'(?<!\\)"messages"\s*:\s*\[')
+_EXPORT_FIELD = re.compile(r'(?<!\\)"(type|id)"\s*:\s*("(?:[^"\\]|\\.)*"|-?\d+)')
+
+class ExportReader:
+    """Iterates the messages of a Telegram Desktop `result.json` one object at a time:
+    JSONDecoder.raw_decode over a sliding window of the file, so memory stays at about
+    one chunk however big the export is. offset() is the byte position just past the
+    last message returned; a reader opened at that offset continues from there.
+    """
+    MAX_MESSAGE = 64 << 20
+
+    def __init__(self, path:str, offset:int=0, chunk:int=1 << 20):
+        self.path = path
+        self.size = os.path.getsize(path)
+        self._raw = open(path, "rb")
+        self._raw.seek(offset)
+        self._f = io.TextIOWrapper(self._raw, encoding="utf-8", newline="")  # keep \r\n: offsets count bytes
+        self._chunk = chunk
+        self._buf = ""
+        self._pos = 0
+        self._base = offset  # byte offset of _buf[0]
+        self._decoder = json.JSONDecoder()
+        self.header = {}     # the chat's top-level "type"/"id" (only when reading from the start)
+        if offset == 0:
+            self._read_header()
+
+    def _refill(self) -> bool:
+        more = self._f.read(self._chunk)
+        self._base += len(self._buf[:self._pos].encode("utf-8"))
+        self._buf = self._buf[self._pos:] + more
+        self._pos = 0
+        return bool(more)
+
+    def _read_header(self):
+        while True:
+            m = _EXPORT_MESSAGES.search(self._buf)
+            if m:
+                break
+            if len(self._buf) > self.MAX_MESSAGE or not self._refill():
+                raise ValueError(f"{self.path}: no \"messages\" list (not a single-chat export?)")
+        for key, raw in _EXPORT_FIELD.findall(self._buf[:m.start()]):
+            self.header.setdefault(key, json.loads(raw))
+        self._pos = m.end()
+
+    def offset(self) -> int:
+        return self._base + len(self._buf[:self._pos].encode("utf-8"))
+
+    def __iter__(self):
+        buf_len = len(self._buf)
+        while True:
+            buf, pos = self._buf, self._pos
+            while pos < buf_len and buf[pos] in " \t\r\n,":
+                pos += 1
+            self._pos = pos
+            if pos >= buf_len:
+                if not self._refill():
+                    return
+                buf_len = len(self._buf)
+                continue
+            if buf[pos] == "]":
+                return
+            try:
+                msg, self._pos = self._decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if buf_len - pos > self.MAX_MESSAGE or not self._refill():
+                    raise
+                buf_len = len(self._buf)
+                continue
+            yield msg
+
+    def close(self):
+        self._f.close()
+
+def export_chat_id(kind:str, raw_id:int) -> int:
+    """Bot API chat_id for an export's top-level "type"/"id" (supergroups/channels are -100<id>)."""
+    if kind.endswith(("supergroup", "channel")):
+        return -(10**12 + raw_id)
+    if kind == "private_group":
+        return -raw_id
+    return raw_id
+
+def export_spin(msg: dict):
+    """-> (ts, user_id, name, value) for a 🎰 message on_dice would count, else None."""
+    if msg.get("type") != "message" or "forwarded_from" in msg:  # same rule as on_dice: no forwards
+        return None
+    dice = msg.get("dice") or {}
+    if (msg.get("dice_emoji") or dice.get("emoji")) != "🎰":
+        return None
+    value = msg.get("dice_value") or dice.get("value")
+    from_id = msg.get("from_id") or ""
+    if value not in slot_value or not from_id.startswith("user"):
+        return None
+    uid = int(from_id[4:])
+    ts = msg.get("date_unixtime")
+    ts = int(ts) if ts else int(datetime.fromisoformat(msg["date"]).replace(tzinfo=timezone.utc).timestamp())
+    return ts, uid, msg.get("from") or str(uid), value
+
+def _export_fingerprint(path:str) -> str:
+    h = hashlib.sha1(str(os.path.getsize(path)).encode())
+    with open(path, "rb") as f:
+        h.update(f.read(1 << 16))
+    return h.hexdigest()[:16]
+
+def _meta_get(c: sqlite3.Connection, key:str):
+    row = c.execute("SELECT value FROM meta WHERE key=?", (key,)).fetchone()
+    return row[0] if row else None
+
+def _meta_set(c: sqlite3.Connection, items):
+    with c:
+        c.executemany("""
+        INSERT INTO meta(key,value) VALUES(?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value
+        """, items)
+
+def bump_data_gen(c: sqlite3.Connection) -> int:
+    """New random meta.data_gen, in the caller's transaction: counters changed other than
+    through the spin buffer (import, v1 migration), so a CounterStore file is stale."""
+    gen = random.getrandbits(62) + 1
+    c.execute("""
+    INSERT INTO meta(key,value) VALUES('data_gen', ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value
+    """, (gen,))
+    return gen
+
+def first_recorded_spin(c: sqlite3.Connection, chat_id:int):
+    """Earliest ts the bot itself counted in this chat (None if nothing yet)."""
+    day = c.execute("SELECT MIN(bucket) FROM rollup_daily WHERE chat_id=?", (chat_id,)).fetchone()[0]
+    if day is None:
+        return None
+    table = _log_partition(day)
+    try:
+        ts = c.execute(f"SELECT MIN(ts) FROM {table} WHERE chat_id=?", (chat_id,)).fetchone()[0]
+    except sqlite3.OperationalError:  # partition already pruned
+        ts = None
+    return ts if ts is not None else day * 86400
+
+def has_counts(c: sqlite3.Connection, chat_id:int) -> bool:
+    return c.execute("SELECT 1 FROM spin_totals WHERE chat_id=? LIMIT 1", (chat_id,)).fetchone() is not None
+
+def write_import_batch(c: sqlite3.Connection, key:str, offset:int, counts, spins, names, events, log_from, hourly_from):
+    """One import batch plus its resume offset, atomically. Names only fill in unknown users."""
+    with c:
+        append_spin_events(c, events, log_from, hourly_from)
+        upsert_spin_counts(c, counts, spins)
+        c.executemany("INSERT INTO users(user_id,name) VALUES(?, ?) ON CONFLICT(user_id) DO NOTHING", names)
+        c.execute("""
+        INSERT INTO meta(key,value) VALUES(?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value
+        """, (key + ":offset", offset))
+        bump_data_gen(c)
+
+def import_export(path:str, chat_id:int=None, until:int=None, batch:int=50_000, force:bool=False,
+                  progress_every:float=2.0) -> dict:
+    """Backfill the counters from a Telegram Desktop export of one chat.
+
+    Spins at or after `until` are skipped (default: the first spin the bot recorded in that
+    chat, so history and live counts don't overlap). A chat with counts but no recorded spin
+    (carried over from v1, or its rollups pruned) has no such point: that needs `until` or
+    `force`. Progress is committed with every batch; running it again on the same file
+    resumes after the last committed batch.
+    """
+    storage = Storage(DB_PATH, 1).open()
+    key = "import:" + _export_fingerprint(path)
+    try:
+        if storage.legacy:
+            raise SystemExit("the DB is still being migrated to v2; start the bot once first")
+        state = storage.submit_write(lambda c: {k: _meta_get(c, f"{key}:{k}") for k in
+                                                ("offset", "chat", "until", "done")}).result()
+        if state["done"] and not force:
+            log.info("%s was already imported into %s (use --force to count it again)", path, storage.path)
+            return {"spins": 0, "skipped": 0, "resumed": False}
+        resume = bool(state["offset"]) and not force
+        reader = ExportReader(path, state["offset"] if resume else 0)
+        if resume:
+            chat_id, until = state["chat"], state["until"]
+        else:
+            if chat_id is None:
+                if "id" not in reader.header:
+                    raise SystemExit("no chat id in the export header, pass --chat-id")
+                chat_id = export_chat_id(str(reader.header.get("type", "")), int(reader.header["id"]))
+            if until is None:
+                until = storage.submit_write(first_recorded_spin, chat_id).result()
+                if until is None and not force and storage.submit_write(has_counts, chat_id).result():
+                    raise SystemExit(f"chat {chat_id} has counts with no recorded spin times (migrated from v1?), "
+                                     "so the export may overlap them: pass --until, or --force to add all of it")
+                until = until or 0
+            storage.submit_write(_meta_set, [(f"{key}:chat", chat_id), (f"{key}:until", until),
+                                             (f"{key}:done", 0), (f"{key}:offset", 0)]).result()
+        today = int(time.time()) // 86400
+        log_from = (today - SPIN_LOG_RETENTION_DAYS + 1) * 86400 if SPIN_LOG_RETENTION_DAYS > 0 else 0
+        hourly_from = (today - ROLLUP_HOURLY_RETENTION_DAYS + 1) * 86400 if ROLLUP_HOURLY_RETENTION_DAYS > 0 else 0
+        log.info("Importing %s into chat %s%s%s", path, chat_id, f" (spins before {until})" if until else "",
+                 f", resuming at byte {reader.offset()}" if resume else "")
+
+        total = skipped = 0
+        counts, spins, names, events = {}, {}, {}, []
+        def flush():
+            fut = storage.submit_write(
+                write_import_batch, key, reader.offset(),
+                [(chat_id, uid, value, n) for (uid, value), n in counts.items()],
+                [(chat_id, uid, s, t) for uid, (s, t) in spins.items()],
+                list(names.items()), events, log_from, hourly_from)
+            counts.clear(); spins.clear(); names.clear()
+            return fut
+        pending = None
+        t0 = last = time.monotonic()
+        start_offset = reader.offset()
+        try:
+            for msg in reader:
+                spin = export_spin(msg)
+                if spin is None:
+                    continue
+                ts, uid, name, value = spin
+                if until and ts >= until:
+                    skipped += 1
+                    continue
+                counts[(uid, value)] = counts.get((uid, value), 0) + 1
+                s = spins.get(uid)
+                spins[uid] = (s[0] + 1, s[1] + (value in TRIPLE_SET)) if s else (1, int(value in TRIPLE_SET))
+                names.setdefault(uid, name)
+                events.append((ts, chat_id, uid, value))
+                total += 1
+                if len(events) >= batch:
+                    if pending is not None:
+                        pending.result()  # at most one batch in flight while the next one is parsed
+                    pending, events = flush(), []
+                now = time.monotonic()
+                if now - last >= progress_every:
+                    last = now
+                    done = reader.offset()
+                    log.info("Import: %.1f%% (%d/%d MB, %.1f MB/s), %d spins", 100 * done / max(reader.size, 1),
+                             done >> 20, reader.size >> 20, (done - start_offset) / (now - t0) / 1e6, total)
+            if pending is not None:
+                pending.result()
+            flush().result()
+        finally:
+            reader.close()
+        storage.submit_write(_meta_set, [(f"{key}:done", 1)]).result()
+        log.info("Imported %d spins into chat %s in %.1fs (%d at/after the live start skipped)",
+                 total, chat_id, time.monotonic() - t0, skipped)
+        return {"spins": total, "skipped": skipped, "resumed": resume, "chat_id": chat_id}
+    finally:
+        storage.close()
+
+def import_main(argv):
+    p = argparse.ArgumentParser(prog="bot.py import", description="Backfill 🎰 stats from a Telegram Desktop "
+                                "chat export (result.json). Safe to interrupt: run again to resume.")
+    p.add_argument("export", help="path to result.json")
+    p.add_argument("--chat-id", type=int, help="Bot API chat id (default: from the export, -100<id> for supergroups)")
+    p.add_argument("--until", type=int, help="only spins before this unix time (default: the bot's first recorded spin)")
+    p.add_argument("--batch", type=int, default=50_000, help="spins per transaction (default 50000)")
+    p.add_argument("--force", action="store_true", help="start over even if this file was (partly) imported, "
+                   "and import into a chat with counts but no recorded spin times")
+    args = p.parse_args(argv)
+    return import_export(args.export, args.chat_id, args.until, args.batch, args.force)
+
+def counters_main(argv):
+    p = argparse.ArgumentParser(prog="bot.py counters", description="Manage the COUNTER_STORE file of DB_PATH "
+                                "(run it with the bot stopped).")
+    p.add_argument("action", choices=["rebuild"], help="rewrite the file from the SQLite counters")
+    p.parse_args(argv)
+    storage = Storage(DB_PATH, 1).open()
+    try:
+        if storage.legacy:
+            raise SystemExit("the DB is still being migrated to v2; start the bot once first")
+        store = CounterStore(counters_path(storage.path), COUNTER_STORE_SLOTS)
+        t0 = time.monotonic()
+        storage.submit_write(store.rebuild, storage.data_gen).result()
+        store.close(storage.flush_seq)
+        log.info("Rebuilt %s: %d (chat, user) slots of %d in %.1fs",
+                 store.path, store.used, store.capacity, time.monotonic() - t0)
+        return store
+    finally:
+        storage.close()
+
 def webhook_path_from_token(token: str) -> str:
     return f"/telegram/{hashlib.sha256(token.encode()).hexdigest()[:16]}"
 
 def build_app() -> Application:
     if not TOKEN:
         raise SystemExit("Set TG_TOKEN env var")
-    app = Application.builder().token(TOKEN).build()
-    app.add_handler(MessageHandler(filters.Dice.SLOT_MACHINE, on_dice))
+    app = (Application.builder().token(TOKEN)
+           .request(api_request(BOT_POOL_SIZE))
+           .get_updates_request(api_request(1))  # one long poll at a time
+           .concurrent_updates(update_processor)  # also holds updates until the DB is open
+           .post_init(on_start).post_stop(on_stop)
+           .build())
+    # forwards are turned away by the filter, without starting on_dice at all
+    app.add_handler(MessageHandler(filters.Dice.SLOT_MACHINE & ~filters.FORWARDED & ~filters.IS_AUTOMATIC_FORWARD,
+                                   on_dice))
     app.add_handler(CommandHandler("mystats", cmd_mystats))
     app.add_handler(CommandHandler("stats", cmd_stats))
+    app.add_handler(CommandHandler("global", cmd_global))
     app.add_handler(CommandHandler("help", cmd_help))
     app.add_error_handler(on_error)
     return app
 
 def main():
+    if WORKER_PORT or SHARDS <= 1:
+        open_storage_soon()  # alongside build_app, getMe and webhook registration
+    if WORKER_PORT:
+        import cluster
+        cluster.run_worker(build_app(), WORKER_PORT, os.getenv("SHARD_SECRET", ""))
+        return
+    if SHARDS > 1:
+        if not (TOKEN and WEBHOOK_BASE):
+            raise SystemExit("SHARDS > 1 needs TG_TOKEN and WEBHOOK_BASE (webhook mode)")
+        import cluster
+        path = WEBHOOK_PATH or webhook_path_from_token(TOKEN)
+        cluster.run_front(TOKEN, SHARDS, PORT, WEBHOOK_BASE.rstrip('/') + path, path, WEBHOOK_SECRET)
+        return
     app = build_app()
     if WEBHOOK_BASE:
         path = WEBHOOK_PATH or webhook_path_from_token(TOKEN)
         url = WEBHOOK_BASE.rstrip('/') + path
         log.info("Starting webhook on %s", url)
-        app.run_webhook(listen="0.0.0.0", port=PORT, url_path=path, webhook_url=url, drop_pending_updates=True)
+        import cluster
+        cluster.run_webhook(app, PORT, url, path, WEBHOOK_SECRET)
     else:
         log.info("Starting polling (no WEBHOOK_BASE set)")
-        app.run_polling(drop_pending_updates=True)
+        app.run_polling(drop_pending_updates=DROP_PENDING_UPDATES, timeout=POLL_TIMEOUT)
 
 if __name__ == "__main__":
-    main()
+    sys.modules.setdefault("bot", sys.modules[__name__])  # cluster.py imports this module as `bot`
+    if sys.argv[1:2] == ["import"]:
+        import_main(sys.argv[2:])
+    elif sys.argv[1:2] == ["counters"]:
+        counters_main(sys.argv[2:])
+    else:
+        main()
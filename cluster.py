@@ -0,0 +1,429 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Multi-process mode: one front process takes Telegram's webhook and routes each update,
+by a hash of its chat_id, to one of SHARDS worker processes. Each worker is a normal bot
+(same handlers, same buffers) with its own SQLite shard, so a chat's /stats and /mystats
+only ever touch one file and the shards write in parallel.
+
+  SHARDS=4 WEBHOOK_BASE=https://... python bot.py        # front + 4 workers
+  python cluster.py route --workers http://127.0.0.1:8100 http://127.0.0.1:8101
+                                                        # front only (POST fake updates to it)
+  python cluster.py rebalance --db stats.sqlite3 --from 4 --to 8 --out new/stats.sqlite3
+  python cluster.py merge --db stats.sqlite3 --from 4 --out merged.sqlite3
+
+Shard files sit next to DB_PATH: stats.sqlite3 -> stats.shard0.sqlite3, stats.shard1.sqlite3, ...
+rebalance/merge read the old layout and write a fresh one (stop the bot first); the
+chat -> shard mapping only depends on the shard count, so changing SHARDS needs a rebalance.
+"""
+import argparse, asyncio, json, logging, os, pathlib, secrets, signal, sqlite3, subprocess, sys, time, zlib
+
+import httpx
+import tornado.httpserver
+import tornado.web
+
+import bot
+import metrics
+
+log = logging.getLogger("ludooman.cluster")
+
+SHARD_SECRET_HEADER = "X-Ludooman-Shard-Secret"
+TELEGRAM_SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+WORKER_UPDATE_PATH = "/update"
+
+
+def shard_of(chat_id:int, shards:int) -> int:
+    return zlib.crc32(int(chat_id).to_bytes(8, "little", signed=True)) % shards
+
+def chat_of(update:dict) -> int:
+    """chat id of a raw Update dict (sender id for chat-less updates, 0 if neither)."""
+    for v in update.values():
+        if not isinstance(v, dict):
+            continue
+        chat = v.get("chat") or (v.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+        if "from" in v:
+            return v["from"]["id"]
+    return 0
+
+def shard_paths(db_path:str, shards:int):
+    if shards <= 1:
+        return [db_path]
+    p = pathlib.Path(db_path)
+    return [str(p.with_name(f"{p.stem}.shard{i}{p.suffix}")) for i in range(shards)]
+
+
+# ---- Front: webhook in, forward to the chat's worker ----
+class Front:
+    def __init__(self, workers, secret:str=None, shard_secret:str="", webhook_path:str="/telegram",
+                 metrics_path:str="/metrics"):
+        self.workers = [w.rstrip("/") for w in workers]
+        self.secret = secret
+        self.shard_secret = shard_secret
+        self.webhook_path = webhook_path
+        self.metrics_path = metrics_path
+        self.client = None
+        self.registry = metrics.Registry()
+        self.forwarded = metrics.Counter("ludooman_front_updates_total", "Updates routed, by shard and result.",
+                                         ("shard", "result"), registry=self.registry)
+        self.latency = metrics.Histogram("ludooman_front_forward_seconds", "Time to hand an update to its worker.",
+                                         ("shard",), registry=self.registry)
+
+    def app(self) -> tornado.web.Application:
+        return tornado.web.Application([
+            (rf"{self.webhook_path}/?", _FrontUpdateHandler, {"front": self}),
+            (self.metrics_path, _FrontMetricsHandler, {"front": self}),
+        ])
+
+    def _client(self) -> httpx.AsyncClient:
+        if self.client is None:
+            limits = httpx.Limits(max_connections=256, max_keepalive_connections=64)
+            self.client = httpx.AsyncClient(timeout=10, limits=limits)
+        return self.client
+
+    async def route(self, body:bytes) -> int:
+        """-> HTTP status for Telegram (non-2xx makes it redeliver the update later)."""
+        try:
+            shard = shard_of(chat_of(json.loads(body)), len(self.workers))
+        except (ValueError, TypeError, KeyError, AttributeError):
+            return 400
+        t0 = time.perf_counter()
+        try:
+            r = await self._client().post(self.workers[shard] + WORKER_UPDATE_PATH, content=body,
+                                          headers={SHARD_SECRET_HEADER: self.shard_secret,
+                                                   "Content-Type": "application/json"})
+            status = r.status_code
+        except httpx.HTTPError:
+            status = 502
+        self.latency.labels(str(shard)).observe(time.perf_counter() - t0)
+        self.forwarded.labels(str(shard), "ok" if status < 300 else str(status)).inc()
+        return status
+
+    async def scrape(self) -> str:
+        """Front metrics plus every worker's, each sample labelled with its shard."""
+        async def one(i, url):
+            try:
+                r = await self._client().get(url + self.metrics_path, timeout=5)
+                return i, r.text if r.status_code == 200 else ""
+            except httpx.HTTPError:
+                return i, ""
+        families = {}  # name -> [help line, type line, samples]
+        for i, text in await asyncio.gather(*(one(i, u) for i, u in enumerate(self.workers))):
+            fam = None
+            for line in text.splitlines():
+                if line.startswith("# HELP "):
+                    fam = families.setdefault(line.split(" ", 3)[2], [line, None, []])
+                elif line.startswith("# TYPE ") and fam is not None:
+                    fam[1] = line
+                elif line and fam is not None:
+                    name, _, rest = line.partition(" ")
+                    if "{" in name:
+                        name = name.replace("{", f'{{shard="{i}",', 1)
+                    else:
+                        name += f'{{shard="{i}"}}'
+                    fam[2].append(f"{name} {rest}")
+        out = [self.registry.render().rstrip("\n")]
+        for help_line, type_line, samples in families.values():
+            out.append(help_line)
+            if type_line:
+                out.append(type_line)
+            out.extend(samples)
+        return "\n".join(out) + "\n"
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+class _FrontUpdateHandler(tornado.web.RequestHandler):
+    def initialize(self, front: Front):
+        self.front = front
+
+    async def post(self):
+        if self.front.secret and self.request.headers.get(TELEGRAM_SECRET_HEADER) != self.front.secret:
+            self.set_status(403)
+            return
+        self.set_status(await self.front.route(self.request.body))
+
+class _FrontMetricsHandler(tornado.web.RequestHandler):
+    def initialize(self, front: Front):
+        self.front = front
+
+    async def get(self):
+        self.set_header("Content-Type", metrics.CONTENT_TYPE)
+        self.finish(await self.front.scrape())
+
+
+# ---- Serving a bot: updates POSTed by the front (shard worker) or by Telegram (webhook mode) ----
+class _UpdateHandler(tornado.web.RequestHandler):
+    """Update JSON in the body -> app.update_queue, if `header` carries `secret` (None: no check)."""
+    def initialize(self, app, header:str, secret:str):
+        self.app = app
+        self.header = header
+        self.secret = secret
+
+    async def post(self):
+        from telegram import Update
+        if self.secret is not None and self.request.headers.get(self.header) != self.secret:
+            self.set_status(403)
+            return
+        try:
+            update = Update.de_json(json.loads(self.request.body), self.app.bot)
+        except Exception:
+            log.exception("Bad update from front")
+            self.set_status(400)
+            return
+        await self.app.update_queue.put(update)
+        self.set_status(200)
+
+def worker_app(app, secret:str) -> tornado.web.Application:
+    return tornado.web.Application([
+        (WORKER_UPDATE_PATH, _UpdateHandler, {"app": app, "header": SHARD_SECRET_HEADER, "secret": secret}),
+        (bot.METRICS_PATH, metrics.metrics_handler()),
+        *bot.probe_routes(),
+    ])
+
+def webhook_app(app, webhook_path:str, secret:str=None) -> tornado.web.Application:
+    """Telegram's webhook plus METRICS_PATH and READY_PATH, all on the one public port."""
+    return tornado.web.Application([
+        (rf"{webhook_path}/?", _UpdateHandler, {"app": app, "header": TELEGRAM_SECRET_HEADER, "secret": secret}),
+        (bot.METRICS_PATH, metrics.metrics_handler()),
+        *bot.probe_routes(),
+    ])
+
+def run_worker(app, port:int, secret:str):
+    """Like Application.run_webhook, minus setWebhook: serve `app` on 127.0.0.1:port until SIGTERM/SIGINT."""
+    _serve(app, worker_app(app, secret), "Shard worker", port, "127.0.0.1")
+
+def run_webhook(app, port:int, webhook_url:str, webhook_path:str, secret:str=None):
+    """Application.run_webhook on a server of our own, so /metrics and /ready share the webhook port."""
+    async def register():
+        await app.bot.set_webhook(webhook_url, secret_token=secret, drop_pending_updates=bot.DROP_PENDING_UPDATES)
+    _serve(app, webhook_app(app, webhook_path, secret), "Webhook", port, "0.0.0.0", register)
+
+def _serve(app, server_app: tornado.web.Application, name:str, port:int, address:str, after_listen=None):
+    """post_init, start `app`, serve `server_app` (then await after_listen()) until SIGTERM/SIGINT."""
+    async def main():
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        async with app:
+            if app.post_init:
+                await app.post_init(app)
+            await app.start()
+            server = tornado.httpserver.HTTPServer(server_app)
+            server.listen(port, address=address)
+            log.info("%s on %s:%d (%s)", name, address, port, bot.DB_PATH)
+            try:
+                if after_listen is not None:
+                    await after_listen()
+                await stop.wait()
+            finally:
+                server.stop()
+                await app.stop()
+                if app.post_stop:
+                    await app.post_stop(app)
+    asyncio.run(main())
+
+
+# ---- Supervisor: front process owns the workers ----
+class Workers:
+    def __init__(self, shards:int, port_base:int, db_path:str, shard_secret:str):
+        self.shards = shards
+        self.ports = [port_base + i for i in range(shards)]
+        self.paths = shard_paths(db_path, shards)
+        self.shard_secret = shard_secret
+        self.procs = [None] * shards
+        self.restarts = [0] * shards
+
+    @property
+    def urls(self):
+        return [f"http://127.0.0.1:{p}" for p in self.ports]
+
+    def _spawn(self, i:int):
+        env = dict(os.environ,
+                   WORKER_PORT=str(self.ports[i]), SHARD_SECRET=self.shard_secret, DB_PATH=self.paths[i],
+                   WEBHOOK_BASE="", METRICS_PORT="0", SEND_RATE=str(bot.SEND_RATE / self.shards))
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+        self.procs[i] = subprocess.Popen([sys.executable, script], env=env)
+
+    def start(self):
+        for i in range(self.shards):
+            self._spawn(i)
+
+    async def watch(self, interval:float=1.0):
+        while True:
+            await asyncio.sleep(interval)
+            for i, p in enumerate(self.procs):
+                if p is not None and p.poll() is not None:
+                    self.restarts[i] += 1
+                    log.error("Shard %d exited with %s, restarting (#%d)", i, p.returncode, self.restarts[i])
+                    await asyncio.sleep(min(3.0, 0.1 * 2 ** self.restarts[i]))
+                    self._spawn(i)
+
+    def stop(self, timeout:float):
+        for p in self.procs:
+            if p is not None and p.poll() is None:
+                p.terminate()  # workers drain their buffers/replies on SIGTERM
+        deadline = time.monotonic() + timeout
+        for p in self.procs:
+            if p is None:
+                continue
+            try:
+                p.wait(max(deadline - time.monotonic(), 0.1))
+            except subprocess.TimeoutExpired:
+                log.warning("Shard pid %d did not stop in time, killing", p.pid)
+                p.kill()
+
+def run_front(token:str, shards:int, port:int, webhook_url:str, webhook_path:str, secret:str=None):
+    from telegram import Bot
+    workers = Workers(shards, bot.SHARD_PORT_BASE, bot.DB_PATH, secrets.token_hex(16))
+    workers.start()
+    front = Front(workers.urls, secret, workers.shard_secret, webhook_path, bot.METRICS_PATH)
+
+    async def main():
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        server = tornado.httpserver.HTTPServer(front.app())
+        server.listen(port, address="0.0.0.0")
+        watcher = asyncio.create_task(workers.watch())
+        async with Bot(token) as b:
+            await b.set_webhook(webhook_url, secret_token=secret, drop_pending_updates=bot.DROP_PENDING_UPDATES)
+        log.info("Front on :%d routing %s to %d shards", port, webhook_url, shards)
+        try:
+            await stop.wait()
+        finally:
+            watcher.cancel()
+            server.stop()
+            await front.close()
+
+    try:
+        asyncio.run(main())
+    finally:
+        workers.stop(bot.REPLY_DRAIN_TIMEOUT + 20)
+
+
+# ---- Rebalance / merge (offline: stop the bot first) ----
+COUNTER_TABLES = {  # table -> (key columns, counter columns)
+    "dice_counts": (("chat_id", "user_id", "value"), ("count",)),
+    "spin_totals": (("chat_id", "user_id"), ("spins", "triples")),
+    "rollup_hourly": (("chat_id", "bucket", "user_id", "value"), ("count",)),
+    "rollup_daily": (("chat_id", "bucket", "user_id", "value"), ("count",)),
+}
+
+def _open_shard(path:str) -> sqlite3.Connection:
+    pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+    c = sqlite3.connect(path, isolation_level=None)
+    c.execute("PRAGMA journal_mode=WAL")
+    c.executescript(bot.SCHEMA)
+    c.executescript(bot.INDEXES)
+    c.execute(f"PRAGMA user_version={bot.SCHEMA_VERSION}")
+    c.create_function("shard_of", 2, shard_of, deterministic=True)
+    return c
+
+def _check_source(path:str):
+    if not os.path.exists(path):
+        raise SystemExit(f"{path}: no such shard")
+    c = sqlite3.connect(f"{pathlib.Path(path).absolute().as_uri()}?mode=ro", uri=True)
+    try:
+        version = c.execute("PRAGMA user_version").fetchone()[0]
+        legacy = c.execute("SELECT COUNT(*) FROM sqlite_master WHERE name IN ('results','totals')").fetchone()[0]
+        logs = [r[0] for r in c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name GLOB 'spin_log_[0-9]*'")]
+    finally:
+        c.close()
+    if version != bot.SCHEMA_VERSION or legacy:
+        raise SystemExit(f"{path}: schema v{version}, start the bot on it once to migrate first")
+    return logs
+
+def rebalance(sources, targets, progress=None) -> dict:
+    """Copy every chat's rows from the `sources` shards into shard_of(chat_id, len(targets)).
+    Targets must not exist yet. -> rows written per table."""
+    for t in targets:
+        if os.path.exists(t):
+            raise SystemExit(f"{t} already exists, refusing to overwrite")
+    n = len(targets)
+    conns = [_open_shard(t) for t in targets]
+    written = {}
+    try:
+        for src in sources:
+            logs = _check_source(src)
+            for j, c in enumerate(conns):
+                c.execute("ATTACH DATABASE ? AS src", (src,))
+                try:
+                    c.execute("BEGIN")
+                    for table, (keys, counters) in COUNTER_TABLES.items():
+                        cols = ",".join(keys + counters)
+                        sets = ",".join(f"{k} = {k} + excluded.{k}" for k in counters)
+                        cur = c.execute(f"""
+                          INSERT INTO main.{table}({cols}) SELECT {cols} FROM src.{table}
+                          WHERE shard_of(chat_id, {n}) = {j}
+                          ON CONFLICT({",".join(keys)}) DO UPDATE SET {sets}""")
+                        written[table] = written.get(table, 0) + cur.rowcount
+                    for table in logs:
+                        c.execute(bot.SPIN_LOG_DDL.format(table=f"main.{table}"))
+                        cur = c.execute(f"INSERT INTO main.{table} SELECT ts, chat_id, user_id, value FROM src.{table} "
+                                        f"WHERE shard_of(chat_id, {n}) = {j}")
+                        written["spin_log"] = written.get("spin_log", 0) + cur.rowcount
+                    cur = c.execute(f"""
+                      INSERT INTO main.spin_marks(chat_id, message_id) SELECT chat_id, message_id FROM src.spin_marks
+                      WHERE shard_of(chat_id, {n}) = {j}
+                      ON CONFLICT(chat_id) DO UPDATE SET message_id = MAX(message_id, excluded.message_id)""")
+                    written["spin_marks"] = written.get("spin_marks", 0) + cur.rowcount
+                    cur = c.execute("""
+                      INSERT INTO main.users(user_id, name) SELECT user_id, name FROM src.users
+                      WHERE user_id IN (SELECT user_id FROM main.spin_totals)
+                      ON CONFLICT(user_id) DO NOTHING""")
+                    written["users"] = written.get("users", 0) + cur.rowcount
+                    c.execute("COMMIT")
+                finally:
+                    c.execute("DETACH DATABASE src")
+                if progress:
+                    progress(f"{src} -> {targets[j]}")
+    finally:
+        for c in conns:
+            c.close()
+    return written
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = p.add_subparsers(dest="cmd", required=True)
+    r = sub.add_parser("route", help="run only the front router against already running workers")
+    r.add_argument("--workers", nargs="+", required=True, help="worker base URLs, shard order")
+    r.add_argument("--port", type=int, default=bot.PORT)
+    r.add_argument("--path", default="/telegram")
+    r.add_argument("--shard-secret", default=os.getenv("SHARD_SECRET", ""))
+    for name, helptext in (("rebalance", "re-split shards for a new shard count"), ("merge", "merge shards into one DB")):
+        s = sub.add_parser(name, help=helptext)
+        s.add_argument("--db", default=bot.DB_PATH, help="DB_PATH the shards were named after")
+        s.add_argument("--from", dest="src", type=int, required=True, help="current shard count (1 = DB_PATH itself)")
+        if name == "rebalance":
+            s.add_argument("--to", type=int, required=True, help="new shard count")
+        s.add_argument("--out", required=True, help="DB_PATH for the new layout (files must not exist)")
+    args = p.parse_args(argv)
+
+    if args.cmd == "route":
+        front = Front(args.workers, shard_secret=args.shard_secret, webhook_path=args.path)
+
+        async def serve():
+            server = tornado.httpserver.HTTPServer(front.app())
+            server.listen(args.port)
+            log.info("Routing :%d%s to %d workers", args.port, args.path, len(args.workers))
+            try:
+                await asyncio.Event().wait()
+            finally:
+                server.stop()
+                await front.close()
+        asyncio.run(serve())
+        return
+    to = args.to if args.cmd == "rebalance" else 1
+    written = rebalance(shard_paths(args.db, args.src), shard_paths(args.out, to), progress=log.info)
+    log.info("Wrote %s", written)
+    return written
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Minimal in-process metrics rendered in the Prometheus text format (0.0.4).
+
+No client library: a counter is a float, a histogram is a list of bucket counts plus
+sum/count, each child guarded by its own lock (SQLite timings are recorded from the
+writer/reader threads). Recording costs a dict lookup, a bisect and a lock round-trip,
+well under a microsecond, so it stays on all the time.
+
+  REQS = Counter("app_requests_total", "Requests.", ("method",))
+  REQS.labels("sendMessage").inc()
+  LAT = Histogram("app_seconds", "Latency.", ("handler",))
+  LAT.labels("on_dice").observe(0.0012)
+  Sampled("app_queue_depth", "Queued items.", lambda: len(q))   # read at scrape time
+  text = REGISTRY.render()
+"""
+import bisect, threading
+
+DEFAULT_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric  # same name again (module reload) replaces it
+        return metric
+
+    def render(self) -> str:
+        out = []
+        for m in list(self._metrics.values()):
+            out.append(f"# HELP {m.name} {m.help}")
+            out.append(f"# TYPE {m.name} {m.kind}")
+            out.extend(m.samples())
+        return "\n".join(out) + "\n"
+
+REGISTRY = Registry()
+
+
+def _escape(v) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names, values, extra:str="") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _num(v) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class _Family:
+    kind = "untyped"
+
+    def __init__(self, name:str, help:str, labelnames=(), registry:Registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def __getattr__(self, attr):
+        # unlabelled families forward inc()/observe() to their single child
+        if attr.startswith("_"):
+            raise AttributeError(attr)
+        return getattr(self.labels(), attr)
+
+
+class _CounterChild:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self._lock:
+            self.value += n
+
+
+class Counter(_Family):
+    kind = "counter"
+    _new_child = _CounterChild
+
+    def samples(self):
+        for values, child in list(self._children.items()):
+            yield f"{self.name}{_labels(self.labelnames, values)} {_num(child.value)}"
+
+
+class _HistogramChild:
+    __slots__ = ("bounds", "counts", "sum", "count", "_lock")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, v:float):
+        i = bisect.bisect_left(self.bounds, v)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += v
+            self.count += 1
+
+
+class Histogram(_Family):
+    kind = "histogram"
+
+    def __init__(self, name:str, help:str, labelnames=(), buckets=DEFAULT_BUCKETS, registry:Registry=REGISTRY):
+        self.bounds = tuple(sorted(buckets))
+        super().__init__(name, help, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramChild(self.bounds)
+
+    def samples(self):
+        for values, child in list(self._children.items()):
+            with child._lock:
+                counts, total, count = list(child.counts), child.sum, child.count
+            acc = 0
+            for bound, n in zip(self.bounds + (float("inf"),), counts):
+                acc += n
+                le = 'le="%s"' % _num(bound)
+                yield f"{self.name}_bucket{_labels(self.labelnames, values, le)} {acc}"
+            yield f"{self.name}_sum{_labels(self.labelnames, values)} {_num(total)}"
+            yield f"{self.name}_count{_labels(self.labelnames, values)} {count}"
+
+
+class Sampled:
+    """A gauge or counter whose value is read from `fn` at scrape time. With labelnames,
+    fn returns {label values tuple: value}."""
+    def __init__(self, name:str, help:str, fn, labelnames=(), kind:str="gauge", registry:Registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.fn = fn
+        self.labelnames = tuple(labelnames)
+        if registry is not None:
+            registry.register(self)
+
+    def samples(self):
+        try:
+            v = self.fn()
+        except Exception:
+            return
+        items = v.items() if self.labelnames else [((), v)]
+        for values, n in items:
+            yield f"{self.name}{_labels(self.labelnames, values)} {_num(n)}"
+
+
+# ---- HTTP exposition (tornado ships with python-telegram-bot[webhooks]) ----
+def metrics_handler(registry:Registry=REGISTRY):
+    import tornado.web
+
+    class MetricsHandler(tornado.web.RequestHandler):
+        def get(self):
+            self.set_header("Content-Type", CONTENT_TYPE)
+            self.finish(registry.render())
+
+    return MetricsHandler
+
+def probe_handler(check):
+    """200 "ok" while check() is true, else 503: a readiness probe served next to the metrics."""
+    import tornado.web
+
+    class ProbeHandler(tornado.web.RequestHandler):
+        def get(self):
+            ok = check()
+            self.set_status(200 if ok else 503)
+            self.finish("ok\n" if ok else "starting\n")
+
+    return ProbeHandler
+
+def serve(port:int, path:str="/metrics", registry:Registry=REGISTRY, address:str="0.0.0.0", routes=()):
+    """Starts a standalone server on the running loop; call .stop() on the result to close it."""
+    import tornado.httpserver, tornado.web
+    server = tornado.httpserver.HTTPServer(tornado.web.Application([(path, metrics_handler(registry)), *routes]))
+    server.listen(port, address=address)
+    return server
@@ -0,0 +1,92 @@
+import asyncio
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import bot
+
+
+class DummyMessage:
+    """A chat message: a 🎰 roll if value is given; replies are collected in `sent`."""
+    def __init__(self, value=None, age=0.0):
+        self.dice = SimpleNamespace(emoji="🎰", value=value) if value else None
+        self.date = datetime.now(timezone.utc) - timedelta(seconds=age)
+        self.sent = []
+
+    async def reply_text(self, text, **kwargs):
+        self.sent.append(text)
+
+
+def _make_update(chat_id, user_id=0, name="viewer", value=None, age=0.0):
+    m = DummyMessage(value, age)
+    return SimpleNamespace(
+        effective_message=m,
+        message=m,
+        effective_user=SimpleNamespace(id=user_id, full_name=name, username=None),
+        effective_chat=SimpleNamespace(id=chat_id),
+    )
+
+
+async def _spin(chat_id, user_id, name, value):
+    await bot.on_dice(_make_update(chat_id, user_id, name, value), None)
+
+
+async def _stats(chat_id, *args):
+    """/stats [args] in the chat -> the reply, once send_queue has delivered it."""
+    u = _make_update(chat_id)
+    await bot.cmd_stats(u, SimpleNamespace(args=list(args)))
+    while not u.message.sent:  # replies are queued, not awaited
+        await asyncio.sleep(0.01)
+    return u.message.sent[-1]
+
+
+@pytest.fixture
+def make_update():
+    return _make_update
+
+
+@pytest.fixture
+def spin():
+    return _spin
+
+
+@pytest.fixture
+def stats():
+    return _stats
+
+
+def _fresh_singletons(monkeypatch):
+    monkeypatch.setattr(bot, "_storage", None)
+    monkeypatch.setattr(bot, "_storage_opening", None)
+    monkeypatch.setattr(bot, "counter_store", None)
+    monkeypatch.setattr(bot, "spin_buffer", bot.SpinBuffer(interval=60, max_pending=1000))
+    monkeypatch.setattr(bot, "spin_dedupe", bot.SpinDedupe(max_recent=100))
+    monkeypatch.setattr(bot, "stats_cache", bot.StatsCache(10, spin_staleness=60))
+    monkeypatch.setattr(bot, "display_names", bot.DisplayNames(bot.DISPLAY_NAMES_MAX))
+    monkeypatch.setattr(bot, "reply_scheduler", bot.ReplyScheduler())
+    monkeypatch.setattr(bot, "send_queue", bot.SendQueue(rate=1000, chat_rate=1000, chat_burst=10))
+    return bot.spin_buffer
+
+
+@pytest.fixture
+def fresh_db(monkeypatch, tmp_path):
+    """bot on a new DB in tmp_path, with new copies of every module-level object that
+    holds state about it (buffers, caches, queues) -> the SpinBuffer. The DB is closed
+    after the test."""
+    monkeypatch.setattr(bot, "DB_PATH", str(tmp_path / "stats.sqlite3"))
+    yield _fresh_singletons(monkeypatch)
+    bot.close_storage()
+
+
+@pytest.fixture
+def restart(monkeypatch, fresh_db):
+    """-> restart(): close the DB and start over with new singletons, as the bot does
+    after a restart; returns the new SpinBuffer."""
+    def restart():
+        bot.close_storage()
+        return _fresh_singletons(monkeypatch)
+    return restart
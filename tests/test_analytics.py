@@ -0,0 +1,61 @@
+import asyncio
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import analytics
+import bot
+
+
+def test_wilson_interval():
+    lo, hi = analytics.wilson(1, 1)
+    assert 0.2 < lo < 0.21 and hi == pytest.approx(1)
+    lo, hi = analytics.wilson(50, 800)
+    assert lo < 50 / 800 < hi and hi - lo < 0.04
+    assert analytics.deviation(50, 800) == pytest.approx(0)
+
+
+def test_rank_prefers_evidence_over_lucky_streaks(tmp_path):
+    storage = bot.Storage(str(tmp_path / "stats.sqlite3")).open()
+    try:
+        # 1: one lucky spin; 2: 20% over 1000 spins in two chats; 3: 30% of 10; 4: below 4/64
+        spins = [(1, 1, 1, 1), (1, 2, 300, 60), (2, 2, 700, 140), (2, 3, 10, 3), (2, 4, 1000, 40)]
+        counts = [(1, 1, 64, 1), (1, 2, 64, 60), (1, 2, 3, 240), (2, 2, 22, 140), (2, 2, 5, 560),
+                  (2, 3, 1, 3), (2, 3, 7, 7), (2, 4, 43, 40), (2, 4, 2, 960)]
+        storage.submit_write(bot.write_spin_batch, counts, spins, [], [], 1).result()
+        board, odds = storage.submit_write(bot.sql_global_analysis, 5, 10).result()
+    finally:
+        storage.close()
+    assert [r[:3] for r in board] == [(2, 1000, 200), (3, 10, 3), (4, 1000, 40)]
+    assert board[0][5] > 4 and board[2][5] < -2
+    assert len(odds) == 64 and sum(o[1] for o in odds) == 2011
+    assert odds[63][:3] == (64, 61, pytest.approx(2011 / 64))
+
+
+def test_global_command_reads_materialized_board(monkeypatch, fresh_db):
+    monkeypatch.setattr(bot, "GLOBAL_MIN_SPINS", 10)
+    sent = []
+
+    async def reply(update, text, **kwargs):
+        sent.append(text)
+    monkeypatch.setattr(bot, "reply", reply)
+
+    async def run():
+        storage = bot.get_storage()
+        await bot.cmd_global(SimpleNamespace(effective_message=None), None)
+        await storage.write(bot.write_spin_batch, [(1, 7, 64, 3), (1, 8, 64, 1)], [(1, 7, 20, 3), (1, 8, 30, 1)],
+                            [(7, "<Alice>"), (8, "Bob")], [], 1)
+        job = asyncio.create_task(bot.global_luck_job(3600, 10, 5))
+        while storage.writes < 2:  # the batch, then the board
+            await asyncio.sleep(0.01)
+        job.cancel()
+        await bot.cmd_global(SimpleNamespace(effective_message=None), None)
+
+    asyncio.run(run())
+    assert "No one has 10 spins" in sent[0]
+    text = sent[1]
+    assert text.index("1. &lt;Alice&gt;") < text.index("2. Bob")
+    assert "(3/20)" in text and "7️⃣7️⃣7️⃣ 4 / 0.1" in text
@@ -0,0 +1,34 @@
+import json
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import bench
+import bot
+
+
+def test_synth_record_and_replay(monkeypatch, tmp_path):
+    for name in ("DB_PATH", "_storage", "spin_buffer", "stats_cache", "reply_scheduler", "send_queue"):
+        monkeypatch.setattr(bot, name, getattr(bot, name))
+    rec = tmp_path / "updates.jsonl"
+    first = bench.main(["synth", "--chats", "3", "--users", "4", "--updates", "300",
+                        "--record", str(rec), "--db", str(tmp_path / "a.sqlite3")])
+    assert first["updates"] == 300
+    assert sum(h["count"] for h in first["handlers"].values()) == 300
+    assert first["db"]["commits"] >= 1 and first["db"]["bytes_after"] > first["db"]["bytes_before"]
+
+    out = tmp_path / "result.json"
+    second = bench.main(["replay", str(rec), "--db", str(tmp_path / "b.sqlite3"), "--out", str(out)])
+    assert json.loads(out.read_text())["handlers"] == second["handlers"]
+    assert {k: v["count"] for k, v in second["handlers"].items()} == \
+           {k: v["count"] for k, v in first["handlers"].items()}
+
+
+def test_micro_outcome_table_matches_old_path():
+    user, cases = bench.micro_messages()
+    for msgs in cases.values():
+        for m in msgs:
+            assert bench.classify_after(m, user) == bench.classify_before(m, user)
+    result = bench.main(["micro", "--loops", "200"])
+    assert set(result["cases"]) == {"spin", "reject_other_dice", "reject_forward", "render"}
+    assert result["cases"]["reject_forward"]["after_peak_bytes"] == 0
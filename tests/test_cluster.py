@@ -0,0 +1,185 @@
+import asyncio
+import json
+import os
+import sqlite3
+import sys
+
+import httpx
+import tornado.httpserver
+import tornado.netutil
+import tornado.web
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import bot
+import cluster
+
+
+def message_update(update_id, chat_id, user_id=1, value=64):
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": 1_760_000_000,
+        "chat": {"id": chat_id, "type": "group", "title": "g"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "U"},
+        "dice": {"emoji": "🎰", "value": value}}}
+
+
+def test_chat_of_and_shard_of():
+    assert cluster.chat_of(message_update(1, -100123)) == -100123
+    assert cluster.chat_of({"update_id": 2, "callback_query": {"id": "x", "from": {"id": 7},
+                                                               "message": {"chat": {"id": -5}}}}) == -5
+    assert cluster.chat_of({"update_id": 3, "inline_query": {"id": "q", "from": {"id": 9}}}) == 9
+    shards = {cluster.shard_of(c, 4) for c in range(-1000, 0)}
+    assert shards == {0, 1, 2, 3}
+    assert cluster.shard_of(-100123, 4) == cluster.shard_of(-100123, 4)
+    assert cluster.shard_paths("/data/stats.sqlite3", 2) == ["/data/stats.shard0.sqlite3", "/data/stats.shard1.sqlite3"]
+    assert cluster.shard_paths("/data/stats.sqlite3", 1) == ["/data/stats.sqlite3"]
+
+
+class FakeWorker(tornado.web.RequestHandler):
+    def initialize(self, got):
+        self.got = got
+
+    def post(self):
+        assert self.request.headers[cluster.SHARD_SECRET_HEADER] == "s3"
+        self.got.append(json.loads(self.request.body)["message"]["chat"]["id"])
+
+    def get(self):
+        self.finish("# HELP x_total X.\n# TYPE x_total counter\nx_total{k=\"v\"} 2\n")
+
+
+def listen(app):
+    server = tornado.httpserver.HTTPServer(app)
+    [sock] = tornado.netutil.bind_sockets(0, "127.0.0.1")
+    server.add_sockets([sock])
+    return server, f"http://127.0.0.1:{sock.getsockname()[1]}"
+
+
+def test_front_routes_fake_updates_by_chat():
+    got = [[], []]
+
+    async def run():
+        workers = [listen(tornado.web.Application([(r"/.*", FakeWorker, {"got": g})])) for g in got]
+        front = cluster.Front([url for _, url in workers], secret="tg", shard_secret="s3", webhook_path="/hook")
+        server, url = listen(front.app())
+        chats = list(range(-120, -100))
+        try:
+            async with httpx.AsyncClient() as client:
+                for i, chat in enumerate(chats):
+                    r = await client.post(url + "/hook", json=message_update(i, chat),
+                                          headers={cluster.TELEGRAM_SECRET_HEADER: "tg"})
+                    assert r.status_code == 200
+                r = await client.post(url + "/hook", json=message_update(99, -1))
+                assert r.status_code == 403
+                text = (await client.get(url + "/metrics")).text
+        finally:
+            server.stop()
+            for s, _ in workers:
+                s.stop()
+            await front.close()
+        return chats, text
+
+    chats, text = asyncio.run(run())
+    for shard, seen in enumerate(got):
+        assert seen == [c for c in chats if cluster.shard_of(c, 2) == shard]
+    assert 'x_total{shard="0",k="v"} 2' in text and 'x_total{shard="1",k="v"} 2' in text
+    assert text.count("# TYPE x_total counter") == 1
+    assert 'ludooman_front_updates_total{shard="0",result="ok"}' in text
+
+
+def test_worker_endpoint_feeds_update_queue():
+    from telegram.ext import Application
+    app = Application.builder().token("1:fake").build()
+
+    async def run():
+        server, url = listen(cluster.worker_app(app, "s3"))
+        try:
+            async with httpx.AsyncClient() as client:
+                bad = await client.post(url + cluster.WORKER_UPDATE_PATH, json=message_update(1, -7))
+                ok = await client.post(url + cluster.WORKER_UPDATE_PATH, json=message_update(1, -7),
+                                       headers={cluster.SHARD_SECRET_HEADER: "s3"})
+        finally:
+            server.stop()
+        return bad.status_code, ok.status_code, app.update_queue.get_nowait()
+
+    bad, ok, update = asyncio.run(run())
+    assert (bad, ok) == (403, 200)
+    assert update.effective_chat.id == -7 and update.effective_message.dice.value == 64
+
+
+def test_webhook_port_serves_metrics_and_ready(monkeypatch):
+    from telegram.ext import Application
+    app = Application.builder().token("1:fake").build()
+    monkeypatch.setattr(bot, "startup", bot.StartupLog())
+
+    async def run():
+        server, url = listen(cluster.webhook_app(app, "/hook", "tg"))
+        try:
+            async with httpx.AsyncClient() as client:
+                bad = await client.post(url + "/hook", json=message_update(1, -7))
+                ok = await client.post(url + "/hook", json=message_update(1, -7),
+                                       headers={cluster.TELEGRAM_SECRET_HEADER: "tg"})
+                starting = await client.get(url + bot.READY_PATH)
+                bot.startup.ready = True
+                up = await client.get(url + bot.READY_PATH)
+                scrape = await client.get(url + bot.METRICS_PATH)
+        finally:
+            server.stop()
+        return (bad.status_code, ok.status_code, starting.status_code, up.status_code, scrape.status_code,
+                app.update_queue.get_nowait())
+
+    *codes, update = asyncio.run(run())
+    assert codes == [403, 200, 503, 200, 200]
+    assert update.effective_chat.id == -7
+
+
+def make_shard(path, spins):
+    c = cluster._open_shard(path)
+    counts, totals, names, events = {}, {}, {}, []
+    for ts, chat, uid, value in spins:
+        counts[(chat, uid, value)] = counts.get((chat, uid, value), 0) + 1
+        s, t = totals.get((chat, uid), (0, 0))
+        totals[(chat, uid)] = (s + 1, t + (value in bot.TRIPLE_SET))
+        names[uid] = f"user{uid}"
+        events.append((ts, chat, uid, value))
+    bot.write_spin_batch(c, [(*k, n) for k, n in counts.items()], [(*k, *v) for k, v in totals.items()],
+                         list(names.items()), events, 1)
+    c.close()
+
+
+def dump(paths):
+    rows = {}
+    for p in paths:
+        c = sqlite3.connect(p)
+        for chat, uid, value, n in c.execute("SELECT chat_id, user_id, value, count FROM dice_counts"):
+            rows[(chat, uid, value)] = rows.get((chat, uid, value), 0) + n
+        c.close()
+    return rows
+
+
+def test_rebalance_and_merge(tmp_path):
+    ts = 1_760_000_000
+    spins = [(ts + i, -100 - i % 7, i % 5, (64, 22, 3, 17)[i % 4]) for i in range(200)]
+    old = cluster.shard_paths(str(tmp_path / "old.sqlite3"), 2)
+    for j, p in enumerate(old):
+        make_shard(p, [s for s in spins if cluster.shard_of(s[1], 2) == j])
+    before = dump(old)
+
+    new = cluster.shard_paths(str(tmp_path / "new.sqlite3"), 3)
+    written = cluster.main(["rebalance", "--db", str(tmp_path / "old.sqlite3"), "--from", "2", "--to", "3",
+                            "--out", str(tmp_path / "new.sqlite3")])
+    assert written["spin_log"] == 200
+    assert dump(new) == before
+    for j, p in enumerate(new):
+        c = sqlite3.connect(p)
+        chats = {r[0] for r in c.execute("SELECT chat_id FROM spin_totals")}
+        chats |= {r[0] for r in c.execute("SELECT chat_id FROM rollup_daily")}
+        assert all(cluster.shard_of(chat, 3) == j for chat in chats)
+        names = dict(c.execute("SELECT user_id, name FROM users"))
+        assert all(names[uid] == f"user{uid}" for (uid,) in c.execute("SELECT user_id FROM spin_totals"))
+        c.close()
+
+    merged = str(tmp_path / "merged.sqlite3")
+    cluster.main(["merge", "--db", str(tmp_path / "new.sqlite3"), "--from", "3", "--out", merged])
+    assert dump([merged]) == before
+    c = sqlite3.connect(merged)
+    assert c.execute("SELECT SUM(spins), SUM(triples) FROM spin_totals").fetchone() == (200, 100)
+    c.close()
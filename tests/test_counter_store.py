@@ -0,0 +1,120 @@
+import asyncio
+import os
+import random
+import sys
+import threading
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import bot
+
+
+def test_add_get_and_grow(tmp_path):
+    store = bot.CounterStore(str(tmp_path / "c.counters"), capacity=8)
+    assert not store.open(1, 0)  # no file yet
+    store._create(store.min_capacity, 1)
+    rng = random.Random(7)
+    expected = {}
+    for _ in range(3000):
+        key, value = (-100 - rng.randrange(3), rng.randrange(1, 40)), rng.randrange(1, 65)
+        store.add(*key, value)
+        expected.setdefault(key, {}).setdefault(value, 0)
+        expected[key][value] += 1
+    assert store.grown >= 3 and store.capacity >= 64 and store.used == len(expected)
+    for key, counts in expected.items():
+        rows, spins = store.get(*key)
+        assert dict(rows) == counts and spins == sum(counts.values())
+        assert [n for _, n in rows] == sorted(counts.values(), reverse=True)
+    assert store.get(-100, 999) == ([], 0)
+    store.close()
+
+
+def test_slots_do_not_depend_on_python_hash():
+    # part of the file layout: a different value needs a new MAGIC
+    assert bot.CounterStore._mix(-1001234567890, 42) == 16022918451663918359
+
+
+def test_grow_copies_on_a_thread(tmp_path):
+    store = bot.CounterStore(str(tmp_path / "c.counters"), capacity=8)
+    store._create(store.min_capacity, 1)
+    gate = threading.Event()
+    copy = store._copy
+
+    def slow_copy(capacity):
+        gate.wait(5)
+        copy(capacity)
+
+    store._copy = slow_copy
+
+    async def run():
+        for uid in range(1, 6):
+            store.add(-1, uid, 64)
+        store.add(-1, 6, 1)  # over LOAD: returns while the copy waits
+        assert store._growing is not None and store.capacity == 8
+        store.add(-1, 6, 1)
+        store.add(-1, 1, 3)
+        assert store.get(-1, 6) == ([(1, 2)], 2)
+        assert sorted(store.get(-1, 1)[0]) == [(3, 1), (64, 1)]
+        gate.set()
+        while store._growing is not None:
+            await asyncio.sleep(0.01)
+        assert store.capacity == 16 and store.grown == 1 and store._journal is None
+        assert store.get(-1, 6) == ([(1, 2)], 2)
+        assert sorted(store.get(-1, 1)[0]) == [(3, 1), (64, 1)]
+
+        gate.clear()
+        for uid in range(7, 13):
+            store.add(-1, uid, 22)
+        assert store._growing is not None
+        gate.set()
+        store.close(9)  # waits for the copy and keeps the journaled spins
+
+    asyncio.run(run())
+    assert store.open(1, 9)
+    assert store.capacity == 32 and store.used == 12
+    assert store.get(-1, 12) == ([(22, 1)], 1) and store.get(-1, 6) == ([(1, 2)], 2)
+    store.close()
+
+
+def test_mystats_from_counter_file(monkeypatch, tmp_path, fresh_db):
+    storage = bot.get_storage()
+    monkeypatch.setattr(bot, "counter_store", bot.open_counter_store(storage))
+    path = bot.counter_store.path
+    assert path == str(tmp_path / "stats.counters")
+
+    async def run():
+        for msg_id, (uid, value) in enumerate([(10, 64), (10, 64), (10, 3), (20, 1)], 1):
+            assert bot.upsert_result(1, uid, "u", value, message_id=msg_id)
+        assert not bot.upsert_result(1, 10, "u", 64, message_id=1)  # redelivered: not counted twice
+        assert await bot.fetch_user_stats(1, 10) == ([(64, 2), (3, 1)], 3)  # not flushed yet
+        await bot.spin_buffer.close()
+        _, sql = await storage.read(bot.sql_user_stats, 1, 10)
+        assert sql == ([(64, 2), (3, 1)], 3)
+
+    asyncio.run(run())
+    bot.close_storage()  # every spin committed: file closed clean
+    assert bot.counter_store is None
+
+    storage = bot.get_storage()
+    store = bot.CounterStore(path)
+    assert store.open(storage.data_gen, storage.flush_seq)
+    assert store.get(1, 20) == ([(1, 1)], 1)
+    store.add(1, 20, 1)
+    store.close()  # no flush_seq: left dirty, as after a crash
+    assert not store.open(storage.data_gen, storage.flush_seq)
+    storage.submit_write(store.rebuild, storage.data_gen).result()
+    assert store.get(1, 20) == ([(1, 1)], 1)
+    store.close(storage.flush_seq)
+
+    # an import changes the counters behind the file's back
+    storage.submit_write(bot.write_import_batch, "import:x", 0, [(1, 20, 64, 5)], [(1, 20, 5, 5)],
+                         [], [], 0, 0).result()
+    storage.close()
+    storage = bot.Storage(bot.DB_PATH).open()
+    try:
+        assert not store.open(storage.data_gen, storage.flush_seq)
+        bot.counters_main(["rebuild"])
+        assert store.open(storage.data_gen, storage.flush_seq)
+        assert store.get(1, 20) == ([(64, 5), (1, 1)], 6)
+        store.close()
+    finally:
+        storage.close()
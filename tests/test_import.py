@@ -0,0 +1,172 @@
+import asyncio
+import json
+import os
+import shutil
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import bot
+
+T0 = 1_700_000_000
+
+
+def write_export(path, n=300):
+    msgs = [{"id": 1, "type": "service", "date_unixtime": str(T0), "action": "create_group", "actor": "Zoë"}]
+    for i in range(n):
+        m = {"id": i + 2, "type": "message", "date_unixtime": str(T0 + i), "from": f"Юзер {i % 3} \"q\"",
+             "from_id": f"user{100 + i % 3}", "text": "🎰 ]}{,\"messages\": ["}
+        if i % 2:
+            m.update(media_type="dice", dice_emoji="🎰", dice_value=(64, 22, 5, 17)[i % 4])
+        elif i % 10 == 0:
+            m.update(dice={"emoji": "🎰", "value": 1}, date="2023-11-14T22:13:20")
+            del m["date_unixtime"]
+        if i % 50 == 7:
+            m["forwarded_from"] = "Someone"
+        if i % 70 == 3:
+            m["dice_emoji"] = "🎲"
+        msgs.append(m)
+    doc = {"name": "Casino \"messages\": [", "type": "private_supergroup", "id": 1234567890, "messages": msgs}
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(doc, f, ensure_ascii=False, indent=1)
+    return [s for s in map(bot.export_spin, msgs) if s]
+
+
+def totals(db):
+    c = sqlite3.connect(db)
+    try:
+        return (c.execute("SELECT user_id, value, count FROM dice_counts ORDER BY 1, 2").fetchall(),
+                c.execute("SELECT user_id, spins, triples FROM spin_totals ORDER BY 1").fetchall(),
+                c.execute("SELECT SUM(count) FROM rollup_daily").fetchone()[0])
+    finally:
+        c.close()
+
+
+def test_reader_streams_with_small_chunks(tmp_path):
+    path = tmp_path / "result.json"
+    expected = write_export(path, 120)
+    r = bot.ExportReader(str(path), chunk=37)
+    assert r.header == {"type": "private_supergroup", "id": 1234567890}
+    got, offsets = [], []
+    for msg in r:
+        got.append(msg)
+        offsets.append(r.offset())
+    r.close()
+    assert len(got) == 121 and [s for s in map(bot.export_spin, got) if s] == expected
+    # resuming at any recorded offset yields exactly the remaining messages
+    r = bot.ExportReader(str(path), offsets[60], chunk=53)
+    assert [m["id"] for m in r] == [m["id"] for m in got[61:]]
+    r.close()
+
+
+def test_reader_resumes_in_crlf_export(tmp_path):
+    path = tmp_path / "result.json"
+    expected = write_export(path, 40)
+    path.write_bytes(path.read_bytes().replace(b"\n", b"\r\n"))  # saved on Windows
+    r = bot.ExportReader(str(path), chunk=29)
+    got, offsets = [], []
+    for msg in r:
+        got.append(msg)
+        offsets.append(r.offset())
+    r.close()
+    assert [s for s in map(bot.export_spin, got) if s] == expected
+    for i in (0, 17, 39):
+        r = bot.ExportReader(str(path), offsets[i], chunk=31)
+        assert [m["id"] for m in r] == [m["id"] for m in got[i + 1:]]
+        r.close()
+
+
+def test_export_spin_filters():
+    base = {"type": "message", "date_unixtime": str(T0), "from": "A", "from_id": "user5",
+            "dice_emoji": "🎰", "dice_value": 64}
+    assert bot.export_spin(base) == (T0, 5, "A", 64)
+    assert bot.export_spin({**base, "forwarded_from": None}) is None
+    assert bot.export_spin({**base, "dice_emoji": "🎲"}) is None
+    assert bot.export_spin({**base, "from_id": "channel5"}) is None
+    assert bot.export_spin({**base, "dice_value": 65}) is None
+    assert bot.export_chat_id("private_supergroup", 1234567890) == -1001234567890
+    assert bot.export_chat_id("private_group", 42) == -42
+
+
+def test_import_resumes_after_interruption(monkeypatch, tmp_path):
+    path = tmp_path / "result.json"
+    expected = write_export(path)
+    ref_db = str(tmp_path / "ref.sqlite3")
+    monkeypatch.setattr(bot, "DB_PATH", ref_db)
+    res = bot.import_main([str(path), "--batch", "20"])
+    assert res["spins"] == len(expected) and res["chat_id"] == -1001234567890
+    reference = totals(ref_db)
+    assert sum(n for _, _, n in reference[0]) == len(expected)
+    assert bot.import_main([str(path)])["spins"] == 0  # already done
+
+    db = str(tmp_path / "stats.sqlite3")
+    monkeypatch.setattr(bot, "DB_PATH", db)
+    real = bot.write_import_batch
+    calls = []
+
+    def crashing(c, *args):
+        calls.append(1)
+        if len(calls) == 3:
+            raise RuntimeError("disk on fire")
+        return real(c, *args)
+
+    monkeypatch.setattr(bot, "write_import_batch", crashing)
+    with pytest.raises(RuntimeError):
+        bot.import_export(str(path), batch=20)
+    monkeypatch.setattr(bot, "write_import_batch", real)
+    res = bot.import_export(str(path), batch=20)
+    assert res["resumed"] and 0 < res["spins"] < len(expected)
+    assert totals(db) == reference
+
+
+def test_import_stops_where_live_counting_began(fresh_db, tmp_path):
+    path = tmp_path / "result.json"
+    expected = write_export(path)
+    db = bot.DB_PATH
+    live_from = T0 + 200
+    bot.upsert_result(-1001234567890, 100, "Live", 64, live_from)
+    bot.spin_buffer.flush()
+    bot.close_storage()
+    res = bot.import_export(str(path))
+    before = [s for s in expected if s[0] < live_from]
+    assert res["spins"] == len(before) and res["skipped"] == len(expected) - len(before)
+    assert sum(spins for _, spins, _ in totals(db)[1]) == len(before) + 1
+
+
+def test_import_into_migrated_chat_needs_until(monkeypatch, tmp_path):
+    path = tmp_path / "result.json"
+    expected = write_export(path)
+    db = str(tmp_path / "stats.sqlite3")
+    c = sqlite3.connect(db)
+    c.executescript("""
+    CREATE TABLE results(chat_id INTEGER NOT NULL, user_id INTEGER NOT NULL, username TEXT,
+        combo TEXT NOT NULL, count INTEGER NOT NULL DEFAULT 0, PRIMARY KEY(chat_id, user_id, combo));
+    CREATE TABLE totals(chat_id INTEGER NOT NULL, user_id INTEGER NOT NULL,
+        spins INTEGER NOT NULL DEFAULT 0, PRIMARY KEY(chat_id, user_id));
+    INSERT INTO results VALUES(-1001234567890, 100, 'Old', 'seven|seven|seven', 3);
+    INSERT INTO totals VALUES(-1001234567890, 100, 3);
+    """)
+    c.commit()
+    c.close()
+    monkeypatch.setattr(bot, "DB_PATH", db)
+    with pytest.raises(SystemExit, match="still being migrated"):
+        bot.import_export(str(path))
+    storage = bot.Storage(db).open()
+    try:
+        asyncio.run(bot.migrate_v2(storage, 100))
+    finally:
+        storage.close()
+    assert totals(db)[1] == [(100, 3, 3)]
+
+    with pytest.raises(SystemExit, match="--until"):
+        bot.import_export(str(path))
+    assert totals(db)[1] == [(100, 3, 3)]  # nothing added on top
+    forced = str(tmp_path / "forced.sqlite3")
+    shutil.copy(db, forced)
+    res = bot.import_export(str(path), until=T0 + 100)
+    assert res["spins"] == len([s for s in expected if s[0] < T0 + 100])
+    monkeypatch.setattr(bot, "DB_PATH", forced)
+    assert bot.import_export(str(path), force=True)["spins"] == len(expected)
+    assert sum(spins for _, spins, _ in totals(forced)[1]) == len(expected) + 3
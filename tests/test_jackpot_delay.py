@@ -27,16 +27,16 @@ def test_jackpot_delay_env(monkeypatch):
 
     captured = {}
 
-    async def fake_sleep(delay):
+    def fake_schedule(chat_id, message, text, delay, kind="delayed"):
         captured['delay'] = delay
+        captured['kind'] = kind
 
-    orig_sleep = asyncio.sleep
-    asyncio.sleep = fake_sleep
+    bot.reply_scheduler.schedule = fake_schedule
     try:
         asyncio.run(bot.on_dice(update, context))
     finally:
-        asyncio.sleep = orig_sleep
         monkeypatch.delenv("JACKPOT_DELAY", raising=False)
         importlib.reload(bot)
 
     assert captured['delay'] == 2.5
+    assert captured['kind'] == "jackpot"
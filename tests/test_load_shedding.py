@@ -0,0 +1,74 @@
+import asyncio
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import bot
+
+
+def make_shedder(monkeypatch, backlog):
+    shedder = bot.LoadShedder([5, 15, 30, 60], [100, 200, 300, 400], recover_after=10, flush_stretch=5,
+                              backlog=lambda: backlog[0])
+    monkeypatch.setattr(bot, "load_shedder", shedder)
+    return shedder
+
+
+def test_levels_follow_lag_and_backlog(monkeypatch, fresh_db):
+    backlog = [0]
+    shedder = make_shedder(monkeypatch, backlog)
+    shedder.observe_lag(3)
+    shedder.tick(0)
+    assert shedder.level == bot.SHED_NORMAL
+
+    shedder.observe_lag(20)
+    shedder.observe_lag(1)  # the worst lag of the tick counts
+    shedder.tick(1)
+    assert shedder.level == bot.SHED_STALE_STATS
+    assert bot.spin_buffer.stretch == 1
+
+    backlog[0] = 450
+    shedder.tick(2)
+    assert shedder.level == bot.SHED_COUNT_ONLY
+    assert bot.spin_buffer.stretch == 5
+
+
+def test_recovers_one_level_at_a_time(monkeypatch, fresh_db):
+    backlog = [300]
+    shedder = make_shedder(monkeypatch, backlog)
+    shedder.tick(0)
+    assert shedder.level == bot.SHED_SLOW_FLUSH
+
+    backlog[0] = 0
+    shedder.tick(5)
+    assert shedder.level == bot.SHED_SLOW_FLUSH  # not calm for long enough yet
+    shedder.tick(10)
+    assert shedder.level == bot.SHED_STALE_STATS
+    assert bot.spin_buffer.stretch == 1
+    shedder.tick(15)
+    assert shedder.level == bot.SHED_STALE_STATS
+    for now in (20, 30, 40):
+        shedder.tick(now)
+    assert shedder.level == bot.SHED_NORMAL
+
+
+def test_shed_replies_and_stale_stats(monkeypatch, fresh_db, spin, stats):
+    shedder = make_shedder(monkeypatch, [0])
+    monkeypatch.setattr(bot.random, "randint", lambda a, b: 1)
+    scheduled = []
+    monkeypatch.setattr(bot.reply_scheduler, "schedule", lambda *a: scheduled.append(a[-1]))
+
+    async def run():
+        await spin(1, 10, "Alice", 64)
+        first = await stats(1)
+        shedder.level = bot.SHED_STALE_STATS
+        await spin(1, 10, "Alice", 16)  # near-jackpot: taunt skipped
+        await spin(1, 20, "Bob", 64)    # jackpot: still answered
+        assert await stats(1) == first  # outdated by the jackpot, served anyway
+        shedder.level = bot.SHED_COUNT_ONLY
+        await spin(1, 20, "Bob", 64)
+        shedder.level = bot.SHED_NORMAL
+        assert "<b>Total Jackpot:</b> 3" in await stats(1)
+
+    asyncio.run(run())
+    assert scheduled == ["jackpot", "jackpot"]
+    assert shedder.skipped == {"near-jackpot": 1, "jackpot": 1}
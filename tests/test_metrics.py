@@ -0,0 +1,78 @@
+import asyncio
+import os
+import socket
+import sys
+import urllib.request
+from types import SimpleNamespace
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import bot
+import metrics
+
+
+def sample(text, name):
+    for line in text.splitlines():
+        if line.startswith(name + " "):
+            return float(line.rsplit(" ", 1)[1])
+    raise AssertionError(f"{name} not in output")
+
+
+def test_render_format():
+    reg = metrics.Registry()
+    c = metrics.Counter("x_total", "X.", ("code",), registry=reg)
+    c.labels('4"29').inc(2)
+    h = metrics.Histogram("y_seconds", "Y.", buckets=(0.1, 1), registry=reg)
+    h.observe(0.05)
+    h.observe(0.5)
+    h.observe(5)
+    metrics.Sampled("z", "Z.", lambda: 7, registry=reg)
+    text = reg.render()
+    assert '# TYPE x_total counter\nx_total{code="4\\"29"} 2' in text
+    assert 'y_seconds_bucket{le="0.1"} 1' in text
+    assert 'y_seconds_bucket{le="1"} 2' in text
+    assert 'y_seconds_bucket{le="+Inf"} 3' in text
+    assert sample(text, "y_seconds_count") == 3 and sample(text, "y_seconds_sum") == 5.55
+    assert sample(text, "z") == 7
+
+
+def test_handlers_and_storage_instrumented(fresh_db, make_update):
+    dice = bot.HANDLER_SECONDS.labels("on_dice")
+    stats = bot.HANDLER_SECONDS.labels("cmd_stats")
+    before = (dice.count, stats.count, bot.UPDATE_LAG.count)
+    writes = bot.SQLITE_SECONDS.labels("write", "write_spin_batch")
+    reads = bot.SQLITE_SECONDS.labels("read", "sql_stats")
+    io_before = (writes.count, reads.count)
+
+    async def run():
+        await bot.on_dice(make_update(1, 10, value=64, age=42), None)
+        await asyncio.wrap_future(bot.spin_buffer.flush())
+        await bot.cmd_stats(make_update(1, 10), SimpleNamespace(args=[]))
+        text = metrics.REGISTRY.render()
+        assert sample(text, "ludooman_delayed_replies_pending") == 1
+        assert sample(text, "ludooman_sqlite_commits_total") >= 1
+        await bot.reply_scheduler.drain(0)
+
+    asyncio.run(run())
+    assert (dice.count, stats.count, bot.UPDATE_LAG.count) == (before[0] + 1, before[1] + 1, before[2] + 2)
+    assert writes.count > io_before[0] and reads.count > io_before[1]
+    assert bot.UPDATE_LAG.labels().counts[bot.LAG_BUCKETS.index(60)] >= 1  # the 42s-old spin
+
+
+def test_side_port_server():
+    reg = metrics.Registry()
+    metrics.Counter("up_total", "Up.", registry=reg).inc()
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+
+    async def run():
+        server = metrics.serve(port, "/metrics", reg, address="127.0.0.1")
+        try:
+            loop = asyncio.get_running_loop()
+            url = f"http://127.0.0.1:{port}/metrics"
+            body = await loop.run_in_executor(None, lambda: urllib.request.urlopen(url, timeout=5).read())
+            return body.decode()
+        finally:
+            server.stop()
+
+    assert "up_total 1" in asyncio.run(run())
@@ -0,0 +1,72 @@
+import asyncio
+import os
+import sqlite3
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import bot
+
+
+def make_v1_db(path):
+    c = sqlite3.connect(path)
+    c.executescript("""
+    CREATE TABLE results(chat_id INTEGER NOT NULL, user_id INTEGER NOT NULL, username TEXT,
+        combo TEXT NOT NULL, count INTEGER NOT NULL DEFAULT 0, PRIMARY KEY(chat_id, user_id, combo));
+    CREATE TABLE totals(chat_id INTEGER NOT NULL, user_id INTEGER NOT NULL,
+        spins INTEGER NOT NULL DEFAULT 0, PRIMARY KEY(chat_id, user_id));
+    """)
+    c.executemany("INSERT INTO results VALUES(?,?,?,?,?)", [
+        (1, 10, "Alice", "seven|seven|seven", 3),
+        (1, 10, "Alice", "grape|bar|bar", 7),
+        (1, 20, "Bob", "bar|bar|bar", 2),
+        (2, 10, "Alice", "lemon|lemon|lemon", 1),
+    ])
+    c.executemany("INSERT INTO totals VALUES(?,?,?)", [(1, 10, 40), (1, 20, 9), (2, 10, 5)])
+    c.commit()
+    c.close()
+
+
+def test_v1_rows_readable_during_and_after_migration(fresh_db):
+    path = bot.DB_PATH
+    make_v1_db(path)
+
+    async def run():
+        storage = bot.get_storage()
+        assert storage.legacy
+        bot.upsert_result(1, 10, "Alice", 64)
+        bot.spin_buffer.flush()
+        assert await storage.write(bot.migrate_v2_batch, 2) == 2  # half of `results` moved
+
+        rows, total = await bot.fetch_user_stats(1, 10)
+        assert dict(rows) == {64: 4, 2: 7} and total == 41
+        view = await bot.fetch_stats_view(1)
+        assert view.totals[10] == (4, 41) and view.total == 6
+
+        await bot.migrate_v2(storage, 2)
+        assert not storage.legacy
+        rows, total = await bot.fetch_user_stats(1, 10)
+        assert dict(rows) == {64: 4, 2: 7} and total == 41
+        view = await bot.fetch_stats_view(1)
+        assert view.combos[1] == {20: 2} and view.names[20] == "Bob"
+        assert view.totals == {10: (4, 41), 20: (2, 9)}
+
+    asyncio.run(run())
+    c = sqlite3.connect(path)
+    tables = {r[0] for r in c.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    assert "results" not in tables and "totals" not in tables
+    assert c.execute("PRAGMA user_version").fetchone()[0] == bot.SCHEMA_VERSION
+    assert c.execute("SELECT COUNT(*) FROM dice_counts").fetchone()[0] == 4
+
+
+def test_names_written_only_when_changed(monkeypatch, tmp_path):
+    buf = bot.SpinBuffer(interval=60, max_pending=1000)
+    buf.add(1, 10, "Alice", 3)
+    buf.add(2, 10, "Alice", 3)
+    _, _, names, _ = buf.rows(buf._chats)
+    assert names == [(10, "Alice")]
+    buf._chats = {}
+    buf.add(1, 10, "Alice", 5)
+    assert buf.rows(buf._chats)[2] == []
+    buf._chats = {}
+    buf.add(1, 10, "Alice B.", 5)
+    assert buf.rows(buf._chats)[2] == [(10, "Alice B.")]
@@ -30,21 +30,22 @@ def test_near_jackpot_delay_range():
         captured['range'] = (a, b)
         return 5.5
 
-    async def fake_sleep(delay):
+    def fake_schedule(chat_id, message, text, delay, kind="delayed"):
         captured['delay'] = delay
+        captured['text'] = text
 
     orig_uniform = random.uniform
-    orig_sleep = asyncio.sleep
     orig_randint = random.randint
     random.uniform = fake_uniform
-    asyncio.sleep = fake_sleep
     random.randint = lambda a, b: 1
+    bot.reply_scheduler.schedule = fake_schedule
     try:
         asyncio.run(bot.on_dice(update, context))
     finally:
         random.uniform = orig_uniform
-        asyncio.sleep = orig_sleep
         random.randint = orig_randint
+        importlib.reload(bot)
 
     assert captured['range'] == (bot.NEAR_JACKPOT_DELAY_MIN, bot.NEAR_JACKPOT_DELAY_MAX)
     assert bot.NEAR_JACKPOT_DELAY_MIN <= captured['delay'] <= bot.NEAR_JACKPOT_DELAY_MAX
+    assert captured['text'] in bot.NEAR_JACKPOT_PHRASES
@@ -0,0 +1,68 @@
+import os
+import sqlite3
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import bot
+
+
+class PlanRecorder:
+    """Connection stand-in that records EXPLAIN QUERY PLAN for every statement."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.plans = []
+
+    def execute(self, sql, params=()):
+        plan = [row[3] for row in self.conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+        self.plans.append((" ".join(sql.split()), plan))
+        return self.conn.execute(sql, params)
+
+
+def populated_db(tmp_path):
+    path = str(tmp_path / "stats.sqlite3")
+    bot.Storage(path).open().close()
+    c = sqlite3.connect(path)
+    c.executemany("INSERT INTO dice_counts VALUES(?,?,?,?)",
+                  [(chat, uid, v, (uid * v) % 17 + 1) for chat in range(3) for uid in range(300)
+                   for v in (1, 5, 22, 40, 43, 64)])
+    c.executemany("INSERT INTO spin_totals VALUES(?,?,?,?)",
+                  [(chat, uid, 100 + uid, uid % 4) for chat in range(3) for uid in range(300)])
+    c.executemany("INSERT INTO users VALUES(?,?)", [(uid, f"user{uid}") for uid in range(300)])
+    c.commit()
+    c.execute("ANALYZE")
+    return c
+
+
+def test_stats_queries_use_indexes(tmp_path):
+    rec = PlanRecorder(populated_db(tmp_path))
+    total, combos, totals, names = bot.sql_stats(rec, 1, 5, 10, 10, (7, 8))
+
+    assert total == sum(uid % 4 for uid in range(300))
+    assert len([r for r in combos if r[0] == 64]) >= 5
+    for sql, plan in rec.plans:
+        text = " | ".join(plan)
+        assert "TEMP B-TREE" not in text, (sql, plan)
+        for line in plan:
+            assert not line.startswith("SCAN dice_counts") and not line.startswith("SCAN spin_totals"), (sql, plan)
+    text = " | ".join(" | ".join(p) for _, p in rec.plans)
+    assert "COVERING INDEX dice_counts_top" in text
+    assert "INDEX spin_totals_top" in text
+    assert "INDEX spin_totals_luck" in text
+
+
+def test_top_n_matches_full_ranking(tmp_path):
+    c = populated_db(tmp_path)
+    total, combos, totals, names = bot.sql_stats(c, 2, 5, 10, 10)
+    full = c.execute("SELECT user_id, count FROM dice_counts WHERE chat_id=2 AND value=64").fetchall()
+    best = sorted((n for _, n in full), reverse=True)[:5]
+    assert sorted((n for v, _, n in combos if v == 64), reverse=True) == best
+    assert all(uid in names for _, uid, _ in combos)
+
+
+def test_rollup_prune_is_a_range_delete(tmp_path):
+    c = populated_db(tmp_path)
+    for table in bot.ROLLUPS:
+        plan = [r[3] for r in c.execute(f"EXPLAIN QUERY PLAN DELETE FROM {table} WHERE bucket < ?", (100,))]
+        assert plan and all(not line.startswith("SCAN") for line in plan), (table, plan)
+        assert f"INDEX {table}_bucket" in " | ".join(plan)
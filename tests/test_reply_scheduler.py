@@ -0,0 +1,92 @@
+import asyncio
+import os
+import sys
+from types import SimpleNamespace
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import bot
+
+
+class DummyMessage:
+    def __init__(self, sent):
+        self.sent = sent
+
+    async def reply_text(self, text):
+        self.sent.append(text)
+
+
+def test_replies_sent_in_due_order():
+    sched = bot.ReplyScheduler()
+    sent = []
+
+    async def run():
+        sched.schedule(1, DummyMessage(sent), "late", 0.05)
+        sched.schedule(1, DummyMessage(sent), "early", 0.01)
+        assert sched.depth == 2
+        await sched.drain(1.0)
+
+    asyncio.run(run())
+    assert sent == ["early", "late"]
+    stats = sched.stats()
+    assert stats["sent"] == 2 and stats["depth"] == 0
+    assert stats["max_lateness"] >= 0
+
+
+def test_cancel_and_drain_drops_pending():
+    sched = bot.ReplyScheduler()
+    sent = []
+
+    async def run():
+        h = sched.schedule(1, DummyMessage(sent), "cancelled", 0.01)
+        sched.schedule(2, DummyMessage(sent), "too late", 60)
+        assert sched.cancel(h)
+        assert not sched.cancel(h)
+        await sched.drain(0.05)
+
+    asyncio.run(run())
+    assert sent == []
+    assert sched.stats()["dropped"] == 1
+
+
+def test_drain_not_lost_to_a_wakeup():
+    # a schedule() waking the worker just as drain() cancels it must not swallow the cancel
+    sent = []
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        for yields in range(4):
+            sched = bot.ReplyScheduler()
+            sched.schedule(1, DummyMessage(sent), "far", 60)
+            await asyncio.sleep(0.01)
+            sched.schedule(1, DummyMessage(sent), "farther", 120)
+            for _ in range(yields):
+                await asyncio.sleep(0)
+            t0 = loop.time()
+            await asyncio.wait_for(sched.drain(0), 1)
+            assert loop.time() - t0 < 0.5
+            assert sched.stats()["dropped"] == 2
+
+    asyncio.run(run())
+    assert sent == []
+
+
+def test_on_dice_returns_before_reply():
+    sched = bot.reply_scheduler
+    sent = []
+
+    message = DummyMessage(sent)
+    message.dice = SimpleNamespace(emoji="🎰", value=64)
+    update = SimpleNamespace(
+        effective_message=message,
+        effective_user=SimpleNamespace(id=1, full_name="User", username="user"),
+        effective_chat=SimpleNamespace(id=1),
+    )
+
+    async def run():
+        await bot.on_dice(update, None)
+        assert sent == [] and sched.depth == 1
+        sched.cancel_chat(1)
+        await sched.drain(0.1)
+
+    asyncio.run(run())
+    assert sent == []
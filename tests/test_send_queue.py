@@ -0,0 +1,143 @@
+import asyncio
+import os
+import sys
+from datetime import timedelta
+
+from telegram.error import RetryAfter
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import bot
+
+
+class Recorder:
+    def __init__(self, loop):
+        self.loop = loop
+        self.sent = []
+        self.gate = asyncio.Event()
+        self.gate.set()
+
+    async def send(self, text):
+        await self.gate.wait()
+        self.sent.append((text, self.loop.time()))
+        return text
+
+
+def test_priority_order_within_chat():
+    q = bot.SendQueue(rate=1000, chat_rate=1000, chat_burst=10)
+
+    async def run():
+        r = Recorder(asyncio.get_running_loop())
+        r.gate.clear()
+        first = q.submit(1, r.send, "first", kind="near-jackpot")
+        await asyncio.sleep(0.01)  # in flight, holding the chat
+        q.submit(1, r.send, "taunt", kind="near-jackpot")
+        q.submit(1, r.send, "jackpot", kind="jackpot")
+        cmd = q.submit(1, r.send, "stats")
+        r.gate.set()
+        assert await cmd == "stats" and await first == "first"
+        await q.drain(1)
+        return [t for t, _ in r.sent]
+
+    assert asyncio.run(run()) == ["first", "stats", "jackpot", "taunt"]
+    assert q.sent == 4 and q.pending == 0
+
+
+def test_chat_bucket_spaces_messages_but_not_other_chats():
+    q = bot.SendQueue(rate=1000, chat_rate=20, chat_burst=1)
+
+    async def run():
+        r = Recorder(asyncio.get_running_loop())
+        await asyncio.gather(q.submit(1, r.send, "a1"), q.submit(1, r.send, "a2"), q.submit(2, r.send, "b1"))
+        await q.drain(1)
+        return dict(r.sent)
+
+    at = asyncio.run(run())
+    assert at["a2"] - at["a1"] >= 0.04
+    assert at["b1"] < at["a2"]
+
+
+def test_retry_after_requeues_instead_of_losing_reply():
+    q = bot.SendQueue(rate=1000, chat_rate=1000, chat_burst=10)
+    calls = []
+
+    async def flaky(text):
+        calls.append(text)
+        if len(calls) == 1:
+            raise RetryAfter(timedelta(milliseconds=50))
+        return text
+
+    async def run():
+        result = await q.submit(7, flaky, "jackpot!", kind="jackpot")
+        await q.drain(1)
+        return result
+
+    assert asyncio.run(run()) == "jackpot!"
+    assert calls == ["jackpot!", "jackpot!"]
+    assert q.retried == 1 and q.sent == 1 and q.failed == 0
+
+
+def test_saturation_drops_taunts_only():
+    q = bot.SendQueue(rate=1000, chat_rate=1000, chat_burst=10, max_pending=3)
+
+    async def run():
+        r = Recorder(asyncio.get_running_loop())
+        r.gate.clear()
+        q.submit(1, r.send, "busy", kind="jackpot")
+        await asyncio.sleep(0.01)
+        t1 = q.submit(1, r.send, "t1", kind="near-jackpot")
+        t2 = q.submit(1, r.send, "t2", kind="near-jackpot")
+        j = q.submit(1, r.send, "j", kind="jackpot")        # full: evicts t1
+        t3 = q.submit(1, r.send, "t3", kind="near-jackpot")  # full: evicts t2
+        c = q.submit(1, r.send, "c")                         # full: evicts t3
+        c2 = q.submit(1, r.send, "c2")                       # full, nothing droppable: queued anyway
+        t4 = q.submit(1, r.send, "t4", kind="near-jackpot")  # full, nothing droppable: dropped itself
+        assert t1.cancelled() and t2.cancelled() and t3.cancelled() and t4.cancelled()
+        r.gate.set()
+        await asyncio.gather(j, c, c2)
+        await q.drain(1)
+        return [t for t, _ in r.sent]
+
+    assert asyncio.run(run()) == ["busy", "c", "c2", "j"]
+    assert q.dropped == 4 and q.sent == 4
+
+
+def test_scheduler_hands_off_to_send_queue(monkeypatch):
+    q = bot.SendQueue(rate=1000, chat_rate=1000, chat_burst=10)
+    monkeypatch.setattr(bot, "send_queue", q)
+    sched = bot.ReplyScheduler()
+
+    class Message:
+        def __init__(self):
+            self.sent = []
+
+        async def reply_text(self, text):
+            self.sent.append(text)
+
+    async def run():
+        m = Message()
+        sched.schedule(5, m, "near", 0.01, "near-jackpot")
+        sched.schedule(5, m, "jackpot", 0.01, "jackpot")
+        await sched.drain(1)
+        return m.sent
+
+    assert sorted(asyncio.run(run())) == ["jackpot", "near"]
+    assert sched.stats()["sent"] == 2 and q.sent == 2
+
+
+def test_throttled_chat_replies_do_not_block_other_chats(monkeypatch, fresh_db, make_update):
+    q = bot.SendQueue(rate=1000, chat_rate=0.01, chat_burst=1)  # chat 1 gets one message, then waits
+    monkeypatch.setattr(bot, "send_queue", q)
+    proc = bot.ChatOrderedProcessor(concurrency=1)
+
+    async def run():
+        async with proc:
+            helps = [make_update(1) for _ in range(3)]
+            for u in helps:
+                await asyncio.wait_for(proc.process_update(u, bot.cmd_help(u, None)), 1)
+            spin = make_update(2, 10, "Alice", 1)
+            await asyncio.wait_for(proc.process_update(spin, bot.on_dice(spin, None)), 1)
+            assert bot.spin_buffer.pending == 1
+            assert [len(u.message.sent) for u in helps] == [1, 0, 0] and q.pending == 2
+            assert proc.running == 0
+
+    asyncio.run(run())
@@ -25,3 +25,23 @@ def test_get_next_jackpot_phrase_cycle():
 
     collected = asyncio.run(collect())
     assert collected == set(bot.JACKPOT_PHRASES)
+
+
+def test_outcome_table():
+    assert bot.OUTCOMES[0] is None and len(bot.OUTCOMES) == 65
+    assert {o.value for o in bot.OUTCOMES[1:] if o.triple} == bot.TRIPLE_SET
+    o = bot.OUTCOMES[16]
+    assert o.symbols == bot.slot_value[16] and o.key == "seven|seven|bar"
+    assert o.near and not o.triple and o.compact == "7️⃣7️⃣🍺"
+    assert not bot.OUTCOMES[2 + 4 * 2].near  # grape, lemon, bar
+
+
+def test_display_names_follow_renames():
+    from telegram import User
+    names = bot.DisplayNames(max_size=2)
+    assert names.get(User(1, "Alice", False, last_name="L")) == "Alice L"
+    assert names.get(User(1, "Alice", False, last_name="L")) == "Alice L"
+    assert names.get(User(1, "Alicia", False)) == "Alicia"
+    names.get(User(2, "Bob", False))
+    names.get(User(3, "Carol", False))
+    assert len(names) <= 2
@@ -0,0 +1,84 @@
+import gzip
+import os
+import sqlite3
+import sys
+import threading
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import bot
+
+
+def spins(path):
+    c = sqlite3.connect(path)
+    try:
+        return c.execute("SELECT COALESCE(SUM(spins), 0) FROM spin_totals").fetchone()[0]
+    finally:
+        c.close()
+
+
+def test_snapshot_while_writing_and_restore(tmp_path):
+    db = str(tmp_path / "stats.sqlite3")
+    storage = bot.Storage(db).open()
+    snaps = bot.Snapshots(str(tmp_path / "snap"), keep=2, step_pages=4, step_pause=0)
+    stop = threading.Event()
+
+    def write(c, i):
+        bot.upsert_spin_counts(c, [(1, i, 64, 1)], [(1, i, 1, 1)])
+        c.commit()
+
+    def writer():
+        i = 0
+        while not stop.is_set():
+            storage.submit_write(write, i).result()
+            i += 1
+
+    for f in [storage.submit_write(write, 100_000 + i) for i in range(2000)]:
+        f.result()
+    t = threading.Thread(target=writer)
+    t.start()
+    try:
+        paths = [snaps.take(storage.path) for _ in range(3)]
+    finally:
+        stop.set()
+        t.join()
+        storage.close()
+    assert snaps.taken == 3 and snaps.failed == 0
+    kept = [str(p) for p in snaps.files(db)]
+    assert len(kept) == 2 and paths[-1] in kept
+    assert not [p for p in os.listdir(tmp_path / "snap") if not p.endswith(".sqlite3.gz")]
+
+    restored = str(tmp_path / "lost" / "stats.sqlite3")
+    os.makedirs(os.path.dirname(restored))
+    assert snaps.restore(db) is None  # DB still there: left alone
+    # snapshots are looked up by the DB file's stem, wherever the DB lives now
+    assert snaps.restore(restored) == kept[0]
+    assert 2000 <= spins(restored) <= spins(db)
+
+
+def test_damaged_snapshot_skipped(tmp_path):
+    db = str(tmp_path / "stats.sqlite3")
+    storage = bot.Storage(db).open()
+    storage.submit_write(lambda c: (bot.upsert_spin_counts(c, [(1, 1, 64, 5)], [(1, 1, 5, 5)]), c.commit())).result()
+    storage.close()
+    snaps = bot.Snapshots(str(tmp_path / "snap"), keep=5, step_pages=100)
+    good = snaps.take(db)
+    with gzip.open(str(tmp_path / "snap" / "stats-99999999T000000Z.sqlite3.gz"), "wb") as z:
+        z.write(b"not a database" * 100)
+    os.remove(db)
+    assert snaps.restore(db) == good
+    assert spins(db) == 5
+    assert not os.path.exists(db + ".restore")
+
+
+def test_vacuum_only_with_free_pages(tmp_path):
+    c = sqlite3.connect(str(tmp_path / "v.sqlite3"))
+    c.execute("PRAGMA journal_mode=WAL")
+    c.execute("CREATE TABLE t(x)")
+    with c:
+        c.executemany("INSERT INTO t VALUES(randomblob(1000))", [()] * 500)
+    assert not bot.vacuum_db(c, 0.2)
+    with c:
+        c.execute("DELETE FROM t")
+    assert bot.vacuum_db(c, 0.2)
+    assert c.execute("PRAGMA freelist_count").fetchone()[0] == 0
+    c.close()
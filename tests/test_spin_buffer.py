@@ -0,0 +1,89 @@
+import asyncio
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import bot
+
+
+def test_pending_spins_visible_before_flush(fresh_db):
+    buf = fresh_db
+    for _ in range(3):
+        bot.upsert_result(1, 10, "Alice", 64)
+    bot.upsert_result(1, 10, "Alice", 5)
+    bot.upsert_result(1, 20, "Bob", 1)
+    assert buf.pending == 3
+
+    async def run():
+        rows, total = await bot.fetch_user_stats(1, 10)
+        assert rows[0] == (64, 3)
+        assert total == 4
+        view = await bot.fetch_stats_view(1)
+        assert view.combos[64] == {10: 3}
+        assert view.combos[1] == {20: 1}
+        assert view.totals == {10: (3, 4), 20: (1, 1)}
+        assert view.total == 4
+
+    asyncio.run(run())
+
+
+def test_flush_merges_into_one_commit(fresh_db):
+    buf = fresh_db
+
+    async def run():
+        for _ in range(50):
+            bot.upsert_result(1, 10, "Alice", 64)
+        fut = buf.flush()
+        # in flight: not yet committed, but still visible to readers
+        rows, total = await bot.fetch_user_stats(1, 10)
+        assert rows == [(64, 50)] and total == 50
+        await asyncio.wrap_future(fut)
+        await asyncio.sleep(0)
+        assert buf.commits == 1 and buf.pending == 0
+        bot.upsert_result(1, 10, "Alice", 64)
+        return await bot.fetch_user_stats(1, 10)
+
+    rows, total = asyncio.run(run())
+    assert rows == [(64, 51)]
+    assert total == 51
+    stored = bot.get_storage().submit_write(lambda c: c.execute("SELECT count FROM dice_counts").fetchall())
+    assert stored.result() == [(50,)]
+
+
+def test_size_threshold_triggers_flush(fresh_db):
+    buf = fresh_db
+    buf.max_pending = 2
+    bot.upsert_result(1, 10, "Alice", 1)
+    bot.upsert_result(1, 11, "Bob", 1)
+    assert buf.pending == 0 and buf.commits == 1
+
+
+def test_redelivered_spins_counted_once(fresh_db):
+    buf = fresh_db
+    assert bot.upsert_result(1, 10, "Alice", 64, message_id=7)
+    assert bot.upsert_result(2, 10, "Alice", 64, message_id=7)  # ids are per chat
+    assert not bot.upsert_result(1, 10, "Alice", 64, message_id=7)
+    buf.flush()
+    assert not bot.upsert_result(1, 10, "Alice", 64, message_id=7)  # after the commit too
+    assert bot.spin_dedupe.duplicates == 2
+    stored = bot.get_storage().submit_write(lambda c: c.execute(
+        "SELECT chat_id, count FROM dice_counts ORDER BY chat_id").fetchall())
+    assert stored.result() == [(1, 1), (2, 1)]
+
+
+def test_marks_survive_restart(fresh_db, restart):
+    buf = fresh_db
+    for message_id in (3, 9, 5):  # out of order within a run is fine
+        bot.upsert_result(1, 10, "Alice", 64, message_id=message_id)
+    buf.flush()
+
+    buf = restart()  # empty LRU, marks reloaded
+    assert bot.get_storage().marks == {1: 9}
+    assert not bot.upsert_result(1, 10, "Alice", 64, message_id=5)
+    assert not bot.upsert_result(1, 10, "Alice", 64, message_id=9)
+    assert bot.upsert_result(1, 10, "Alice", 64, message_id=10)
+    assert bot.upsert_result(2, 10, "Alice", 64, message_id=1)
+    buf.flush()
+    stored = bot.get_storage().submit_write(lambda c: c.execute(
+        "SELECT chat_id, message_id FROM spin_marks ORDER BY chat_id").fetchall())
+    assert stored.result() == [(1, 10), (2, 1)]
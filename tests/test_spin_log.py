@@ -0,0 +1,57 @@
+import asyncio
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import bot
+
+DAY = 86400
+NOW = 1_760_000_000 - 1_760_000_000 % DAY + 12 * 3600  # noon UTC
+
+
+def test_windows_answered_from_rollups(fresh_db):
+    buf = fresh_db
+    bot.upsert_result(1, 10, "Alice", 64, NOW - 40 * DAY)   # outside every window
+    bot.upsert_result(1, 10, "Alice", 64, NOW - 20 * DAY)   # month
+    bot.upsert_result(1, 20, "Bob", 22, NOW - 3 * DAY)      # week
+    bot.upsert_result(1, 20, "Bob", 5, NOW - 3600)          # day
+
+    async def run():
+        buf.flush()
+        bot.upsert_result(1, 10, "Alice", 1, NOW - 60)      # still buffered
+        day = await bot.fetch_window_view(1, "day", NOW)
+        week = await bot.fetch_window_view(1, "week", NOW)
+        month = await bot.fetch_window_view(1, "month", NOW)
+        return day, week, month
+
+    day, week, month = asyncio.run(run())
+    assert day.total == 1 and day.totals == {20: (0, 1), 10: (1, 1)}
+    assert week.total == 2 and week.combos[22] == {20: 1}
+    assert month.total == 3 and month.combos[64] == {10: 1}
+    assert "Alice" in bot.render_stats(month)
+
+
+def test_prune_drops_old_partitions(fresh_db):
+    buf = fresh_db
+    for days_ago in (30, 10, 0):
+        bot.upsert_result(1, 10, "Alice", 64, NOW - days_ago * DAY)
+    buf.flush()
+    storage = bot.get_storage()
+    tables = lambda c: sorted(r[0] for r in c.execute(
+        "SELECT name FROM sqlite_master WHERE name GLOB 'spin_log_*'"))
+    assert len(storage.submit_write(tables).result()) == 3
+    dropped = storage.submit_write(bot.prune_spin_log, NOW, 14, 7, 0).result()
+    assert dropped == 1
+    assert len(storage.submit_write(tables).result()) == 2
+    hourly = storage.submit_write(lambda c: c.execute("SELECT COUNT(*) FROM rollup_hourly").fetchone()[0])
+    daily = storage.submit_write(lambda c: c.execute("SELECT COUNT(*) FROM rollup_daily").fetchone()[0])
+    assert hourly.result() == 1 and daily.result() == 3
+
+
+def test_retention_too_short_for_stats_windows_is_raised(monkeypatch):
+    monkeypatch.setenv("ROLLUP_DAILY_RETENTION_DAYS", "7")
+    assert bot._retention_days("ROLLUP_DAILY_RETENTION_DAYS", "0", 30) == 30
+    monkeypatch.setenv("ROLLUP_DAILY_RETENTION_DAYS", "0")
+    assert bot._retention_days("ROLLUP_DAILY_RETENTION_DAYS", "0", 30) == 0  # forever
+    monkeypatch.setenv("ROLLUP_DAILY_RETENTION_DAYS", "90")
+    assert bot._retention_days("ROLLUP_DAILY_RETENTION_DAYS", "0", 30) == 90
@@ -0,0 +1,99 @@
+import asyncio
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import urllib.error
+import urllib.request
+from types import SimpleNamespace
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import bot
+
+
+def tables(path):
+    c = sqlite3.connect(path)
+    try:
+        return {r[0] for r in c.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    finally:
+        c.close()
+
+
+def test_schema_ddl_only_when_version_changes(tmp_path):
+    path = str(tmp_path / "stats.sqlite3")
+    bot.Storage(path).open().close()
+    c = sqlite3.connect(path)
+    c.execute("DROP TABLE combo_odds")
+    c.commit()
+    c.close()
+    bot.Storage(path).open().close()
+    assert "combo_odds" not in tables(path)  # current version: no DDL on open
+
+    c = sqlite3.connect(path)
+    c.execute("PRAGMA user_version=3")
+    c.close()
+    bot.Storage(path).open().close()
+    assert "combo_odds" in tables(path)
+
+
+def probe(port):
+    try:
+        return urllib.request.urlopen(f"http://127.0.0.1:{port}/ready", timeout=5).status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def test_updates_held_until_db_open(monkeypatch, fresh_db):
+    monkeypatch.setattr(bot, "startup", bot.StartupLog())
+    monkeypatch.setattr(bot, "update_processor", bot.ChatOrderedProcessor(2))
+    monkeypatch.setattr(bot, "load_shedder", bot.LoadShedder([], [], 10, 5))
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    monkeypatch.setattr(bot, "METRICS_PORT", port)
+    monkeypatch.setattr(bot, "WEBHOOK_BASE", None)
+    release = threading.Event()
+    open_db = bot.Storage.open
+
+    def slow_open(self):
+        release.wait(5)
+        return open_db(self)
+    monkeypatch.setattr(bot.Storage, "open", slow_open)
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        app = SimpleNamespace(running=False)
+        handled = []
+
+        async def handle():
+            handled.append(bot.get_storage().path)
+
+        await bot.update_processor.initialize()
+        await bot.on_start(app)
+        task = asyncio.create_task(bot.update_processor.process_update(
+            SimpleNamespace(effective_chat=SimpleNamespace(id=1)), handle()))
+        await asyncio.sleep(0.1)
+        assert not handled and bot.update_processor.waiting == 1
+        assert await loop.run_in_executor(None, probe, port) == 503
+
+        release.set()
+        await task
+        assert handled == [bot.DB_PATH]
+        app.running = True
+        while not bot.startup.ready:
+            await asyncio.sleep(0.01)
+        assert await loop.run_in_executor(None, probe, port) == 200
+        assert {"post_init", "db_open", "total"} <= set(bot.startup.phases)
+        await bot.stop_background()
+
+    asyncio.run(run())
+
+
+def test_api_client_pool_and_keepalive(monkeypatch):
+    monkeypatch.setattr(bot, "BOT_KEEPALIVE", 90.0)
+    monkeypatch.setattr(bot, "BOT_POOL_TIMEOUT", 2.0)
+    req = bot.api_request(32)
+    limits, timeout = req._client_kwargs["limits"], req._client_kwargs["timeout"]
+    assert limits.max_connections == limits.max_keepalive_connections == 32
+    assert limits.keepalive_expiry == 90.0 and timeout.pool == 2.0
@@ -0,0 +1,58 @@
+import asyncio
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import bot
+
+
+def test_stats_cached_until_jackpot(fresh_db, spin, stats):
+    async def run():
+        await spin(1, 10, "Alice", 64)
+        await spin(1, 10, "Alice", 3)
+        await spin(1, 20, "Bob", 1)
+        first = await stats(1)
+        assert "<b>Total Jackpot:</b> 2" in first
+        assert "1. Bob — 1.000 (≈1/1)" in first
+        assert "2. Alice — 0.500 (≈1/2)" in first
+
+        await spin(1, 20, "Bob", 2)  # no jackpot: cached text is reused
+        assert await stats(1) == first
+        assert bot.stats_cache.hits == 1
+
+        await spin(1, 10, "Alice", 64)  # jackpot: re-rendered
+        third = await stats(1)
+        assert "<b>Total Jackpot:</b> 3" in third
+        assert "1. Alice — 2" in third
+        assert "1. Alice — 0.667 (≈1/2)" in third
+        bot.reply_scheduler.cancel_chat(1)
+        await bot.reply_scheduler.drain(0)
+
+    asyncio.run(run())
+
+
+def test_same_display_name_kept_apart(fresh_db, spin, stats):
+    async def run():
+        await spin(1, 10, "Max", 64)
+        await spin(1, 11, "Max", 64)
+        await spin(1, 11, "Max", 64)
+        text = await stats(1)
+        assert "1. Max — 2" in text and "2. Max — 1" in text
+        bot.reply_scheduler.cancel_chat(1)
+        await bot.reply_scheduler.drain(0)
+
+    asyncio.run(run())
+
+
+def test_idle_chats_evicted(monkeypatch, fresh_db, spin, stats):
+    monkeypatch.setattr(bot, "stats_cache", bot.StatsCache(2, spin_staleness=60))
+
+    async def run():
+        for chat_id in (1, 2, 3):
+            await spin(chat_id, 10, "Alice", 22)
+            await stats(chat_id)
+        assert len(bot.stats_cache) == 2
+        assert "No data" in await stats(4)
+        assert len(bot.stats_cache) == 2
+
+    asyncio.run(run())
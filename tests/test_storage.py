@@ -0,0 +1,45 @@
+import asyncio
+import os
+import sys
+import threading
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import bot
+
+
+def test_reads_do_not_wait_for_writer(tmp_path):
+    storage = bot.Storage(str(tmp_path / "stats.sqlite3"), readers=2).open()
+    release = threading.Event()
+
+    def slow_write(c):
+        release.wait(5)
+        with c:
+            c.execute("INSERT INTO spin_totals(chat_id,user_id,spins) VALUES(1,1,1)")
+
+    async def run():
+        blocked = storage.submit_write(slow_write)
+        seq, rows = await storage.read(lambda c: c.execute("SELECT COUNT(*) FROM spin_totals").fetchone())
+        assert rows == (0,) and not blocked.done()
+        release.set()
+        await asyncio.wrap_future(blocked)
+        _, rows = await storage.read(lambda c: c.execute("SELECT COUNT(*) FROM spin_totals").fetchone())
+        assert rows == (1,)
+
+    try:
+        asyncio.run(run())
+    finally:
+        storage.close()
+
+
+def test_writes_are_serialized_in_order(tmp_path):
+    storage = bot.Storage(str(tmp_path / "stats.sqlite3")).open()
+    seen = []
+    try:
+        futs = [storage.submit_write(lambda c, i=i: seen.append(i)) for i in range(20)]
+        for f in futs:
+            f.result()
+        assert seen == list(range(20))
+        journal = storage.submit_write(lambda c: c.execute("PRAGMA journal_mode").fetchone()[0])
+        assert journal.result() == "wal"
+    finally:
+        storage.close()
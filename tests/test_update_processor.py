@@ -0,0 +1,86 @@
+import asyncio
+import os
+import sys
+from types import SimpleNamespace
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import bot
+
+
+def update(chat_id):
+    return SimpleNamespace(effective_chat=SimpleNamespace(id=chat_id))
+
+
+def test_chats_in_parallel_each_chat_in_order():
+    proc = bot.ChatOrderedProcessor(concurrency=2)
+    log = []
+
+    async def run():
+        gate = asyncio.Event()
+        running = []
+
+        async def handle(tag, wait=False):
+            running.append(tag)
+            assert len(running) <= 2
+            if wait:
+                await gate.wait()
+            log.append(tag)
+            running.remove(tag)
+
+        async with proc:
+            tasks = [
+                asyncio.create_task(proc.process_update(update(1), handle("a1", wait=True))),
+                asyncio.create_task(proc.process_update(update(1), handle("a2"))),
+                asyncio.create_task(proc.process_update(update(2), handle("b1"))),
+                asyncio.create_task(proc.process_update(update(3), handle("c1"))),
+            ]
+            await asyncio.sleep(0.01)
+            # a1 blocks chat 1 only: other chats went ahead, a2 waits for its turn without a slot
+            assert log == ["b1", "c1"]
+            assert proc.running == 1 and proc.waiting == 1
+            gate.set()
+            await asyncio.gather(*tasks)
+        assert proc._chats == {}
+
+    asyncio.run(run())
+    assert log == ["b1", "c1", "a1", "a2"]
+
+
+def test_concurrency_limit():
+    proc = bot.ChatOrderedProcessor(concurrency=2)
+    peak = 0
+
+    async def run():
+        nonlocal peak
+        gate = asyncio.Event()
+
+        async def handle():
+            nonlocal peak
+            peak = max(peak, proc.running)
+            await gate.wait()
+
+        async with proc:
+            tasks = [asyncio.create_task(proc.process_update(update(c), handle())) for c in range(5)]
+            await asyncio.sleep(0.01)
+            assert proc.running == 2 and proc.waiting == 3
+            gate.set()
+            await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+    assert peak == 2
+
+
+def test_order_kept_for_many_updates_of_one_chat():
+    proc = bot.ChatOrderedProcessor(concurrency=8)
+    seen = []
+
+    async def run():
+        async def handle(i):
+            await asyncio.sleep(0.001 * (i % 3))
+            seen.append(i)
+
+        async with proc:
+            await asyncio.gather(*(proc.process_update(update(42), handle(i)) for i in range(50)))
+
+    asyncio.run(run())
+    assert seen == list(range(50))